@@ -0,0 +1,4 @@
+"""
+Benchmark suite that runs a Master and Slaves as local processes and measures distribution time, query latency,
+throughput and bytes on the wire. Run it with `python -m benchmark` from the src directory.
+"""
@@ -0,0 +1,48 @@
+"""
+Command line entry point of the benchmark suite. Every combination of the given sizes is run once.
+"""
+import argparse
+import itertools
+from benchmark.runner import run_benchmark, save_results
+from quantization import QUANTIZATIONS
+from spatial_index import INDEX_AUTO, INDEX_TYPES
+
+parser = argparse.ArgumentParser(prog='python -m benchmark')
+parser.add_argument('-n', type=int, nargs='+', default=[10000], help='Set numbers of training points')
+parser.add_argument('-d', type=int, nargs='+', default=[8], help='Set numbers of dimensions')
+parser.add_argument('-k', type=int, nargs='+', default=[5], help='Set numbers for k in kNN')
+parser.add_argument('--slaves', '-s', type=int, nargs='+', default=[2], help='Set numbers of Slave nodes')
+parser.add_argument('--classes', type=int, default=2, help='Set number of classes in the dataset')
+parser.add_argument('--queries', '-q', type=int, default=1000, help='Set number of query points')
+parser.add_argument('--batch-size', type=int, default=1, help='Set number of queries in one batch')
+parser.add_argument('--pipeline', type=int, default=1, help='Set number of batches in flight')
+parser.add_argument('--workers', type=int, default=1, help='Set number of workers of every Slave')
+parser.add_argument('--index', choices=INDEX_TYPES, default=INDEX_AUTO, help='Set index built by Slaves')
+parser.add_argument('--fan-out', default='exact', help='Set fan-out of the Master')
+parser.add_argument('--nprobe', type=int, nargs='+', default=[None],
+                    help='Set numbers of IVF lists probed by approximate search, exact search by default')
+parser.add_argument('--pruning', action='store_true',
+                    help='Answer batches in rounds of growing size with k-th distance bounds')
+parser.add_argument('--quantization', choices=QUANTIZATIONS, help='Scan shards quantized to int8 or float16')
+parser.add_argument('--max-batch-size', type=int, default=0,
+                    help='Set maximum number of queries the Master collects into one micro-batch, 0 disables it')
+parser.add_argument('--seed', type=int, default=0, help='Set seed of the dataset')
+parser.add_argument('--output', '-o', default='benchmark-results.json', help='Set file the results are saved to')
+parser.add_argument('--verbose', action='store_true', help='Show output of the nodes')
+args = parser.parse_args()
+
+results = []
+for n, d, k, slaves, nprobe in itertools.product(args.n, args.d, args.k, args.slaves, args.nprobe):
+    result = run_benchmark(n, d, k, slaves, args.classes, args.queries, args.batch_size, args.pipeline, args.workers,
+                           args.index, args.fan_out, nprobe, args.pruning, args.quantization, args.max_batch_size,
+                           args.seed, quiet=not args.verbose)
+    queries = result['queries']
+    print('n={} d={} k={} slaves={} nprobe={}: distribution {:.3f}s, {:.1f} queries/s, p50 {:.2f}ms, p99 {:.2f}ms, '
+          'recall {:.3f}, {:.0f} bytes/query'.format(n, d, k, slaves, nprobe, result['distribution']['seconds'],
+                                                     queries['queries_per_second'],
+                                                     queries['batch_latency_ms']['p50'],
+                                                     queries['batch_latency_ms']['p99'], queries['recall'],
+                                                     queries['bytes_per_query']))
+    results.append(result)
+save_results(results, args.output)
+print('Results saved to', args.output)
@@ -0,0 +1,35 @@
+"""
+Module contains synthetic datasets used by the benchmarks.
+"""
+import numpy as np
+from point_batch import PointBatch
+
+
+def gaussian_blobs(n, d, classes=2, spread=1.0, separation=4.0, seed=0):
+    """
+    Generates points around random class centers. Every point is labelled with the class of its center.
+    :param n: Number of points
+    :param d: Number of dimensions
+    :param classes: Number of classes (and centers)
+    :param spread: Standard deviation of points around their center
+    :param separation: Standard deviation of the centers around the origin
+    :param seed: Seed of the generator, the same seed always gives the same dataset
+    :return: PointBatch
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=separation, size=(classes, d))
+    labels = rng.integers(0, classes, n)
+    points = centers[labels] + rng.normal(scale=spread, size=(n, d))
+    return PointBatch(points, label_codes=labels.astype(np.int32), label_table=[str(c) for c in range(classes)])
+
+
+def train_test_split(batch, num_queries, seed=0):
+    """
+    Splits the dataset into training points and query points.
+    :param batch: PointBatch
+    :param num_queries: Number of query points
+    :param seed: Seed of the split
+    :return: tuple of (training PointBatch, query PointBatch)
+    """
+    shuffled = batch.shuffle(seed)
+    return shuffled[num_queries:], shuffled[:num_queries]
@@ -0,0 +1,146 @@
+"""
+Module contains a cluster of one Master and N Slaves running as local processes on loopback ports.
+"""
+import logging
+import multiprocessing
+import socket
+import time
+from master_node import MasterNode
+from slave_node import SlaveNode
+from query_client import QueryClient
+
+DEFAULT_START_TIMEOUT = 120.0
+
+
+def free_port():
+    """
+    Finds a loopback port that is not in use.
+    :return: port number
+    """
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def run_master(pipe, dataset, num_slaves, k, frontend, options, quiet):
+    """
+    Main function of the Master process. Reports its port, the distribution phase statistics after the dataset is
+    distributed and all statistics of the Master after the serving phase through the pipe.
+    """
+    logging.basicConfig(level=logging.WARNING if quiet else logging.INFO, format='%(message)s')
+    master = MasterNode(k=k, port=0, serve_address=frontend, **options)
+    pipe.send(master.socket.getsockname()[1])
+    master.start_connection_phase(num_slaves)
+    master.load_data(dataset)
+    master.start_data_distribution_phase()
+    pipe.send(dict(master.metrics.phase('distribution').to_dict(), shard_sizes=master.shard_sizes))
+    master.start_serving_phase(frontend)
+    pipe.send(master.stats())
+    master.start_shutdown_phase()
+
+
+def run_slave(port, options, quiet):
+    """
+    Main function of a Slave process.
+    """
+    logging.basicConfig(level=logging.WARNING if quiet else logging.INFO, format='%(message)s')
+    SlaveNode(master_port=port, **options).start_node()
+
+
+class LocalCluster(object):
+    """
+    Master and Slaves running as local processes. The Master serves queries at a loopback front end address.
+    """
+
+    def __init__(self, dataset, num_slaves, k=5, master_options=None, slave_options=None, quiet=True,
+                 timeout=DEFAULT_START_TIMEOUT):
+        """
+        Constructor for LocalCluster.
+        :param dataset: PointBatch distributed to the Slaves
+        :param num_slaves: Number of Slave processes
+        :param k: Number of neighbours
+        :param master_options: Keyword arguments of MasterNode
+        :param slave_options: Keyword arguments of SlaveNode
+        :param quiet: Hide output of the nodes
+        :param timeout: Seconds to wait for the cluster to start and stop
+        """
+        self.dataset = dataset
+        self.num_slaves = num_slaves
+        self.k = k
+        self.master_options = master_options or {}
+        self.slave_options = slave_options or {}
+        self.quiet = quiet
+        self.timeout = timeout
+        self.frontend = 'localhost:' + str(free_port())
+        self.context = multiprocessing.get_context('spawn')
+        self.pipe = None
+        self.master = None
+        self.slaves = []
+        self.distribution = None
+        self.serving = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def receive(self):
+        if not self.pipe.poll(self.timeout):
+            raise TimeoutError('Master did not report its progress within ' + str(self.timeout) + ' seconds')
+        return self.pipe.recv()
+
+    def start(self):
+        """
+        Starts all nodes and waits until the dataset is distributed.
+        :return: statistics of the distribution
+        """
+        self.pipe, child = self.context.Pipe()
+        self.master = self.context.Process(target=run_master, args=(child, self.dataset, self.num_slaves, self.k,
+                                                                    self.frontend, self.master_options, self.quiet))
+        self.master.start()
+        child.close()
+        port = self.receive()
+        for _ in range(self.num_slaves):
+            slave = self.context.Process(target=run_slave, args=(port, self.slave_options, self.quiet))
+            slave.start()
+            self.slaves.append(slave)
+        self.distribution = self.receive()
+        return self.distribution
+
+    def connect(self):
+        """
+        Connects a client to the Master's front end as soon as it accepts connections.
+        :return: QueryClient
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return QueryClient(self.frontend)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def stop(self):
+        """
+        Shuts the cluster down and waits for all processes.
+        :return: statistics of the Master
+        """
+        if self.master is None:
+            return self.serving
+        try:
+            if self.master.is_alive() and self.serving is None:
+                client = self.connect()
+                client.shutdown()
+                client.close()
+                self.serving = self.receive()
+        finally:
+            for process in [self.master] + self.slaves:
+                process.join(self.timeout)
+                if process.is_alive():
+                    process.terminate()
+            self.master = None
+            self.slaves = []
+        return self.serving
@@ -0,0 +1,144 @@
+"""
+Module contains benchmark runners and saving of their results.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+from benchmark.datasets import gaussian_blobs, train_test_split
+from benchmark.harness import LocalCluster
+from knn_classifier import ShardEngine
+
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+
+
+def measure_queries(client, queries, batch_size=1, pipeline=1, nprobe=None):
+    """
+    Sends queries to the cluster in batches, keeping up to `pipeline` batches in flight, and measures the latency
+    of every batch.
+    :param client: QueryClient
+    :param queries: [m x d] array of query points
+    :param batch_size: Number of queries in one batch
+    :param pipeline: Maximum number of batches in flight
+    :param nprobe: Number of IVF lists probed by approximate search, exact search by default
+    :return: tuple of (list of labels, [m x k] neighbour ids, array of batch latencies in seconds, total seconds)
+    """
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    sent = {}
+    labels = [None] * len(batches)
+    neighbours = [None] * len(batches)
+    latencies = []
+    next_batch = 0
+    start = time.perf_counter()
+    while len(latencies) < len(batches):
+        while next_batch < len(batches) and next_batch - len(latencies) < pipeline:
+            request_id = client.send_batch(batches[next_batch], nprobe=nprobe, neighbours=True)
+            sent[request_id] = (next_batch, time.perf_counter())
+            next_batch += 1
+        request_id, batch_labels, batch_neighbours = client.receive_result(with_neighbours=True)
+        batch_index, sent_at = sent.pop(request_id)
+        latencies.append(time.perf_counter() - sent_at)
+        labels[batch_index] = batch_labels
+        neighbours[batch_index] = batch_neighbours
+    return [label for batch_labels in labels for label in batch_labels], np.vstack(neighbours), \
+        np.array(latencies), time.perf_counter() - start
+
+
+def recall(neighbours, exact):
+    """
+    Fraction of the exact k nearest neighbours that were found.
+    :param neighbours: [m x k] array of found neighbour ids
+    :param exact: [m x k] array of exact neighbour ids
+    :return: recall between 0 and 1
+    """
+    if exact.size == 0:
+        return 1.0
+    return sum(len(np.intersect1d(found, true)) for found, true in zip(neighbours, exact)) / exact.size
+
+
+def run_benchmark(n=10000, d=8, k=5, slaves=2, classes=2, queries=1000, batch_size=1, pipeline=1, workers=1,
+                  index='auto', fan_out='exact', nprobe=None, pruning=False, quantization=None, max_batch_size=0,
+                  seed=0, quiet=True):
+    """
+    Runs one benchmark on a local cluster.
+    :param n: Number of training points
+    :param d: Number of dimensions
+    :param k: Number of neighbours
+    :param slaves: Number of Slave processes
+    :param classes: Number of classes in the dataset
+    :param queries: Number of query points
+    :param batch_size: Number of queries in one batch
+    :param pipeline: Maximum number of batches in flight
+    :param workers: Number of workers of every Slave
+    :param index: Index built by Slaves over their shards
+    :param fan_out: Fan-out of the Master
+    :param nprobe: Number of IVF lists probed by approximate search, exact search by default
+    :param pruning: Answer batches in rounds of growing size with k-th distance bounds
+    :param quantization: Scan shards quantized to 'int8' or 'float16', full precision by default
+    :param max_batch_size: Maximum number of queries the Master collects into one micro-batch, 0 disables it
+    :param seed: Seed of the dataset
+    :param quiet: Hide output of the nodes
+    :return: dictionary with the configuration and the measured results
+    """
+    config = {'n': n, 'd': d, 'k': k, 'slaves': slaves, 'classes': classes, 'queries': queries,
+              'batch_size': batch_size, 'pipeline': pipeline, 'workers': workers, 'index': index,
+              'fan_out': fan_out, 'nprobe': nprobe, 'pruning': pruning, 'quantization': quantization,
+              'max_batch_size': max_batch_size, 'seed': seed}
+    train, test = train_test_split(gaussian_blobs(n + queries, d, classes, seed=seed), queries, seed)
+    master_options = {'index_type': index, 'fan_out': fan_out, 'pruning': pruning, 'quantization': quantization,
+                      'max_batch_size': max_batch_size}
+    cluster = LocalCluster(train, slaves, k, master_options, {'workers': workers}, quiet=quiet)
+    with cluster:
+        client = cluster.connect()
+        try:
+            labels, neighbours, latencies, seconds = measure_queries(client, test.points, batch_size, pipeline,
+                                                                     nprobe)
+        finally:
+            client.close()
+    latency_ms = {'p' + str(p): float(np.percentile(latencies, p) * 1000) for p in LATENCY_PERCENTILES}
+    latency_ms['mean'] = float(latencies.mean() * 1000)
+    serving = cluster.serving['phases']['serving']
+    exact = train.ids[ShardEngine(train.points).query(test.points, k)[0]]
+    return {'config': config,
+            'distribution': cluster.distribution,
+            'queries': {'count': queries,
+                        'seconds': seconds,
+                        'queries_per_second': queries / seconds,
+                        'batch_latency_ms': latency_ms,
+                        'accuracy': float(np.mean(np.array(labels, dtype=object) == test.labels)),
+                        'recall': recall(neighbours, exact),
+                        'bytes_sent': serving['bytes_sent'],
+                        'bytes_received': serving['bytes_received'],
+                        'bytes_per_query': (serving['bytes_sent'] + serving['bytes_received']) / queries},
+            'master': cluster.serving}
+
+
+def environment():
+    """
+    Describes the machine and the commit the benchmark runs on, so results of different runs can be compared.
+    :return: dictionary
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count()}
+
+
+def save_results(results, path):
+    """
+    Saves results of benchmark runs together with the environment as JSON.
+    :param results: List of dictionaries returned by run_benchmark
+    :param path: Output file
+    :return: None
+    """
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'runs': results}, f, indent=2)
@@ -0,0 +1,147 @@
+"""
+This module contains non-blocking connections used by the Master's event loop.
+"""
+from collections import deque
+import network_messages as messages
+
+
+class SlaveTimeoutError(TimeoutError):
+    """
+    Raised when a Slave does not make progress within the configured timeout
+    """
+
+
+class Connection(object):
+    """
+    Non-blocking connection with its outgoing queue and incoming frame reader
+    """
+
+    def __init__(self, sock, address):
+        """
+        Constructor for Connection.
+        :param sock: Connected socket
+        :param address: Address of the other side
+        """
+        sock.setblocking(False)
+        messages.set_no_delay(sock)
+        self.socket = sock
+        self.address = address
+        self.reader = messages.FrameReader()
+        self.outgoing = deque()
+        self.events = 0
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+
+    def __str__(self):
+        if isinstance(self.address, tuple):
+            return self.address[0] + ':' + str(self.address[1])
+        return str(self.address) or 'local socket'
+
+    def queue(self, buffers):
+        """
+        Queues encoded frame for sending. Buffers are not copied, so the same frame can be queued for many connections.
+        :param buffers: List of bytes-like objects returned by network_messages.encode_message
+        :return: None
+        """
+        self.messages_sent += 1
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            if view.nbytes:
+                self.outgoing.append(view)
+
+    def send(self, msg_type, fields=None, arrays=None):
+        """
+        Encodes and queues one message.
+        :param msg_type: One of MessageType values
+        :param fields: Dictionary of JSON serializable values
+        :param arrays: Dictionary of NumPy arrays
+        :return: None
+        """
+        self.queue(messages.encode_message(msg_type, fields, arrays))
+
+    def has_outgoing(self):
+        return len(self.outgoing) > 0
+
+    def outgoing_bytes(self):
+        return sum(view.nbytes for view in self.outgoing)
+
+    @property
+    def bytes_received(self):
+        return self.reader.bytes_received
+
+    def traffic(self):
+        return {'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'messages_sent': self.messages_sent, 'messages_received': self.messages_received}
+
+    def flush(self):
+        """
+        Sends as much of the queued data as the socket accepts without blocking.
+        :return: number of bytes sent
+        """
+        sent = 0
+        while self.outgoing:
+            try:
+                n = self.socket.send(self.outgoing[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            sent += n
+            if n < self.outgoing[0].nbytes:
+                self.outgoing[0] = self.outgoing[0][n:]
+                break
+            self.outgoing.popleft()
+        self.bytes_sent += sent
+        return sent
+
+    def read_messages(self):
+        """
+        Reads all messages that are currently available.
+        :return: list of Messages
+        """
+        received = self.reader.read(self.socket)
+        self.messages_received += len(received)
+        return received
+
+    def close(self):
+        self.socket.close()
+
+
+class SlaveConnection(Connection):
+    """
+    Connection to one Slave with the requests it still has to answer
+    """
+
+    def __init__(self, sock, address, index):
+        """
+        Constructor for SlaveConnection.
+        :param sock: Connected socket
+        :param address: Address of the Slave
+        :param index: Index of the Slave in the list of connections
+        """
+        super().__init__(sock, address)
+        self.index = index
+        self.manifest = None
+        self.cores = 1
+        self.workers = 1
+        self.throughput = 1.0
+        self.capacity = 1.0
+        self.memory = None
+        self.compute_per_query = None
+        self.shard_id = None
+        # Send times of the requests the Slave has not answered yet, by request id
+        self.pending = {}
+        # Requests held back while a joining Slave waits for the copy of its shard
+        self.held = None
+        # A joining Slave does not answer queries until it stores the copy of its shard
+        self.syncing = False
+        self.deadline = None
+
+    def is_busy(self):
+        """
+        Checks whether the Master is waiting for this Slave to make progress.
+        :return: True if something has to be sent to or received from the Slave
+        """
+        return bool(self.pending) or self.has_outgoing()
+
+    def __str__(self):
+        return super().__str__() + ' (' + str(self.workers) + ' of ' + str(self.cores) + ' cores)'
@@ -7,7 +7,8 @@ from uuid import uuid5, NAMESPACE_OID
 
 class DataPoint(object):
     """
-    DataPoint data that stores all required data for one data point
+    DataPoint data that stores all required data for one data point. Points of a PointBatch are DataPoint views
+    that share memory with the batch.
     """
 
     def __init__(self, data, label=None, point_id=None):
@@ -15,10 +16,21 @@ class DataPoint(object):
         Constructor for DataPoint data.
         :param data: Array of values for each dimension
         :param label: Label assigned to the point
+        :param point_id: Id of the point, computed from its data and label when it is first needed by default
         """
-        self.data = np.array(data)
+        self.data = np.asarray(data)
         self.label = label
-        self.id = point_id if point_id is not None else uuid5(NAMESPACE_OID, str(self.data) + str(self.label))
+        self._id = point_id
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = uuid5(NAMESPACE_OID, str(self.data) + str(self.label))
+        return self._id
+
+    @id.setter
+    def id(self, point_id):
+        self._id = point_id
 
     def __str__(self) -> str:
         return '(' + str(self.id) + ';[' + ','.join([str(point) for point in self.data]) + '];' \
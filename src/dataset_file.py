@@ -0,0 +1,186 @@
+"""
+Module that reads datasets from files in chunks of rows, so that a dataset larger than the Master's memory can be
+streamed to the Slaves. Supported formats:
+    .csv - comma separated numbers, one point per line, with an optional header line and an optional label column
+    .npy - [n x d] matrix, memory mapped, with an optional label column
+    .npz - 'points' matrix with optional 'labels' and 'ids' arrays
+"""
+import itertools
+import os
+import numpy as np
+from point_batch import PointBatch
+
+DEFAULT_CHUNK_ROWS = 1 << 16
+ASSIGN_ROUND_ROBIN = 'round_robin'
+ASSIGN_HASH = 'hash'
+ASSIGNMENTS = (ASSIGN_ROUND_ROBIN, ASSIGN_HASH)
+FORMATS = ('.csv', '.npy', '.npz')
+# Round-robin assignment with weights cycles through this many rows per unit weight
+ROUND_ROBIN_UNITS = 8
+# Multiplier of Fibonacci hashing, 2^64 divided by the golden ratio
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def encode_label_column(labels):
+    """
+    Encodes an array of labels as integer codes and a lookup table without a Python loop.
+    :param labels: [n] array of labels
+    :return: tuple of (int32 array of codes, list of distinct labels)
+    """
+    table, codes = np.unique(labels, return_inverse=True)
+    return codes.astype(np.int32).reshape(-1), table.tolist()
+
+
+def labelled_chunk(matrix, ids, label_column):
+    """
+    Builds a chunk from rows of a matrix, one column of which may hold the labels.
+    :param matrix: [n x c] array of rows
+    :param ids: [n] array of point ids
+    :param label_column: Index of the label column or None
+    :return: PointBatch
+    """
+    if label_column is None:
+        return PointBatch(np.asarray(matrix, dtype=np.float64), ids)
+    label_column %= matrix.shape[1]
+    features = np.delete(np.arange(matrix.shape[1]), label_column)
+    label_codes, label_table = encode_label_column(np.asarray(matrix[:, label_column]))
+    return PointBatch(np.asarray(matrix[:, features], dtype=np.float64), ids, label_codes, label_table)
+
+
+def is_header(line):
+    try:
+        float(line.split(',')[0])
+    except ValueError:
+        return True
+    return False
+
+
+def read_csv_chunks(path, chunk_rows, label_column):
+    """
+    Reads a CSV file in chunks of lines parsed with NumPy's C parser.
+    :return: generator of PointBatches
+    """
+    with open(path) as f:
+        first = f.readline()
+        lines = f if is_header(first) else itertools.chain([first], f)
+        start = 0
+        while True:
+            chunk = [line for line in itertools.islice(lines, chunk_rows) if line.strip()]
+            if not chunk:
+                return
+            ids = np.arange(start, start + len(chunk), dtype=np.int64)
+            start += len(chunk)
+            columns = chunk[0].count(',') + 1
+            if label_column is None:
+                yield PointBatch(np.loadtxt(chunk, delimiter=',', dtype=np.float64, ndmin=2), ids)
+                continue
+            label = label_column % columns
+            features = [column for column in range(columns) if column != label]
+            points = np.loadtxt(chunk, delimiter=',', dtype=np.float64, usecols=features, ndmin=2)
+            labels = np.char.strip(np.loadtxt(chunk, delimiter=',', dtype=str, usecols=[label], ndmin=1))
+            label_codes, label_table = encode_label_column(labels)
+            yield PointBatch(points, ids, label_codes, label_table)
+
+
+def read_npy_chunks(path, chunk_rows, label_column):
+    """
+    Reads a memory mapped .npy matrix in chunks of rows.
+    :return: generator of PointBatches
+    """
+    matrix = np.load(path, mmap_mode='r')
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(len(matrix), 1)
+    for start in range(0, len(matrix), chunk_rows):
+        rows = matrix[start:start + chunk_rows]
+        yield labelled_chunk(rows, np.arange(start, start + len(rows), dtype=np.int64), label_column)
+
+
+def read_npz_chunks(path, chunk_rows):
+    """
+    Reads the arrays of a .npz archive in chunks of rows. NumPy cannot memory map archives, so every array is loaded
+    whole when it is first used.
+    :return: generator of PointBatches
+    """
+    with np.load(path) as archive:
+        points = archive['points']
+        labels = archive['labels'] if 'labels' in archive.files else None
+        ids = archive['ids'].astype(np.int64) if 'ids' in archive.files else None
+    if points.ndim == 1:
+        points = points.reshape(len(points), 1)
+    for start in range(0, len(points), chunk_rows):
+        end = min(start + chunk_rows, len(points))
+        chunk_ids = ids[start:end] if ids is not None else np.arange(start, end, dtype=np.int64)
+        if labels is None:
+            yield PointBatch(np.asarray(points[start:end], dtype=np.float64), chunk_ids)
+        else:
+            label_codes, label_table = encode_label_column(labels[start:end])
+            yield PointBatch(np.asarray(points[start:end], dtype=np.float64), chunk_ids, label_codes, label_table)
+
+
+class DatasetFile(object):
+    """
+    Dataset stored in a CSV, .npy or .npz file and read in chunks of rows. Points get their row numbers as ids,
+    unless a .npz archive has its own ids.
+    """
+
+    def __init__(self, path, chunk_rows=DEFAULT_CHUNK_ROWS, label_column=-1):
+        """
+        Constructor for DatasetFile.
+        :param path: Path of the file
+        :param chunk_rows: Number of rows read at once
+        :param label_column: Index of the label column of CSV and .npy files, negative indices count from the end,
+                             None if the points are unlabelled
+        """
+        self.path = os.fspath(path)
+        self.format = os.path.splitext(self.path)[1].lower()
+        if self.format not in FORMATS:
+            raise ValueError('Unsupported dataset file ' + self.path + ', expected one of ' + ', '.join(FORMATS))
+        self.chunk_rows = chunk_rows
+        self.label_column = label_column
+
+    def __str__(self):
+        return self.path
+
+    def chunks(self):
+        """
+        Reads the file chunk by chunk.
+        :return: generator of PointBatches, each with its own label table
+        """
+        if self.format == '.csv':
+            return read_csv_chunks(self.path, self.chunk_rows, self.label_column)
+        if self.format == '.npy':
+            return read_npy_chunks(self.path, self.chunk_rows, self.label_column)
+        return read_npz_chunks(self.path, self.chunk_rows)
+
+    def read(self):
+        """
+        Reads the whole file.
+        :return: PointBatch
+        """
+        return PointBatch.concatenate(list(self.chunks()))
+
+
+def assign_rows(ids, rows, parts, assignment=ASSIGN_HASH, weights=None):
+    """
+    Chooses the part every row of a chunk belongs to.
+    :param ids: [n] array of point ids of the chunk
+    :param rows: [n] array of row numbers of the chunk in the file
+    :param parts: Number of parts
+    :param assignment: 'round_robin' by row number or 'hash' of the point id, which spreads sorted files evenly and
+                       keeps every point on the same part however the file is chunked
+    :param weights: Optional weight of every part, parts get rows in proportion to it. Round-robin assignment needs
+                    weights that are multiples of 1/ROUND_ROBIN_UNITS
+    :return: [n] array of part indices
+    """
+    if assignment == ASSIGN_ROUND_ROBIN:
+        if weights is None:
+            return np.asarray(rows, dtype=np.int64) % parts
+        units = np.cumsum(np.maximum(np.round(np.asarray(weights) * ROUND_ROBIN_UNITS), 1).astype(np.int64))
+        return np.searchsorted(units, np.asarray(rows, dtype=np.int64) % units[-1], side='right')
+    hashed = np.asarray(ids).astype(np.uint64) * HASH_MULTIPLIER
+    if weights is None:
+        return ((hashed >> np.uint64(32)) % np.uint64(parts)).astype(np.int64)
+    # The top 53 bits of the hash are a uniform fraction that falls into the part of its weight
+    fractions = (hashed >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+    bounds = np.cumsum(weights, dtype=np.float64)
+    return np.minimum(np.searchsorted(bounds / bounds[-1], fractions, side='right'), parts - 1)
@@ -1,9 +1,19 @@
 """
 Module contains all methods required for kNN classification
 """
+import heapq
+import itertools
 import numpy as np
-from collections import Counter
-import operator
+from collections import Counter, namedtuple
+from point_batch import as_point_batch
+
+# Upper bound (in bytes) for one block of the query x shard distance matrix
+DEFAULT_BLOCK_BYTES = 1 << 26
+# Number of queries processed together against the shard
+QUERY_BLOCK_SIZE = 1024
+
+# Neighbour candidate returned by a slave. Candidates are ordered by distance and then by id.
+Candidate = namedtuple('Candidate', ['distance', 'id', 'label'])
 
 
 def euclidean(p1, p2):
@@ -16,19 +26,241 @@ def euclidean(p1, p2):
     return np.linalg.norm(p1.data - p2.data)
 
 
+def select_k_smallest(distances, indices, k):
+    """
+    Selects k smallest distances in every row, breaking ties by the smaller index.
+    :param distances: [m x c] array of distances
+    :param indices: [m x c] array of indices that correspond to the distances
+    :param k: number of entries to keep in every row
+    :return: tuple of ([m x k] indices, [m x k] distances), not sorted
+    """
+    if distances.shape[1] <= k:
+        return np.array(indices), np.array(distances)
+    part = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    best_i = np.take_along_axis(indices, part, axis=1)
+    best_d = np.take_along_axis(distances, part, axis=1)
+    kth = best_d.max(axis=1)
+    # argpartition is not stable, rows with ties on the k-th distance are resolved by index. Only the columns up to
+    # the k-th distance are sorted, in one lexsort over all such rows
+    within = distances <= kth[:, None]
+    counts = np.count_nonzero(within, axis=1)
+    ties = np.flatnonzero(counts > k)
+    if len(ties):
+        width = int(counts[ties].max())
+        tied_d = np.where(within[ties], distances[ties], np.inf)
+        columns = np.argpartition(tied_d, width - 1, axis=1)[:, :width] if width < tied_d.shape[1] \
+            else np.broadcast_to(np.arange(width), (len(ties), width))
+        tied_d = np.take_along_axis(tied_d, columns, axis=1)
+        tied_i = np.take_along_axis(indices[ties], columns, axis=1)
+        order = np.lexsort((tied_i, tied_d), axis=1)[:, :k]
+        best_i[ties] = np.take_along_axis(tied_i, order, axis=1)
+        best_d[ties] = np.take_along_axis(tied_d, order, axis=1)
+    return best_i, best_d
+
+
+class ShardEngine(object):
+    """
+    Brute-force kNN search over a shard stored as one contiguous matrix with precomputed squared norms. Queries with
+    distance bounds search the shard in blocks of rows with similar norms and skip the blocks whose norms differ from
+    the norm of the query by more than its bound: by the triangle inequality all their points are farther.
+    """
+
+    def __init__(self, matrix, labels=None, dtype=np.float64, block_bytes=DEFAULT_BLOCK_BYTES, norms=None):
+        """
+        Constructor for ShardEngine.
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param labels: Optional sequence of n labels
+        :param dtype: float32 or float64 used for storage and computation
+        :param block_bytes: Upper bound for memory used by one block of distances
+        :param norms: Optional precomputed squared norms of the points
+        """
+        self.matrix = np.ascontiguousarray(matrix, dtype=dtype)
+        if self.matrix.ndim == 1:
+            self.matrix = self.matrix.reshape(len(self.matrix), -1 if len(self.matrix) else 0)
+        self.labels = np.array(labels, dtype=object) if labels is not None else None
+        self.norms = norms if norms is not None else np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.block_bytes = block_bytes
+        self.norm_order = None
+
+    @classmethod
+    def from_points(cls, points, **kwargs):
+        """
+        Builds the engine from a batch or a list of DataPoints.
+        :param points: PointBatch or list of DataPoints
+        :return: ShardEngine
+        """
+        batch = as_point_batch(points)
+        return cls(batch.points, batch.labels, **kwargs)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    def block(self, start, end):
+        """
+        Rows of the shard that are searched together.
+        :param start: First row
+        :param end: Row after the last one
+        :return: [r x d] array of points
+        """
+        return self.matrix[start:end]
+
+    def gather(self, rows):
+        """
+        Rows of the shard that are searched together when they are not contiguous.
+        :param rows: Sorted array of rows
+        :return: [r x d] array of points
+        """
+        return self.matrix[rows]
+
+    def sorted_norms(self):
+        """
+        Orders the rows by their norms, once for all bounded queries.
+        :return: tuple of (array of rows ordered by norm, array of their norms)
+        """
+        if self.norm_order is None:
+            order = np.argsort(self.norms, kind='stable')
+            self.norm_order = order, np.sqrt(np.asarray(self.norms, dtype=np.float64)[order])
+        return self.norm_order
+
+    def block_rows(self, queries, k):
+        """
+        Number of rows searched together, so that the distances of one block of queries fit in block_bytes.
+        :param queries: Number of queries searched together
+        :param k: Number of neighbours, a block is never smaller
+        :return: rows
+        """
+        return max(k, self.block_bytes // (self.dtype.itemsize * queries))
+
+    def query(self, queries, k, bounds=None):
+        """
+        Finds k nearest shard points for every query.
+        :param queries: [m x d] array of query points (or a single [d] point)
+        :param k: number of neighbours to return
+        :param bounds: Optional [m] array of distances, neighbours farther than the bound of their query are not
+                       needed: blocks of rows beyond it are skipped and missing neighbours have infinite distance
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        n, d = self.matrix.shape
+        dtype = self.dtype
+        queries = np.asarray(queries, dtype=dtype)
+        queries = queries.reshape(-1, d) if d else np.atleast_2d(queries)
+        m = len(queries)
+        k = min(k, n)
+        indices = np.empty((m, k), dtype=np.int64)
+        distances = np.empty((m, k), dtype=dtype)
+        if k == 0 or m == 0:
+            return indices, distances
+        rows = self.block_rows(min(m, QUERY_BLOCK_SIZE), k)
+        if bounds is not None:
+            bounds = np.broadcast_to(np.asarray(bounds, dtype=np.float64), (m,))
+        for qs in range(0, m, QUERY_BLOCK_SIZE):
+            q = queries[qs:qs + QUERY_BLOCK_SIZE]
+            q_norms = np.einsum('ij,ij->i', q, q)
+            if bounds is None:
+                best_i, best_d = self.search_blocks(q, q_norms, k, rows)
+            else:
+                best_i, best_d = self.search_by_norm(q, q_norms, k, bounds[qs:qs + len(q)], rows)
+            order = np.lexsort((best_i, best_d))
+            indices[qs:qs + len(q)] = np.take_along_axis(best_i, order, axis=1)
+            distances[qs:qs + len(q)] = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+        return indices, distances
+
+    def search_blocks(self, queries, query_norms, k, rows):
+        """
+        Searches all rows of the shard in contiguous blocks.
+        :param queries: [m x d] array of query points
+        :param query_norms: [m] array of squared norms of the queries
+        :param k: number of neighbours to return
+        :param rows: Number of rows searched together
+        :return: tuple of ([m x k] indices, [m x k] squared distances), not sorted
+        """
+        best_i, best_d = None, None
+        for rs in range(0, len(self.matrix), rows):
+            block = self.block(rs, rs + rows)
+            block_d = queries @ block.T
+            block_d *= -2
+            block_d += query_norms[:, None]
+            block_d += self.norms[None, rs:rs + len(block)]
+            np.maximum(block_d, 0, out=block_d)
+            block_i = np.broadcast_to(np.arange(rs, rs + len(block)), block_d.shape)
+            if best_d is not None:
+                block_d = np.hstack((best_d, block_d))
+                block_i = np.hstack((best_i, block_i))
+            best_i, best_d = select_k_smallest(block_d, block_i, k)
+        return best_i, best_d
+
+    def search_by_norm(self, queries, query_norms, k, bounds, rows):
+        """
+        Searches blocks of rows ordered by norm. A query searches only the blocks with norms within its bound of its
+        own norm, neighbours it does not find are padded with the shard size as index and infinite distance.
+        :param queries: [m x d] array of query points
+        :param query_norms: [m] array of squared norms of the queries
+        :param k: number of neighbours to return
+        :param bounds: [m] array of distance bounds
+        :param rows: Number of rows searched together
+        :return: tuple of ([m x k] indices, [m x k] squared distances), not sorted
+        """
+        order, norms = self.sorted_norms()
+        lengths = np.sqrt(query_norms)
+        first = np.searchsorted(norms, lengths - bounds, side='left')
+        last = np.searchsorted(norms, lengths + bounds, side='right')
+        best_i = np.full((len(queries), k), len(order), dtype=np.int64)
+        best_d = np.full((len(queries), k), np.inf, dtype=self.dtype)
+        for rs in range(0, len(order), rows):
+            active = np.flatnonzero((first < rs + rows) & (last > rs))
+            if not len(active):
+                continue
+            # Rows of the block are read in row order, which keeps reads of memory mapped shards sequential
+            block_r = np.sort(order[rs:rs + rows])
+            block_d = queries[active] @ self.gather(block_r).T
+            block_d *= -2
+            block_d += query_norms[active, None]
+            block_d += self.norms[None, block_r]
+            np.maximum(block_d, 0, out=block_d)
+            block_i = np.broadcast_to(block_r, block_d.shape)
+            new_i, new_d = select_k_smallest(np.hstack((best_d[active], block_d)),
+                                             np.hstack((best_i[active], block_i)), k)
+            best_i[active] = new_i
+            best_d[active] = new_d
+        return best_i, best_d
+
+
 def get_neighbours(dataset, data_point, k):
     """
     Calculate distances from data_point to all points in the dataset.
-    :param dataset: [n x d] numpy array of training samples (n: number of samples, d: number of dimensions).
-    :param data_point: [d x 1] numpy array of test instance features.
+    :param dataset: PointBatch or list of n DataPoints (training samples).
+    :param data_point: DataPoint to find the neighbours for.
     :param k: number of neighbours to return.
-    :return: list of length k with neighbour indices.
+    :return: list of k nearest DataPoints sorted by distance.
+    """
+    indices, _ = ShardEngine.from_points(dataset).query(data_point.data, k)
+    return [dataset[i] for i in indices[0]]
+
+
+def to_candidates(ids, distances, labels):
+    """
+    Converts one row of a slave reply into the list of candidates.
+    :param ids: Neighbour ids sorted by distance
+    :param distances: Neighbour distances
+    :param labels: Neighbour labels
+    :return: list of Candidates
     """
-    distances = {}
-    for i, point in enumerate(dataset):
-        distances[point] = euclidean(point, data_point)
-    neighbours_map = sorted(distances.items(), key=operator.itemgetter(1))[:k]
-    return list(map(lambda p: p[0], neighbours_map))
+    return [Candidate(d, i, label) for d, i, label in zip(np.asarray(distances).tolist(), np.asarray(ids).tolist(),
+                                                          labels)]
+
+
+def merge_candidates(candidate_lists, k):
+    """
+    Streaming k-way merge of sorted candidate lists that keeps exactly k nearest candidates.
+    :param candidate_lists: Lists of Candidates, each one sorted by distance
+    :param k: number of neighbours to keep
+    :return: list of at most k nearest Candidates sorted by distance
+    """
+    return list(itertools.islice(heapq.merge(*candidate_lists), k))
 
 
 def get_majority_vote(points):
@@ -37,7 +269,15 @@ def get_majority_vote(points):
     :param points: the list of DataPoints
     :return: the label of most common data.
     """
-    labels = [point.label for point in points]
+    return get_majority_label([point.label for point in points])
+
+
+def get_majority_label(labels):
+    """
+    Finds the most common label.
+    :param labels: the list of labels
+    :return: the most common label.
+    """
     (most_common, _) = Counter(labels).most_common(1)[0]
     return most_common
 
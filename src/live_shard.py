@@ -0,0 +1,172 @@
+"""
+Module contains the live state of a Slave's shard on a running cluster. Inserted points go to an append buffer that is
+searched by brute force and deleted points are marked with tombstones, so that the shard index does not have to be
+rebuilt for every change. Once the buffer and the tombstones grow beyond a fraction of the shard, the shard is
+compacted and its index is rebuilt, which keeps the cost of updates amortized.
+"""
+import numpy as np
+from knn_classifier import ShardEngine
+from point_batch import PointBatch
+from shard_store import Shard
+
+# Fraction of the shard that may be buffered or deleted before the shard is compacted
+COMPACT_FRACTION = 0.1
+# Number of buffered or deleted points that never triggers compaction on its own
+MIN_COMPACT_ROWS = 1024
+
+
+class LiveShard(object):
+    """
+    Shard with an append buffer of inserted points and tombstones of deleted ones
+    """
+
+    def __init__(self, shard, compact_fraction=COMPACT_FRACTION, min_compact_rows=MIN_COMPACT_ROWS):
+        """
+        Constructor for LiveShard.
+        :param shard: Shard the index is built over
+        :param compact_fraction: Fraction of the shard that may be buffered or deleted before compaction
+        :param min_compact_rows: Number of buffered or deleted points below which the shard is never compacted
+        """
+        self.compact_fraction = compact_fraction
+        self.min_compact_rows = min_compact_rows
+        self.label_table = list(shard.label_table)
+        self.label_codes = {label: code for code, label in enumerate(self.label_table)}
+        self.reset(shard)
+
+    def reset(self, shard):
+        self.shard = shard
+        self.deleted = np.zeros(len(shard), dtype=bool)
+        self.tombstones = 0
+        self.buffer = PointBatch(np.empty((0, shard.points.shape[1])), np.empty(0, dtype=np.int64),
+                                 np.empty(0, dtype=np.int32), self.label_table)
+        self.buffer_engine = None
+
+    def __len__(self):
+        return len(self.shard) - self.tombstones + len(self.buffer)
+
+    @property
+    def max_id(self):
+        ids = [int(np.max(ids)) for ids in (self.shard.ids, self.buffer.ids) if len(ids)]
+        return max(ids) if ids else -1
+
+    def is_modified(self):
+        return self.tombstones > 0 or len(self.buffer) > 0
+
+    def insert(self, batch):
+        """
+        Appends points to the buffer, mapping their label codes to the shard's label table.
+        :param batch: PointBatch of new points
+        :return: None
+        """
+        lookup = np.array([self.label_codes.setdefault(label, len(self.label_codes)) for label in batch.label_table],
+                          dtype=np.int32)
+        self.label_table[len(self.label_table):] = list(self.label_codes)[len(self.label_table):]
+        self.buffer = PointBatch(np.concatenate([self.buffer.points, batch.points]),
+                                 np.concatenate([self.buffer.ids, batch.ids]),
+                                 np.concatenate([self.buffer.label_codes, lookup[np.asarray(batch.label_codes)]]),
+                                 self.label_table)
+        self.buffer_engine = None
+
+    def delete(self, ids):
+        """
+        Deletes points by id: buffered points are dropped and shard points get tombstones.
+        :param ids: Array of point ids
+        :return: number of deleted points
+        """
+        hits = np.isin(self.shard.ids, ids) & ~self.deleted
+        self.deleted |= hits
+        removed = int(np.count_nonzero(hits))
+        self.tombstones += removed
+        buffered = np.isin(self.buffer.ids, ids)
+        if buffered.any():
+            self.buffer = self.buffer.take(np.flatnonzero(~buffered))
+            self.buffer_engine = None
+            removed += int(np.count_nonzero(buffered))
+        return removed
+
+    def extract(self, count):
+        """
+        Removes points from the shard so that they can be moved to another Slave, newest points first.
+        :param count: Number of points to remove
+        :return: PointBatch of the removed points
+        """
+        count = min(count, len(self))
+        from_buffer = min(count, len(self.buffer))
+        moved = [self.buffer[len(self.buffer) - from_buffer:]]
+        self.buffer = self.buffer[:len(self.buffer) - from_buffer]
+        self.buffer_engine = None
+        rows = np.flatnonzero(~self.deleted)[len(self.shard) - self.tombstones - (count - from_buffer):]
+        self.deleted[rows] = True
+        self.tombstones += len(rows)
+        moved.append(PointBatch(self.shard.points[rows], self.shard.ids[rows], self.shard.label_codes[rows],
+                                self.label_table))
+        return PointBatch.concatenate(moved)
+
+    def snapshot(self):
+        """
+        Copies the live points: the shard points without tombstones followed by the buffer.
+        :return: PointBatch
+        """
+        live = np.flatnonzero(~self.deleted)
+        return PointBatch(np.concatenate([self.shard.points[live], self.buffer.points]),
+                          np.concatenate([self.shard.ids[live], self.buffer.ids]),
+                          np.concatenate([np.asarray(self.shard.label_codes)[live], self.buffer.label_codes]),
+                          self.label_table)
+
+    def needs_compaction(self):
+        changed = self.tombstones + len(self.buffer)
+        return changed > max(self.min_compact_rows, self.compact_fraction * len(self.shard))
+
+    def compact(self):
+        """
+        Builds a new shard of the live points: the shard points without tombstones followed by the buffer.
+        :return: Shard
+        """
+        live = self.snapshot()
+        shard = Shard(live.points, live.ids, live.label_codes, self.label_table,
+                      np.einsum('ij,ij->i', live.points, live.points))
+        self.reset(shard)
+        return shard
+
+    def query(self, engine, queries, k, **options):
+        """
+        Finds k nearest live points for every query: the shard index is asked for more neighbours than k when some
+        of them may be deleted, and the buffer is searched by brute force.
+        :param engine: Index over the shard
+        :param queries: [m x d] array of query points
+        :param k: Number of neighbours
+        :param options: Options of the index query
+        :return: tuple of ([m x c] ids, [m x c] distances, [m x c] label codes) sorted by distance, entries that were
+                 not found have infinite distance
+        """
+        indices, distances = engine.query(queries, k + min(self.tombstones, k), **options)
+        # Indexes pad missing neighbours with the shard size as index
+        if not self.is_modified():
+            indices = np.minimum(indices, len(self.shard) - 1)
+            return self.shard.ids[indices], distances, np.asarray(self.shard.label_codes)[indices]
+        distances = np.where(self.deleted[np.minimum(indices, len(self.shard) - 1)], np.inf, distances)
+        live = np.count_nonzero(np.isfinite(distances), axis=1)
+        # Rows that lost neighbours to tombstones but may have more of them are searched again with a deeper k
+        searched = distances.shape[1]
+        again = np.flatnonzero((live < k) & np.isfinite(distances[:, searched - 1]) & (searched < len(self.shard))
+                               if searched else [])
+        if len(again):
+            deeper = {name: value[again] if np.ndim(value) else value for name, value in options.items()}
+            more_i, more_d = engine.query(queries[again], k + self.tombstones, **deeper)
+            more_d = np.where(self.deleted[np.minimum(more_i, len(self.shard) - 1)], np.inf, more_d)
+            order = np.argsort(more_d, axis=1, kind='stable')[:, :searched]
+            indices[again] = np.take_along_axis(more_i, order, axis=1)
+            distances[again] = np.take_along_axis(more_d, order, axis=1)
+        indices = np.minimum(indices, len(self.shard) - 1)
+        ids = self.shard.ids[indices]
+        codes = np.asarray(self.shard.label_codes)[indices]
+        if len(self.buffer):
+            if self.buffer_engine is None:
+                self.buffer_engine = ShardEngine(self.buffer.points)
+            buffer_i, buffer_d = self.buffer_engine.query(queries, k)
+            ids = np.hstack((ids, self.buffer.ids[buffer_i]))
+            distances = np.hstack((distances, buffer_d))
+            codes = np.hstack((codes, self.buffer.label_codes[buffer_i]))
+        order = np.lexsort((ids, distances))[:, :k]
+        return (np.take_along_axis(ids, order, axis=1), np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(codes, order, axis=1))
@@ -1,53 +1,323 @@
 """
 This module contains everything needed for master node.
 """
+import heapq
+import itertools
+import logging
+import math
+import os
+import queue
+import selectors
 import socket
-import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
 import network_messages as messages
-from data_point import DataPoint, parse_data_point
-from knn_classifier import get_majority_vote
+from network_messages import MessageType
+from data_point import DataPoint
+from point_batch import PointBatch, as_point_batch, as_query_matrix, encode_labels, weighted_split_sizes
+from connection import Connection, SlaveConnection, SlaveTimeoutError
+from query_batch import QueryBatch
+from query_cache import DEFAULT_CACHE_BYTES, QueryCache
+from dataset_file import ASSIGN_HASH, ASSIGNMENTS, DEFAULT_CHUNK_ROWS, DatasetFile, assign_rows
+from metrics import SIZE_BUCKETS, Metrics, measure_phase
+from spatial_index import INDEX_AUTO, INDEX_TYPES
+from quantization import QUANTIZATIONS
+import shard_store
 import argparse
 
+FAN_OUT_EXACT = 'exact'
+FAN_OUT_ADAPTIVE = 'adaptive'
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MAX_IN_FLIGHT = 4
+# Seconds the first queries of a micro-batch wait for more queries
+DEFAULT_MAX_BATCH_WAIT = 0.002
+# Number of chunks of a streamed dataset that may wait in the outgoing queues before reading continues
+STREAM_WINDOW_CHUNKS = 2
+SIZING_EQUAL = 'equal'
+SIZING_CAPACITY = 'capacity'
+SIZINGS = (SIZING_EQUAL, SIZING_CAPACITY)
+# Measured throughputs are noisy, Slaves whose throughput per core is within this fraction of the fastest Slave's
+# count as equally fast
+THROUGHPUT_TOLERANCE = 0.15
+# Fraction of a Slave's physical memory its shard may take
+MEMORY_FRACTION = 0.5
+# Weight of the latest reply in the moving average of a Slave's compute time per query
+COMPUTE_SMOOTHING = 0.2
+# A Slave is a straggler if its compute time per query stays this many times above the fastest Slave's
+STRAGGLER_RATIO = 1.5
+# Number of consecutive batches with a straggler after which rows are moved away from it
+STRAGGLER_BATCHES = 8
+# Percentile of recent query round trips after which a query is also sent to another replica of the shard
+DEFAULT_HEDGE_PERCENTILE = 95.0
+# Number of recent query round trips the hedging deadline is computed from
+HEDGE_WINDOW = 256
+# Number of query round trips needed before queries are hedged
+HEDGE_MIN_SAMPLES = 16
+
+logger = logging.getLogger(__name__)
+
+# Selector keys that are not connections
+FRONTEND = 'frontend'
+WAKEUP = 'wakeup'
+JOIN = 'join'
+
+
+def adaptive_request_size(k, num_slaves):
+    """
+    Number of candidates requested from every slave in adaptive fan-out. Since the dataset is shuffled, the number of
+    global k nearest points held by one slave is binomial with mean k/n, so two standard deviations are added to it.
+    :param k: Number of neighbours
+    :param num_slaves: Number of slave nodes
+    :return: request size
+    """
+    mean = k / num_slaves
+    deviation = math.sqrt(mean * (1 - 1 / num_slaves))
+    return min(k, int(math.ceil(mean + 2 * deviation)) + 1)
+
+
+def as_dataset(dataset):
+    """
+    Converts a dataset to a PointBatch, or to a DatasetFile if it is a file.
+    :param dataset: PointBatch, list of DataPoints, DatasetFile or path of a dataset file
+    :return: PointBatch or DatasetFile
+    """
+    if isinstance(dataset, (str, os.PathLike)):
+        return DatasetFile(dataset)
+    return dataset if isinstance(dataset, DatasetFile) else as_point_batch(dataset)
+
+
+def capacity_weights(throughputs, cores, tolerance=THROUGHPUT_TOLERANCE):
+    """
+    Relative capacities of slaves: throughput per core times the number of cores they search with. Only the measured
+    throughput is noisy, throughputs within the tolerance of the fastest slave count as equal to it and the others
+    are rounded to eighths, so that small differences do not change the shard sizes. Core counts are used exactly.
+    :param throughputs: Measured throughput per core of every slave
+    :param cores: Number of cores every slave searches with
+    :param tolerance: Relative throughput difference that is ignored
+    :return: list of weights, 1 for the largest capacity
+    """
+    relative = np.asarray(throughputs, dtype=np.float64) / max(throughputs)
+    relative = np.where(relative >= 1 - tolerance, 1.0, np.maximum(np.round(relative * 8), 1) / 8)
+    capacities = relative * np.asarray(cores, dtype=np.float64)
+    return (capacities / capacities.max()).tolist()
+
+
+def capacity_sizes(total, weights, limits=None):
+    """
+    Shard sizes proportional to the weights of the slaves. Slaves whose share does not fit into their limit get the
+    limit and the rest is split between the others.
+    :param total: Number of points
+    :param weights: Weight of every slave
+    :param limits: Optional maximum shard size of every slave
+    :return: list of shard sizes
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    limits = np.full(len(weights), np.inf) if limits is None else np.asarray(limits, dtype=np.float64)
+    sizes = np.zeros(len(weights), dtype=np.int64)
+    free = np.ones(len(weights), dtype=bool)
+    while True:
+        sizes[free] = weighted_split_sizes(total - int(sizes[~free].sum()), weights[free])
+        over = free & (sizes > limits)
+        if not over.any() or over.sum() == free.sum():
+            return sizes.tolist()
+        sizes[over] = limits[over]
+        free &= ~over
+
+
+def fill_counts(sizes, count, weights=None):
+    """
+    Splits new points between slaves so that the shards smallest for their weight are filled first and shard sizes
+    end up as close to proportional as possible.
+    :param sizes: Current shard sizes
+    :param count: Number of new points
+    :param weights: Optional weight of every slave
+    :return: list with the number of new points for every slave
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    weights = np.ones(len(sizes)) if weights is None else np.asarray(weights, dtype=np.float64)
+    ratios = sizes / weights
+    order = np.argsort(ratios, kind='stable')
+    filled = 1
+    while filled < len(order) and (count + sizes[order[:filled]].sum()) / weights[order[:filled]].sum() \
+            > ratios[order[filled]]:
+        filled += 1
+    chosen = order[:filled]
+    counts = np.zeros(len(sizes), dtype=np.int64)
+    counts[chosen] = np.subtract(weighted_split_sizes(int(count + sizes[chosen].sum()), weights[chosen]),
+                                 sizes[chosen])
+    return counts.tolist()
+
+
+def balanced_sizes(sizes, weights=None):
+    """
+    Target shard sizes proportional to the weights, which differ by at most one point for equal weights. Remaining
+    points go to larger shards, so that the fewest points have to move.
+    :param sizes: Current shard sizes
+    :param weights: Optional weight of every slave
+    :return: list of target sizes
+    """
+    return weighted_split_sizes(int(sum(sizes)), weights if weights is not None else np.ones(len(sizes)), sizes)
+
+
+class PendingRequest(object):
+    """
+    Request sent to one or more Slaves that waits for their replies. A request sent to shards waits for one reply
+    from any replica of every shard and keeps its frames, so that it can be sent again to another replica.
+    """
+
+    def __init__(self, on_reply, on_complete, waiting, frames=None):
+        """
+        Constructor for PendingRequest.
+        :param on_reply: Callback called with (slave, message) for every reply
+        :param on_complete: Callback called without arguments after the last reply
+        :param waiting: Slaves that have to reply, or shard ids of a request sent to shards
+        :param frames: Dictionary of shard id -> encoded frame of a request sent to shards, None otherwise
+        """
+        self.on_reply = on_reply
+        self.on_complete = on_complete
+        self.waiting = set(waiting)
+        self.frames = frames
+
+    def key(self, slave):
+        return slave.shard_id if self.frames is not None else slave
+
 
 class MasterNode(object):
     """
     Master node class
     """
 
-    def __init__(self, dataset=None, points=None, k=5, host='localhost', port=1223):
+    def __init__(self, dataset=None, points=None, k=5, host='localhost', port=1223, fan_out=FAN_OUT_EXACT,
+                 timeout=DEFAULT_TIMEOUT, serve_address=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 index_type=INDEX_AUTO, shard_directory=None, shuffle_seed=0, nprobe=None, pruning=False,
+                 assignment=ASSIGN_HASH, sizing=SIZING_CAPACITY, replication=1,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE, cache_size=0, cache_bytes=DEFAULT_CACHE_BYTES,
+                 cache_precision=None, quantization=None, max_batch_size=0, max_batch_wait=DEFAULT_MAX_BATCH_WAIT):
         """
         Constructor for Master Node class.
-        :param dataset: The whole dataset of points
-        :param points:  List of points to classify
+        :param dataset: The whole dataset of points, a PointBatch, a list of DataPoints, or a DatasetFile or the path
+                        of a CSV, .npy or .npz file that is streamed to the slaves in chunks
+        :param points: Points to classify, a PointBatch or a list of DataPoints
+        :param k: Number of neighbours
         :param host: Host name at which Master node will be located
         :param port: Port number at which Master node will be located
+        :param fan_out: Number of candidates requested from every slave: 'exact' (k), 'adaptive' or a number
+        :param timeout: Seconds a slave may stay silent while the Master waits for it (None waits forever)
+        :param serve_address: If set, the Master keeps serving query batches at this front end address
+                              ('host:port' or 'unix:/path') until it receives a shutdown command
+        :param max_in_flight: Maximum number of query batches sent to slaves and not answered yet
+        :param index_type: Index built by slaves over their shards, one of spatial_index.INDEX_TYPES
+        :param shard_directory: If set, every shard is also written to this directory in the on-disk shard format
+        :param shuffle_seed: Seed of the dataset shuffle, so that shards stay the same between runs and slaves
+                             that already store their shard do not have to receive it again
+        :param nprobe: Default for query batches: if set, Slaves search approximately, probing this many nearest
+                       IVF lists for every query, otherwise they search exactly
+        :param pruning: Query batches are answered in rounds of growing size (one Slave, one more, two more, four
+                        more...), and every round gets the k-th distance bound of every query, so that Slaves skip
+                        parts of their shards that cannot beat it and return only candidates within it. Every Slave
+                        is asked for k candidates
+        :param assignment: How rows of a streamed dataset are assigned to slaves: 'round_robin' or 'hash' of the id
+        :param sizing: 'equal' shards or shards sized by the 'capacity' slaves report in the handshake. With capacity
+                       sizing, rows are also moved away from slaves whose compute time per query stays well above
+                       that of the others
+        :param replication: Number of Slaves that store every shard. Queries go to one replica of every shard, other
+                            replicas take over when it fails
+        :param hedge_percentile: A query not answered within this percentile of recent round trips is also sent to
+                                 another replica of the shard and the first answer is used, None disables hedging
+        :param cache_size: Maximum number of query results cached by the Master, 0 disables the cache. Inserting or
+                           deleting points empties it
+        :param cache_bytes: Maximum memory taken by cached query results
+        :param cache_precision: If set, query coordinates are rounded to multiples of it before they are looked up in
+                                the cache, so that near-duplicate queries share their result
+        :param quantization: If set, Slaves scan their shards quantized to 'int8' or 'float16' and re-rank the
+                             candidates with the full-precision points, which stay memory mapped if Slaves store
+                             their shards on disk
+        :param max_batch_size: If set, queries submitted with the same k and nprobe are collected into micro-batches
+                               of up to this many queries, which are sent to the Slaves as one batch. 0 disables it
+        :param max_batch_wait: Maximum number of seconds queries wait in a micro-batch for more queries
         """
-        print('k =', k)
-        print('host =', host)
-        print('port =', port)
-        self.data = dataset
-        self.points = points
+        logger.info('k = %s, host = %s, port = %s', k, host, port)
+        self.data = None
+        self.points = None
+        if dataset is not None:
+            self.data = as_dataset(dataset)
+        if points is not None:
+            self.load_points_to_classify(points)
         self.k = k
+        self.fan_out = fan_out
+        self.timeout = timeout
+        self.serve_address = serve_address
+        self.max_in_flight = max_in_flight
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.micro_batches = {}
+        self.index_type = index_type
+        self.quantization = quantization
+        self.shard_directory = shard_directory
+        self.shuffle_seed = shuffle_seed
+        self.nprobe = nprobe
+        self.pruning = pruning
+        self.assignment = assignment
+        self.sizing = sizing
+        self.rebalances = []
+        self.rebalancing = False
+        # Inserts and deletes that wait until the points of a rebalance or drain arrive at their new shards
+        self.updates = []
+        self.imbalanced_batches = 0
+        self.replication = replication
+        self.hedge_percentile = hedge_percentile
+        self.round_trips = deque(maxlen=HEDGE_WINDOW)
+        self.cache = QueryCache(cache_size, cache_bytes, cache_precision) if cache_size else None
+        self.dataset_version = 0
+        self.seed_shards = itertools.count()
+        self.neighbours = None
         self.socket = socket.socket()
         self.socket.bind((host, port))
+        self.selector = selectors.DefaultSelector()
         self.connections = []
+        self.replicas = []
+        self.shard_sizes = []
+        self.dimensions = None
+        self.next_id = 0
+        self.requests = {}
+        self.request_ids = itertools.count(1)
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.in_flight = set()
+        self.backlog = []
+        self.frontend = None
+        self.clients = []
+        # Connections of Slaves that joined while serving and have not greeted the Master yet
+        self.joining = []
+        self.submissions = queue.Queue()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, WAKEUP)
+        self.loop_thread = None
+        self.shutdown_requested = False
+        self.metrics = Metrics()
+        self.closed_traffic = dict.fromkeys(('bytes_sent', 'bytes_received', 'messages_sent', 'messages_received'), 0)
 
     def load_data(self, data):
         """
-        Loads the dataset on Master node.
-        :param data: Dataset to be stored
+        Loads the dataset on Master node and shuffles it. Dataset files are only opened, their rows are spread over
+        the slaves while they are streamed.
+        :param data: Dataset to be stored, a PointBatch, a list of DataPoints, a DatasetFile or a file path
         :return: None
         """
-        random.shuffle(data)
-        self.data = data
+        data = as_dataset(data)
+        self.data = data if isinstance(data, DatasetFile) else data.shuffle(self.shuffle_seed)
 
     def load_points_to_classify(self, points):
         """
         Loads the points that need to be classified.
-        :param points: List of points for classification
+        :param points: Points for classification, a PointBatch or a list of DataPoints
         :return: None
         """
-        self.points = points
+        self.points = as_point_batch(points)
 
     def run(self, num_connections: int, dataset=None, points=None):
         """
@@ -59,26 +329,26 @@ class MasterNode(object):
         :return: None
         """
         self.start_connection_phase(num_connections)
-        if self.data is None:
-            if dataset is not None:
-                self.load_data(dataset)
-            else:
-                print('No data provided! Shutting down...')
-                self.start_shutdown_phase()
-                return
-        else:
-            random.shuffle(self.data)
+        if self.data is None and dataset is None:
+            logger.warning('No data provided! Shutting down...')
+            self.start_shutdown_phase()
+            return
+        self.load_data(self.data if self.data is not None else dataset)
         self.start_data_distribution_phase()
         if self.points is None:
             if points is not None:
                 self.load_points_to_classify(points)
-            else:
-                print('No classification points provided! Shutting down...')
+            elif self.serve_address is None:
+                logger.warning('No classification points provided! Shutting down...')
                 self.start_shutdown_phase()
                 return
-        self.start_classification_phase()
+        if self.points is not None:
+            self.start_classification_phase()
+        if self.serve_address is not None:
+            self.start_serving_phase(self.serve_address)
         self.start_shutdown_phase()
 
+    @measure_phase('connection')
     def start_connection_phase(self, num_connections: int):
         """
         Starts Connection phase where all connections are established.
@@ -86,109 +356,1565 @@ class MasterNode(object):
         :return: None
         """
         self.socket.listen(num_connections)
-        print('CONNECTION PHASE')
+        logger.info('CONNECTION PHASE')
         while len(self.connections) < num_connections:
-            connection, address = self.socket.accept()
-            data = connection.recv(1024)
-            if data and data == messages.ClientMessages.GREET_SERVER:
-                self.connections.append((connection, address))
-                connection.send(messages.ServerMessages.GREET_CLIENT)
-        print('Established connections:')
-        for connection in self.connections:
-            print('\t', connection[1][0] + ':' + str(connection[1][1]))
-        print('CONNECTION PHASE IS FINISHED')
+            self.greet_slave(*self.socket.accept())
+        logger.info('Established connections:')
+        for slave in self.connections:
+            logger.info('\t %s', slave)
+        logger.info('CONNECTION PHASE IS FINISHED')
 
+    def greet_slave(self, connection, address):
+        """
+        Runs the handshake with a connecting Slave and adds it to the connections.
+        :param connection: Accepted socket
+        :param address: Address of the Slave
+        :return: SlaveConnection or None if the handshake failed
+        """
+        connection.settimeout(self.timeout)
+        try:
+            message = messages.recv_message(connection)
+        except (OSError, messages.ProtocolError):
+            connection.close()
+            return None
+        if message.type != MessageType.GREET_SERVER:
+            connection.close()
+            return None
+        messages.send_message(connection, MessageType.GREET_CLIENT)
+        return self.add_slave(connection, address, message)
+
+    def add_slave(self, connection, address, message):
+        """
+        Adds a Slave that greeted the Master to the connections.
+        :param connection: Socket of the Slave
+        :param address: Address of the Slave
+        :param message: GREET_SERVER message
+        :return: SlaveConnection
+        """
+        slave = SlaveConnection(connection, address, len(self.connections))
+        slave.manifest = message.fields.get('shard')
+        slave.cores = message.fields.get('cores') or 1
+        slave.workers = message.fields.get('workers') or 1
+        slave.memory = message.fields.get('memory')
+        slave.throughput = message.fields.get('throughput') or 1.0
+        slave.capacity = slave.throughput * min(slave.workers, slave.cores)
+        self.metrics.slave(str(slave)).capacity = slave.capacity
+        self.register(slave)
+        self.connections.append(slave)
+        return slave
+
+    def accept_slave(self):
+        """
+        Accepts a connection of a Slave that joins the cluster while the Master is serving. The handshake is finished
+        by the event loop when the greeting arrives, so a connection that never greets does not stall serving. It is
+        closed after the timeout.
+        :return: None
+        """
+        sock, address = self.socket.accept()
+        joining = Connection(sock, address)
+        self.register(joining)
+        self.joining.append(joining)
+        if self.timeout is not None:
+            self.call_later(self.timeout, lambda: self.drop_joining(joining, 'did not greet the Master'))
+
+    def drop_joining(self, joining, reason):
+        if joining in self.joining:
+            logger.warning('Connection %s %s', joining, reason)
+            self.joining.remove(joining)
+            self.unregister(joining)
+
+    def handle_joining(self, joining):
+        """
+        Reads the greeting of a joining Slave and adds it to the cluster.
+        :param joining: Connection of the joining Slave
+        :return: None
+        """
+        try:
+            received = joining.read_messages()
+        except (ConnectionError, messages.ProtocolError) as error:
+            self.drop_joining(joining, 'failed the handshake: ' + str(error))
+            return
+        if not received:
+            return
+        if received[0].type != MessageType.GREET_SERVER or len(received) > 1:
+            self.drop_joining(joining, 'sent ' + str(received[0].type) + ' instead of a greeting')
+            return
+        self.joining.remove(joining)
+        self.selector.unregister(joining.socket)
+        slave = self.add_slave(joining.socket, joining.address, received[0])
+        slave.send(MessageType.GREET_CLIENT)
+        self.join_slave(slave)
+
+    def join_slave(self, slave):
+        """
+        Adds a Slave that greeted the Master while it is serving. It becomes a replica of the shard with the fewest
+        replicas if that shard has fewer than the replication factor, otherwise it gets a new empty shard, which is
+        filled by inserts and rebalancing.
+        :param slave: SlaveConnection
+        :return: None
+        """
+        if self.replicas:
+            shard_id = min(range(len(self.replicas)), key=lambda s: len(self.replicas[s]))
+            if len(self.replicas[shard_id]) < self.replication:
+                self.copy_shard(slave, shard_id)
+                return
+        logger.info('Slave %s joined the cluster', slave)
+        slave.shard_id = len(self.replicas)
+        self.replicas.append([slave])
+        self.shard_sizes.append(0)
+        empty = PointBatch(np.empty((0, self.dimensions)))
+        self.send_request({slave: (dict(self.index_fields(), shard_id=slave.shard_id, label_table=empty.label_table),
+                                   {'points': empty.points, 'ids': empty.ids, 'label_codes': empty.label_codes})},
+                          MessageType.DATA_BATCH, self.receive_shard_size)
+
+    def index_fields(self):
+        """
+        Fields of DATA_BATCH messages that tell a Slave which indexes to build over its shard. With a default nprobe
+        the IVF index for approximate queries is built together with the shard index, before the first query.
+        :return: dictionary
+        """
+        return {'index': self.index_type, 'quantization': self.quantization, 'approximate': self.nprobe is not None}
+
+    def copy_shard(self, slave, shard_id):
+        """
+        Makes a joining Slave another replica of a shard: a live replica sends a copy of its points and updates of
+        the shard sent in the meantime are held back and sent to the new replica after the copy.
+        :param slave: SlaveConnection of the joining Slave
+        :param shard_id: Shard to copy
+        :return: None
+        """
+        logger.info('Slave %s joined the cluster as a replica of shard %s', slave, shard_id)
+        slave.shard_id = shard_id
+        slave.syncing = True
+        slave.held = []
+        self.replicas[shard_id].append(slave)
+
+        def on_reply(source, message):
+            self.expect_type(source, message, MessageType.DATA_CHUNK)
+            if slave not in self.connections:
+                return
+            if 'error' in message.fields:
+                self.fail_slave(slave, ValueError('Slave ' + str(source) + ' could not copy shard ' + str(shard_id)
+                                                  + ': ' + message.fields['error']))
+                return
+            fields = dict(self.index_fields(), shard_id=shard_id, label_table=message.fields['label_table'])
+            arrays = {name: message.arrays[name] for name in ('points', 'ids', 'label_codes')}
+            held, slave.held = slave.held, None
+            self.send_request({slave: (fields, arrays)}, MessageType.DATA_BATCH,
+                              lambda replica, reply: self.expect_type(replica, reply, MessageType.DATA_RECEIVED),
+                              on_synced)
+            for request_id, frame in held:
+                self.queue_frame(slave, request_id, frame)
+
+        def on_synced():
+            slave.syncing = False
+            self.metrics.increment('copied_shards')
+
+        self.send_to_shards({shard_id: ({'count': 0, 'copy': True}, {})}, MessageType.EXTRACT_POINTS, on_reply)
+
+    def register(self, connection):
+        connection.events = selectors.EVENT_READ
+        self.selector.register(connection.socket, connection.events, connection)
+
+    def unregister(self, connection):
+        self.selector.unregister(connection.socket)
+        connection.close()
+        for key, value in connection.traffic().items():
+            self.closed_traffic[key] += value
+
+    def traffic(self):
+        """
+        Totals of bytes and messages sent to and received from all Slaves and front end clients.
+        :return: dictionary
+        """
+        totals = dict(self.closed_traffic)
+        for connection in itertools.chain(self.connections, self.clients):
+            if connection.socket.fileno() != -1:
+                for key, value in connection.traffic().items():
+                    totals[key] += value
+        return totals
+
+    def stats(self):
+        """
+        Statistics of the Master: phases, per-slave round trip and compute times, query latencies and counters.
+        :return: dictionary
+        """
+        stats = self.metrics.to_dict()
+        if self.cache is not None:
+            stats['cache'] = self.cache.to_dict()
+        return stats
+
+    def send_request(self, slaves_frames, msg_type, on_reply, on_complete=None):
+        """
+        Sends a request to slaves. All slaves share one request id and each one is expected to reply once. Slaves
+        that wait for the copy of their shard get the request after the copy and are not waited for.
+        :param slaves_frames: Dictionary of slave -> (fields, arrays) of its message
+        :param msg_type: One of MessageType values
+        :param on_reply: Callback called with (slave, message) for every reply
+        :param on_complete: Callback called after the last reply
+        :return: request id
+        """
+        request_id = next(self.request_ids)
+        encoded = self.encode_frames(slaves_frames, msg_type, request_id)
+        request = PendingRequest(on_reply, on_complete, [slave for slave in slaves_frames if slave.held is None])
+        self.requests[request_id] = request
+        for slave, frame in encoded.items():
+            if slave.held is not None:
+                slave.held.append((request_id, frame))
+            else:
+                self.queue_frame(slave, request_id, frame)
+        if not request.waiting:
+            self.complete(request_id)
+        return request_id
+
+    def send_to_shards(self, shards_frames, msg_type, on_reply, on_complete=None):
+        """
+        Sends a request to one replica of every shard: the one with the fewest unanswered requests. If it does not
+        answer within the hedging deadline, the request is also sent to another replica and the first answer is
+        used. If it fails, another replica takes over.
+        :param shards_frames: Dictionary of shard id -> (fields, arrays) of its message
+        :param msg_type: One of MessageType values
+        :param on_reply: Callback called with (slave, message) for the first reply of every shard
+        :param on_complete: Callback called after every shard replied
+        :return: request id
+        """
+        request_id = next(self.request_ids)
+        frames = self.encode_frames(shards_frames, msg_type, request_id)
+        self.requests[request_id] = PendingRequest(on_reply, on_complete, frames, frames)
+        for shard_id in frames:
+            if not self.send_to_replica(request_id, shard_id):
+                raise ConnectionError('No live replica of shard ' + str(shard_id))
+        if not frames:
+            self.complete(request_id)
+            return request_id
+        deadline = self.hedge_deadline()
+        if deadline is not None and any(len(self.replicas[shard_id]) > 1 for shard_id in frames):
+            self.call_later(deadline, lambda: self.hedge(request_id))
+        return request_id
+
+    @staticmethod
+    def encode_frames(frames, msg_type, request_id):
+        """
+        Encodes the messages of a request, every distinct pair of fields and arrays only once.
+        :param frames: Dictionary of key -> (fields, arrays)
+        :param msg_type: One of MessageType values
+        :param request_id: Request id added to the fields
+        :return: Dictionary of key -> encoded frame
+        """
+        encoded = {}
+        by_content = {}
+        for key, (fields, arrays) in frames.items():
+            content = (id(fields), id(arrays))
+            if content not in by_content:
+                by_content[content] = messages.encode_message(msg_type, dict(fields, request_id=request_id), arrays)
+            encoded[key] = by_content[content]
+        return encoded
+
+    def queue_frame(self, slave, request_id, frame):
+        if not slave.is_busy():
+            self.touch(slave)
+        slave.queue(frame)
+        slave.pending[request_id] = time.perf_counter()
+
+    def send_to_replica(self, request_id, shard_id):
+        """
+        Sends a request to the least busy replica of a shard that stores the shard and does not have it yet.
+        :param request_id: Id of a request sent to shards
+        :param shard_id: Shard id
+        :return: True if a replica was found
+        """
+        replicas = [slave for slave in self.replicas[shard_id] if not slave.syncing and request_id not in slave.pending]
+        if not replicas:
+            return False
+        replica = min(replicas, key=lambda slave: (len(slave.pending), slave.messages_sent))
+        self.queue_frame(replica, request_id, self.requests[request_id].frames[shard_id])
+        return True
+
+    def hedge_deadline(self):
+        """
+        Seconds after which a query request is hedged: the hedge percentile of recent query round trips.
+        :return: number of seconds or None if queries are not hedged
+        """
+        if self.hedge_percentile is None or len(self.round_trips) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(self.round_trips, self.hedge_percentile))
+
+    def hedge(self, request_id):
+        """
+        Sends a request to another replica of every shard that did not answer it yet.
+        :param request_id: Id of a request sent to shards
+        :return: None
+        """
+        request = self.requests.get(request_id)
+        if request is None:
+            return
+        for shard_id in list(request.waiting):
+            if self.send_to_replica(request_id, shard_id):
+                self.metrics.increment('hedged_requests')
+
+    def call_later(self, delay, callback):
+        """
+        Calls a function from the event loop after a delay.
+        :param delay: Number of seconds
+        :param callback: Function without arguments
+        :return: None
+        """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_ids), callback))
+
+    def complete(self, request_id):
+        request = self.requests.pop(request_id)
+        if request.on_complete is not None:
+            request.on_complete()
+
+    def fail_slave(self, slave, error):
+        """
+        Removes a Slave that failed or stopped responding. Requests sent to its shard go to another replica and
+        requests sent to all Slaves stop waiting for it.
+        :param slave: SlaveConnection
+        :param error: Exception raised if the failed Slave held the last replica of its shard
+        :return: None
+        """
+        logger.warning('%s, removing it from the cluster', error)
+        self.remove_slave(slave)
+        self.metrics.increment('failed_slaves')
+        if slave.shard_id is None or all(replica.syncing for replica in self.replicas[slave.shard_id]):
+            raise error
+        self.reroute_pending(slave)
+
+    def remove_slave(self, slave):
+        """
+        Closes the connection of a Slave and removes it from the replicas of its shard.
+        :param slave: SlaveConnection
+        :return: None
+        """
+        self.connections.remove(slave)
+        self.unregister(slave)
+        if slave.shard_id is not None:
+            self.replicas[slave.shard_id].remove(slave)
+
+    def reroute_pending(self, slave):
+        """
+        Sends requests a removed Slave did not answer to another replica of its shard, requests sent to all Slaves
+        stop waiting for it.
+        :param slave: Removed SlaveConnection
+        :return: None
+        """
+        replicas = self.replicas[slave.shard_id] if slave.shard_id is not None else []
+        for request_id in list(slave.pending):
+            request = self.requests.get(request_id)
+            if request is None or request.key(slave) not in request.waiting:
+                continue
+            if request.frames is None:
+                request.waiting.discard(slave)
+                if not request.waiting:
+                    self.complete(request_id)
+            elif not any(request_id in replica.pending for replica in replicas):
+                self.send_to_replica(request_id, slave.shard_id)
+                self.metrics.increment('failovers')
+        slave.pending.clear()
+
+    def broadcast(self, msg_type, fields=None, arrays=None, on_reply=None, on_complete=None):
+        """
+        Sends the same message, encoded once, to all slaves and waits for one reply from each of them.
+        :return: request id
+        """
+        message = (fields or {}, arrays or {})
+        return self.send_request({slave: message for slave in self.connections}, msg_type, on_reply, on_complete)
+
+    def run_until(self, condition):
+        """
+        Runs the event loop until the condition is met.
+        :param condition: Function without arguments
+        :return: None
+        """
+        while not condition():
+            self.poll()
+
+    def poll(self, timeout=None):
+        """
+        Runs one iteration of the event loop: writes queued frames to all connections in parallel, dispatches
+        complete messages as they arrive, calls due timers and fails slaves that passed their deadlines.
+        :param timeout: Maximum number of seconds to wait for events
+        :return: None
+        """
+        for connection in itertools.chain(self.connections, self.clients):
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.has_outgoing() else 0)
+            if events != connection.events:
+                connection.events = events
+                self.selector.modify(connection.socket, events, connection)
+        busy = [slave for slave in self.connections if slave.is_busy()]
+        wait = self.time_to_deadline(busy)
+        if self.timers:
+            timer_wait = max(0.0, self.timers[0][0] - time.monotonic())
+            wait = timer_wait if wait is None else min(wait, timer_wait)
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        for key, mask in self.selector.select(wait):
+            if key.data == FRONTEND:
+                self.accept_client()
+            elif key.data == WAKEUP:
+                self.accept_submissions()
+            elif key.data == JOIN:
+                self.accept_slave()
+            elif key.data in self.joining:
+                self.handle_joining(key.data)
+            elif isinstance(key.data, SlaveConnection):
+                # The slave may have failed while earlier events were handled
+                if key.data in self.connections:
+                    self.handle_slave(key.data, mask)
+            else:
+                self.handle_client(key.data, mask)
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+        for slave in busy:
+            if slave in self.connections and slave.is_busy() and slave.deadline is not None and now > slave.deadline:
+                self.fail_slave(slave, SlaveTimeoutError('Slave ' + str(slave) + ' did not respond within '
+                                                         + str(self.timeout) + ' seconds'))
+
+    def handle_slave(self, slave, mask):
+        """
+        Handles socket events of one slave.
+        :param slave: SlaveConnection
+        :param mask: Selector events mask
+        :return: None
+        """
+        try:
+            if mask & selectors.EVENT_WRITE and slave.flush():
+                self.touch(slave)
+            received = slave.read_messages() if mask & selectors.EVENT_READ else []
+        except ConnectionError:
+            self.fail_slave(slave, ConnectionError('Slave ' + str(slave) + ' closed the connection'))
+            return
+        if received:
+            self.touch(slave)
+        for message in received:
+            request_id = message.fields.get('request_id')
+            if request_id not in slave.pending:
+                raise messages.ProtocolError('Unexpected message ' + str(message.type) + ' from slave ' + str(slave))
+            round_trip = time.perf_counter() - slave.pending.pop(request_id)
+            slave_stats = self.metrics.slave(str(slave))
+            slave_stats.requests += 1
+            slave_stats.round_trip.observe(round_trip)
+            if message.type == MessageType.NEIGHBOURS:
+                self.round_trips.append(round_trip)
+            if 'compute_seconds' in message.fields:
+                slave_stats.compute.observe(message.fields['compute_seconds'])
+            if message.type == MessageType.NEIGHBOURS and len(message.arrays.get('query_ids', ())):
+                per_query = message.fields['compute_seconds'] / len(message.arrays['query_ids'])
+                if slave.compute_per_query is not None:
+                    per_query += (1 - COMPUTE_SMOOTHING) * (slave.compute_per_query - per_query)
+                slave.compute_per_query = slave_stats.compute_per_query = per_query
+            request = self.requests.get(request_id)
+            if request is None or request.key(slave) not in request.waiting:
+                # Another replica answered a hedged request first, or a joining Slave replied to an update it got
+                # after the copy of its shard
+                self.metrics.increment('late_replies')
+                continue
+            request.waiting.discard(request.key(slave))
+            request.on_reply(slave, message)
+            if not request.waiting:
+                self.complete(request_id)
+
+    def touch(self, slave):
+        """
+        Moves the slave's deadline after it made progress.
+        :param slave: SlaveConnection
+        :return: None
+        """
+        slave.deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+
+    @staticmethod
+    def time_to_deadline(slaves):
+        deadlines = [slave.deadline for slave in slaves if slave.deadline is not None]
+        return max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+
+    @staticmethod
+    def expect_type(slave, message, expected_type):
+        if message.type != expected_type:
+            raise messages.ProtocolError('Expected message ' + str(expected_type) + ' from slave ' + str(slave)
+                                         + ' but received ' + str(message.type))
+
+    @measure_phase('distribution')
     def start_data_distribution_phase(self):
         """
         Starts Data Distribution Phase where initial dataset is distributed to the Slave nodes.
         :return: None
         """
-        print('DATA DISTRIBUTION PHASE')
-        n = len(self.connections)
-        remaining_points = len(self.data) % n
-        batch_size = int((len(self.data) - remaining_points) / n)
-        for i, connection in enumerate(self.connections):
-            need_send_additional_point = remaining_points - i > 0
-            if need_send_additional_point:
-                batch_size += 1
-            data_batch = self.data[batch_size * i: batch_size * (i + 1)]
-            data = connection[0].recv(1024)
-            if data and data == messages.ClientMessages.SEND_DATA_REQUEST:
-                connection[0].send(str.encode(str(len(data_batch))))
-                data = connection[0].recv(1024)
-                if data and data == messages.ClientMessages.READY:
-                    for d in data_batch:
-                        connection[0].send(str.encode(str(d)))
-            if need_send_additional_point:
-                batch_size -= 1
-                remaining_points -= 1
-        print('DATA DISTRIBUTION PHASE IS FINISHED')
+        logger.info('DATA DISTRIBUTION PHASE')
+        num_shards = max(1, len(self.connections) // self.replication)
+        if num_shards * self.replication > len(self.connections):
+            logger.warning('%d Slaves cannot store %d replicas of every shard', len(self.connections),
+                           self.replication)
+        self.replicas = [self.connections[shard_id::num_shards] for shard_id in range(num_shards)]
+        requests = self.stream_chunks() if isinstance(self.data, DatasetFile) else self.prepare_shards()
+        self.shard_sizes = [0] * num_shards
+        request_id = self.send_request(requests, MessageType.DATA_BATCH, self.receive_shard_size)
+        self.run_until(lambda: request_id not in self.requests)
+        logger.info('DATA DISTRIBUTION PHASE IS FINISHED')
 
+    def receive_shard_size(self, slave, message):
+        """
+        Stores the shard size a Slave reported after its shard changed.
+        :param slave: SlaveConnection that sent the message
+        :param message: DATA_RECEIVED message
+        :return: None
+        """
+        self.expect_type(slave, message, MessageType.DATA_RECEIVED)
+        if 'error' in message.fields:
+            logger.warning('Slave %s could not update its shard: %s', slave, message.fields['error'])
+        self.metrics.slave(str(slave)).shard_size = message.fields['count']
+        if slave.shard_id is not None:
+            # A draining Slave no longer holds a shard
+            self.shard_sizes[slave.shard_id] = message.fields['count']
+        self.next_id = max(self.next_id, message.fields.get('max_id', -1) + 1)
+
+    def shard_weights(self):
+        """
+        Relative shard sizes: equal, or given by the capacities the replicas of every shard reported in the
+        handshake, as queries are spread over the replicas.
+        :return: list of weights
+        """
+        if self.sizing == SIZING_EQUAL:
+            return [1.0] * len(self.replicas)
+        slaves = [slave for replicas in self.replicas for slave in replicas]
+        weights = dict(zip(slaves, capacity_weights([slave.throughput for slave in slaves],
+                                                    [min(slave.workers, slave.cores) for slave in slaves])))
+        shards = np.array([sum(weights[slave] for slave in replicas) for replicas in self.replicas])
+        return (shards / shards.max()).tolist()
+
+    def memory_limits(self):
+        """
+        Maximum shard sizes that fit into MEMORY_FRACTION of the memory of every replica: every point takes its
+        coordinates, squared norm, id and label code.
+        :return: list of numbers of points
+        """
+        point_bytes = 8 * self.dimensions + 8 + 8 + 4
+        return [min(slave.memory * MEMORY_FRACTION // point_bytes if slave.memory else np.inf for slave in replicas)
+                for replicas in self.replicas]
+
+    def prepare_shards(self):
+        """
+        Splits the dataset into shards, keeping shards that slaves already store on them.
+        :return: Dictionary of slave -> (fields, arrays) of its DATA_BATCH message
+        """
+        shards = []
+        label_table = self.data.label_table
+        self.dimensions = self.data.points.shape[1]
+        limits = self.memory_limits()
+        sizes = self.stored_sizes(len(self.data), limits)
+        if sizes is not None:
+            logger.info('Keeping shard sizes of the stored shards: %s', sizes)
+        else:
+            sizes = capacity_sizes(len(self.data), self.shard_weights(), limits)
+            if sizes != capacity_sizes(len(self.data), [1.0] * len(sizes)):
+                logger.info('Shard sizes by capacity of the Slaves: %s', sizes)
+        for shard_id, shard in enumerate(self.data.split(len(self.replicas), sizes)):
+            arrays = {'points': shard.points, 'ids': shard.ids, 'label_codes': shard.label_codes}
+            checksum = shard_store.shard_checksum(shard.points, shard.ids, shard.label_codes, label_table)
+            if self.shard_directory is not None:
+                shard_store.write_shard(os.path.join(self.shard_directory, 'shard-' + str(shard_id)), shard_id,
+                                        shard.points, shard.ids, shard.label_codes, label_table, checksum)
+            shards.append((dict(self.index_fields(), shard_id=shard_id, checksum=checksum, label_table=label_table),
+                           arrays))
+        requests = {}
+        assignment = self.assign_shards([fields['checksum'] for fields, _ in shards],
+                                        [len(replicas) for replicas in self.replicas])
+        self.replicas = [[] for _ in shards]
+        for slave, shard_id in assignment.items():
+            fields, arrays = shards[shard_id]
+            slave.shard_id = shard_id
+            self.replicas[shard_id].append(slave)
+            if slave.manifest is not None and slave.manifest.get('checksum') == fields['checksum']:
+                logger.info('Slave %s already stores shard %s', slave, shard_id)
+                requests[slave] = (dict(fields, reuse=True), {})
+            else:
+                requests[slave] = (fields, arrays)
+        return requests
+
+    def stored_sizes(self, total, limits):
+        """
+        Shard sizes of the shards the Slaves offered in the handshake. Measured throughputs differ between runs, so
+        restarted Slaves keep the sizes of their stored shards instead of a new split by capacity, as long as the
+        stored shards cover every shard exactly once, hold the whole dataset and fit into the memory of the Slaves.
+        :param total: Number of points
+        :param limits: Maximum shard size of every shard
+        :return: list of shard sizes or None
+        """
+        sizes = [None] * len(self.replicas)
+        for slave in self.connections:
+            manifest = slave.manifest
+            if manifest is None:
+                continue
+            shard_id, count = manifest.get('shard_id'), manifest.get('count')
+            if not isinstance(shard_id, int) or not 0 <= shard_id < len(sizes) or not isinstance(count, int) \
+                    or manifest.get('dim') != self.dimensions or sizes[shard_id] not in (None, count):
+                return None
+            sizes[shard_id] = count
+        if None in sizes or sum(sizes) != total or any(size > limit for size, limit in zip(sizes, limits)):
+            return None
+        return sizes
+
+    def stream_chunks(self):
+        """
+        Reads the dataset file chunk by chunk and queues the rows of every chunk for their slaves as soon as it is
+        read. Reading waits while more than STREAM_WINDOW_CHUNKS chunks are queued, so that the Master holds only a
+        few chunks at a time and sending overlaps with reading.
+        :return: Dictionary of slave -> (fields, arrays) of the DATA_BATCH messages that complete the shards
+        """
+        if self.shard_directory is not None:
+            logger.warning('Shards of a streamed dataset are not written by the Master, store them on the Slaves')
+        parts = len(self.replicas)
+        weights = self.shard_weights()
+        weights = weights if len(set(weights)) > 1 else None
+        rows = 0
+        for chunk in self.data.chunks():
+            owners = assign_rows(chunk.ids, np.arange(rows, rows + len(chunk)), parts, self.assignment, weights)
+            rows += len(chunk)
+            self.dimensions = chunk.points.shape[1]
+            order = np.argsort(owners, kind='stable')
+            bounds = np.searchsorted(owners[order], np.arange(parts + 1))
+            for shard_id, replicas in enumerate(self.replicas):
+                part = chunk.take(order[bounds[shard_id]:bounds[shard_id + 1]])
+                frame = messages.encode_message(MessageType.DATA_CHUNK, {'label_table': part.label_table},
+                                                {'points': part.points, 'ids': part.ids,
+                                                 'label_codes': part.label_codes})
+                for slave in replicas:
+                    if not slave.is_busy():
+                        self.touch(slave)
+                    slave.queue(frame)
+            # Replicas of a shard queue views of the same frames
+            limit = STREAM_WINDOW_CHUNKS * (chunk.points.nbytes + chunk.ids.nbytes + chunk.label_codes.nbytes) \
+                * len(self.connections) / parts
+            self.run_until(lambda: sum(slave.outgoing_bytes() for slave in self.connections) <= limit)
+        logger.info('Streamed %d data points from %s', rows, self.data)
+        requests = {}
+        for shard_id, replicas in enumerate(self.replicas):
+            fields = dict(self.index_fields(), shard_id=shard_id, streamed=True)
+            for slave in replicas:
+                slave.shard_id = shard_id
+                requests[slave] = (fields, {})
+        return requests
+
+    def assign_shards(self, checksums, slots):
+        """
+        Assigns shards to slaves, keeping every shard on the slaves that already store it.
+        :param checksums: Checksums of the shards
+        :param slots: Number of replicas of every shard
+        :return: Dictionary of slave -> shard id
+        """
+        assignment = {}
+        free = list(slots)
+        for slave in self.connections:
+            manifest = slave.manifest or {}
+            shard_id = manifest.get('shard_id')
+            if isinstance(shard_id, int) and 0 <= shard_id < len(checksums) and free[shard_id] > 0 \
+                    and manifest.get('checksum') == checksums[shard_id]:
+                assignment[slave] = shard_id
+                free[shard_id] -= 1
+        # Remaining slots are filled one replica of every shard at a time
+        free_shards = iter([shard_id for replica in range(max(slots, default=0))
+                            for shard_id in range(len(checksums)) if free[shard_id] > replica])
+        for slave in self.connections:
+            if slave not in assignment:
+                assignment[slave] = next(free_shards)
+        return assignment
+
+    @measure_phase('classification')
     def start_classification_phase(self):
         """
         Starts Classification Phase where points are sent to Slave nodes for classification.
         :return: Classification results
         """
-        print('CLASSIFICATION PHASE')
-        for i, connection in enumerate(self.connections):
-            data_batch = self.points
-            data = connection[0].recv(1024)
-            if data and data == messages.ClientMessages.SEND_DATA_REQUEST:
-                connection[0].send(str.encode(str(len(data_batch))))
-                data = connection[0].recv(1024)
-                if data and data == messages.ClientMessages.READY:
-                    for d in data_batch:
-                        connection[0].send(str.encode(str(d)))
-        for connection in self.connections:
-            data = connection[0].recv(1024)
-            if data and data == messages.ClientMessages.REQUEST_FOR_K:
-                connection[0].send(str.encode(str(self.k)))
-                connection[0].send(str.encode(str(len(self.connections))))
-        neighbouring_points = {}
-        for point in self.points:
-            neighbouring_points[str(point.id)] = []
-        for connection in self.connections:
-            data = connection[0].recv(1024)
-            if data and data == messages.ClientMessages.SEND_CLASSIFICATION_DATA_REQUEST:
-                connection[0].send(messages.ServerMessages.ALLOW_PROCEED)
-                data = connection[0].recv(1024)
-                if data:
-                    points_to_receive = int(data.decode())
-                    for _ in range(points_to_receive):
-                        data = connection[0].recv(1024)
-                        if data:
-                            neighbours_to_receive = int(data.decode())
-                            data = connection[0].recv(1024)
-                            if data:
-                                point_id = str(data.decode())
-                                for _ in range(neighbours_to_receive):
-                                    data = connection[0].recv(1024)
-                                    if data:
-                                        neighbour_point = parse_data_point(data.decode())
-                                        neighbouring_points[point_id].append(neighbour_point)
-        final_classified_points = []
-        for point in self.points:
-            neighbours = neighbouring_points[str(point.id)]
-            final_label = get_majority_vote(neighbours)
-            print('Received all neighbours for', point.data, '('+str(point.id)+'):', [p.label for p in neighbours])
-            final_classified_points.append(DataPoint(point.data, final_label, point.id))
-        self.points = final_classified_points
-        print('CLASSIFICATION PHASE IS FINISHED')
+        logger.info('CLASSIFICATION PHASE')
+        batch = self.submit(self.points.points)
+        self.run_until(batch.future.done)
+        self.neighbours = batch.neighbours
+        if logger.isEnabledFor(logging.DEBUG):
+            for point, neighbours in zip(self.points, batch.neighbours):
+                labels = [neighbour.label for neighbour in neighbours]
+                logger.debug('Received all neighbours for %s (%s): %s', point.data, point.id, labels)
+        self.points = self.points.with_labels(batch.future.result())
+        logger.info('CLASSIFICATION PHASE IS FINISHED')
+
+    def get_request_size(self, k=None):
+        """
+        Computes number of candidates requested from every shard for one query.
+        :param k: Number of neighbours, Master's k by default
+        :return: request size
+        """
+        k = k if k is not None else self.k
+        if self.fan_out == FAN_OUT_EXACT:
+            return k
+        if self.fan_out == FAN_OUT_ADAPTIVE:
+            return adaptive_request_size(k, len(self.replicas))
+        return max(1, min(k, int(self.fan_out)))
+
+    def submit(self, queries, k=None, nprobe=None):
+        """
+        Submits a batch of queries. Must be called from the thread that runs the event loop.
+        :param queries: [m x d] array of query points
+        :param k: Number of neighbours, Master's k by default
+        :param nprobe: Number of IVF lists probed by approximate search, Master's nprobe by default
+        :return: QueryBatch whose future resolves to the list of labels
+        """
+        k = k if k is not None else self.k
+        nprobe = nprobe if nprobe is not None else self.nprobe
+        self.check_queries(queries, k, nprobe)
+        batch = QueryBatch(queries, k, self.get_request_size(k), len(self.replicas), nprobe)
+        # Answered queries per second since the first request
+        self.metrics.rate('answered_queries').start()
+        batch.future.add_done_callback(lambda future: self.record_request(batch))
+        if self.max_batch_size:
+            self.coalesce(batch)
+        else:
+            self.answer(batch)
+        return batch
 
+    def record_request(self, batch):
+        self.metrics.histogram('request_latency').observe(time.perf_counter() - batch.created, len(batch))
+        if batch.future.exception() is None:
+            self.metrics.rate('answered_queries').add(len(batch))
+
+    def check_points(self, batch):
+        """
+        Checks labelled points before they are inserted, the Slaves cannot store malformed ones.
+        :param batch: PointBatch of the points
+        :return: None
+        """
+        points, label_codes, label_table = batch.points, batch.label_codes, batch.label_table
+        if points.ndim != 2 or points.dtype.kind not in 'biuf':
+            raise ValueError('Points must be a numeric [m x d] matrix')
+        if self.dimensions is not None and points.shape[1] != self.dimensions:
+            raise ValueError('Points have ' + str(points.shape[1]) + ' dimensions but the dataset has '
+                             + str(self.dimensions))
+        if not isinstance(label_table, list) or any(isinstance(label, (list, dict)) for label in label_table):
+            raise ValueError('Label table must be a list of labels')
+        if not isinstance(label_codes, np.ndarray) or label_codes.shape != (len(points),) \
+                or label_codes.dtype.kind not in 'iu':
+            raise ValueError('Points need one integer label code each')
+        if len(label_codes) and (label_codes.min() < 0 or label_codes.max() >= len(label_table)):
+            raise ValueError('Label codes must refer to the label table')
+
+    def check_queries(self, queries, k, nprobe):
+        """
+        Checks a batch of queries before it is sent to the Slaves, which cannot answer malformed ones.
+        :param queries: [m x d] array of query points
+        :param k: Number of neighbours
+        :param nprobe: Number of IVF lists probed by approximate search or None
+        :return: None
+        """
+        if not isinstance(queries, np.ndarray) or queries.ndim != 2 or queries.dtype.kind not in 'biuf':
+            raise ValueError('Queries must be a numeric [m x d] matrix')
+        if self.dimensions is not None and queries.shape[1] != self.dimensions:
+            raise ValueError('Queries have ' + str(queries.shape[1]) + ' dimensions but the dataset has '
+                             + str(self.dimensions))
+        for name, value in (('k', k), ('nprobe', nprobe)):
+            if value is not None and (not isinstance(value, (int, np.integer)) or isinstance(value, bool)
+                                      or value < 1):
+                raise ValueError(name + ' must be a positive integer')
+
+    def answer(self, batch):
+        """
+        Answers a query batch from the cache or sends it to the Slaves.
+        :param batch: QueryBatch
+        :return: None
+        """
+        if self.cache is not None:
+            self.submit_cached(batch)
+        else:
+            self.enqueue(batch)
+
+    def coalesce(self, batch):
+        """
+        Adds a query batch to the micro-batch of queries with the same k and nprobe. The micro-batch is sent once it
+        holds max_batch_size queries or once its first queries waited max_batch_wait seconds.
+        :param batch: QueryBatch
+        :return: None
+        """
+        key = (batch.k, batch.nprobe)
+        group = self.micro_batches.get(key)
+        if group is None:
+            group = self.micro_batches[key] = []
+            self.call_later(self.max_batch_wait, lambda: self.flush_micro_batch(key, group))
+        group.append(batch)
+        if sum(len(queued) for queued in group) >= self.max_batch_size:
+            self.flush_micro_batch(key, group)
+
+    def flush_micro_batch(self, key, group):
+        """
+        Sends the queries of a micro-batch as one batch and hands the results back to the batches they came from.
+        :param key: Tuple of (k, nprobe) of the micro-batch
+        :param group: List of QueryBatches in the micro-batch
+        :return: None
+        """
+        if self.micro_batches.get(key) is not group:
+            # The micro-batch was already sent when it became full
+            return
+        del self.micro_batches[key]
+        first = group[0]
+        merged = QueryBatch(np.concatenate([batch.queries for batch in group]), first.k, first.request_size,
+                            len(self.replicas), first.nprobe)
+        self.metrics.increment('micro_batches')
+        self.metrics.histogram('micro_batch_size', SIZE_BUCKETS, unit=None).observe(len(merged))
+        self.metrics.histogram('micro_batch_wait').observe(merged.created - first.created)
+
+        def on_done(future):
+            if future.exception() is not None:
+                for batch in group:
+                    batch.fail(future.exception())
+                return
+            labels = future.result()
+            start = 0
+            for batch in group:
+                batch.neighbours = merged.neighbours[start:start + len(batch)]
+                batch.finish(labels[start:start + len(batch)])
+                start += len(batch)
+
+        merged.future.add_done_callback(on_done)
+        self.answer(merged)
+
+    def enqueue(self, batch):
+        """
+        Dispatches a query batch at once or leaves it in the backlog while too many batches are in flight or points
+        are moving between shards.
+        :param batch: QueryBatch
+        :return: None
+        """
+        if len(self.in_flight) < self.max_in_flight and not self.rebalances and not self.rebalancing:
+            self.dispatch(batch)
+        else:
+            self.backlog.append(batch)
+
+    def submit_cached(self, batch):
+        """
+        Answers queries of the batch from the cache. The distinct queries that are not cached are sent to the
+        cluster as one smaller batch, whose results are cached and copied into the batch once it finishes.
+        :param batch: QueryBatch
+        :return: None
+        """
+        version = self.dataset_version
+        batch.neighbours = [None] * len(batch)
+        labels = [None] * len(batch)
+        missing = {}
+        for query_id, key in enumerate(self.cache.keys(batch.queries, batch.k, batch.nprobe)):
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.setdefault(key, []).append(query_id)
+            else:
+                batch.neighbours[query_id], labels[query_id] = cached
+        misses = sum(len(query_ids) for query_ids in missing.values())
+        self.metrics.increment('cache_hits', len(batch) - misses)
+        self.metrics.increment('cache_misses', misses)
+        if not missing:
+            batch.finish(labels)
+            return
+        rows = [query_ids[0] for query_ids in missing.values()]
+        uncached = QueryBatch(batch.queries[rows], batch.k, batch.request_size, len(self.replicas), batch.nprobe)
+
+        def on_done(future):
+            if future.exception() is not None:
+                batch.fail(future.exception())
+                return
+            for key, neighbours, label in zip(missing, uncached.neighbours, future.result()):
+                self.metrics.increment('cache_evictions', self.cache.put(key, neighbours, label, version))
+                for query_id in missing[key]:
+                    batch.neighbours[query_id], labels[query_id] = neighbours, label
+            batch.finish(labels)
+
+        uncached.future.add_done_callback(on_done)
+        self.enqueue(uncached)
+
+    def bump_dataset_version(self):
+        """
+        Marks a change of the dataset, which empties the cache. Slaves receive every change before the queries
+        submitted after it, so results of those queries belong to the new version.
+        :return: None
+        """
+        self.dataset_version += 1
+        if self.cache is not None:
+            self.cache.invalidate(self.dataset_version)
+
+    def dispatch(self, batch):
+        """
+        Sends a query batch to a replica of every shard and gathers their candidates.
+        :param batch: QueryBatch
+        :return: None
+        """
+        self.in_flight.add(batch)
+        if self.pruning and len(self.replicas) > 1:
+            self.dispatch_with_bounds(batch)
+            return
+        message = batch.encode()
+        self.send_to_shards({shard_id: message for shard_id in range(len(self.replicas))}, MessageType.QUERY_BATCH,
+                            lambda slave, reply: self.receive_candidates(batch, slave, reply),
+                            lambda: self.refine_truncated_candidates(batch))
+
+    def dispatch_with_bounds(self, batch):
+        """
+        Sends a query batch to the shards in rounds: first to one seed shard, which changes round-robin between
+        batches, and then to groups as large as the number of shards that already answered. Every round carries the
+        k-th distance bounds given by the candidates merged so far, so later rounds return fewer candidates.
+        :param batch: QueryBatch
+        :return: None
+        """
+        seed = next(self.seed_shards) % len(self.replicas)
+        shards = list(range(seed, len(self.replicas))) + list(range(seed))
+
+        def receive(slave, message):
+            self.receive_candidates(batch, slave, message)
+
+        def send_round(start, size):
+            message = batch.encode(request_size=batch.k, bounds=batch.bounds() if start else None)
+
+            def on_complete():
+                batch.merge()
+                if start + size < len(shards) and batch.error is None:
+                    send_round(start + size, start + size)
+                else:
+                    self.finish(batch)
+
+            self.send_to_shards({shard_id: message for shard_id in shards[start:start + size]},
+                                MessageType.QUERY_BATCH, receive, on_complete)
+
+        self.metrics.increment('pruned_batches')
+        send_round(0, 1)
+
+    def receive_candidates(self, batch, slave, message):
+        """
+        Stores candidates received from a replica of one shard.
+        :param batch: QueryBatch the reply belongs to
+        :param slave: SlaveConnection that sent the message
+        :param message: NEIGHBOURS message
+        :return: None
+        """
+        self.expect_type(slave, message, MessageType.NEIGHBOURS)
+        if 'error' in message.fields:
+            logger.warning('Slave %s could not answer a query batch: %s', slave, message.fields['error'])
+            batch.error = ValueError(message.fields['error'])
+            return
+        batch.add_reply(slave.shard_id, message)
+
+    def refine_truncated_candidates(self, batch):
+        """
+        Merges candidates of the batch. With reduced fan-out shards whose truncated lists reached into the global
+        k nearest are asked for their full k candidates before the batch is finished.
+        :param batch: QueryBatch
+        :return: None
+        """
+        if batch.error is not None:
+            self.finish(batch)
+            return
+        batch.merge()
+        retries = batch.find_truncated(self.shard_sizes)
+        requests = {}
+        for shard_id, query_ids in enumerate(retries):
+            if query_ids:
+                requests[shard_id] = batch.encode(np.array(query_ids, dtype=np.int64), batch.k)
+        if requests:
+            logger.debug('Requested full candidate lists for %d shard queries', sum(len(r) for r in retries))
+            self.metrics.increment('candidate_retries', sum(len(r) for r in retries))
+
+        def on_complete():
+            batch.merge(set(itertools.chain(*retries)))
+            self.finish(batch)
+
+        self.send_to_shards(requests, MessageType.QUERY_BATCH,
+                            lambda slave, message: self.receive_candidates(batch, slave, message), on_complete)
+
+    def finish(self, batch):
+        """
+        Finishes the batch and dispatches the next one from the backlog.
+        :param batch: QueryBatch
+        :return: None
+        """
+        self.in_flight.discard(batch)
+        if batch.error is not None:
+            batch.fail(batch.error)
+            self.metrics.increment('failed_batches')
+            self.dispatch_backlog()
+            return
+        batch.finish()
+        self.metrics.histogram('query_latency').observe(time.perf_counter() - batch.created, len(batch))
+        self.metrics.increment('queries', len(batch))
+        self.metrics.increment('batches')
+        self.check_stragglers()
+        self.dispatch_backlog()
+
+    def dispatch_backlog(self):
+        """
+        Dispatches waiting batches while fewer than max_in_flight batches are in flight. Inserts and deletes that
+        waited for moving points go first, then queued rebalances, they start once no batch is in flight.
+        :return: None
+        """
+        while self.updates and not self.rebalancing:
+            self.updates.pop(0)()
+        if self.rebalances or self.rebalancing:
+            self.start_rebalance()
+            return
+        while self.backlog and len(self.in_flight) < self.max_in_flight:
+            self.dispatch(self.backlog.pop(0))
+
+    def check_stragglers(self):
+        """
+        Moves rows away from stragglers: shards whose compute time per query stayed STRAGGLER_RATIO times above
+        that of the fastest shard for STRAGGLER_BATCHES batches. Shards are resized in proportion to the speed
+        observed on their replicas, rows searched per second of compute time per query.
+        :return: None
+        """
+        times = [[slave.compute_per_query for slave in replicas if slave.compute_per_query is not None]
+                 for replicas in self.replicas]
+        if self.sizing == SIZING_EQUAL or len(times) < 2 or not all(times):
+            return
+        times = [float(np.mean(replica_times)) for replica_times in times]
+        if min(times) <= 0:
+            return
+        self.imbalanced_batches = self.imbalanced_batches + 1 if max(times) > STRAGGLER_RATIO * min(times) else 0
+        if self.imbalanced_batches < STRAGGLER_BATCHES or self.rebalances or self.rebalancing:
+            return
+        speeds = [max(size, 1) / seconds for size, seconds in zip(self.shard_sizes, times)]
+        logger.info('Moving rows away from stragglers, compute seconds per query: %s', times)
+        self.metrics.increment('straggler_rebalances')
+        self.submit_rebalance(speeds)
+
+    def submit_insert(self, points):
+        """
+        Inserts labelled points into the running cluster. They get new ids and go to all replicas of the smallest
+        shards. Must be called from the thread that runs the event loop. Raises ValueError for malformed points.
+        :param points: PointBatch or list of DataPoints
+        :return: Future that resolves to the array of ids given to the points
+        """
+        batch = as_point_batch(points)
+        self.check_points(batch)
+        ids = np.arange(self.next_id, self.next_id + len(batch), dtype=np.int64)
+        self.next_id += len(batch)
+        future = Future()
+
+        errors = []
+
+        def on_reply(slave, message):
+            self.receive_shard_size(slave, message)
+            if 'error' in message.fields:
+                errors.append(message.fields['error'])
+
+        def on_complete():
+            if errors:
+                future.set_exception(ValueError('Slaves could not insert the points: ' + errors[0]))
+            else:
+                future.set_result(ids)
+
+        def send():
+            self.bump_dataset_version()
+            counts = fill_counts(self.shard_sizes, len(batch), self.shard_weights())
+            self.send_points(PointBatch(batch.points, ids, batch.label_codes, batch.label_table), counts,
+                             on_complete, on_reply)
+            self.metrics.increment('inserted_points', len(batch))
+
+        self.schedule_update(send)
+        return future
+
+    def schedule_update(self, send):
+        """
+        Sends an insert or delete at once, or after the running rebalance or drain. Points it moves have already
+        left their old shard and reach the new one only when it finishes, so updates sent in between would miss
+        them. Slaves handle messages in order, so updates sent before a rebalance starts are applied before its
+        points are extracted.
+        :param send: Function that sends the update
+        :return: None
+        """
+        if self.rebalancing:
+            self.updates.append(send)
+        else:
+            send()
+
+    def send_points(self, batch, counts, on_complete, on_reply=None):
+        """
+        Sends consecutive parts of a batch of points to all replicas of the shards. Shard sizes are raised at once,
+        so that points inserted before the Slaves reply are routed by the sizes they will have.
+        :param batch: PointBatch
+        :param counts: Number of points for every shard
+        :param on_complete: Callback called after all Slaves stored their points
+        :param on_reply: Callback called with (slave, message) for every reply, receive_shard_size by default
+        :return: None
+        """
+        requests = {}
+        start = 0
+        for shard_id, count in enumerate(counts):
+            # A Slave that failed to extract its points sends fewer of them
+            count = min(count, len(batch) - start)
+            if count:
+                part = batch[start:start + count]
+                message = ({'label_table': part.label_table},
+                           {'points': part.points, 'ids': part.ids, 'label_codes': part.label_codes})
+                requests.update((slave, message) for slave in self.replicas[shard_id])
+                self.shard_sizes[shard_id] += count
+                start += count
+        self.send_request(requests, MessageType.INSERT_POINTS, on_reply or self.receive_shard_size, on_complete)
+
+    def submit_delete(self, ids):
+        """
+        Deletes points from the running cluster. Must be called from the thread that runs the event loop. Raises
+        ValueError if the ids are not a sequence of integers.
+        :param ids: Ids of the points
+        :return: Future that resolves to the number of deleted points
+        """
+        ids = np.asarray(ids)
+        if ids.ndim != 1 or (len(ids) and ids.dtype.kind not in 'iu'):
+            raise ValueError('Ids must be a sequence of integers')
+        ids = ids.astype(np.int64)
+        future = Future()
+        removed = {}
+        errors = []
+
+        def on_reply(slave, message):
+            self.receive_shard_size(slave, message)
+            removed[slave.shard_id] = message.fields.get('removed', 0)
+            if 'error' in message.fields:
+                errors.append(message.fields['error'])
+
+        def on_complete():
+            self.metrics.increment('deleted_points', sum(removed.values()))
+            if errors:
+                future.set_exception(ValueError('Slaves could not delete the points: ' + errors[0]))
+            else:
+                future.set_result(sum(removed.values()))
+
+        def send():
+            self.bump_dataset_version()
+            self.broadcast(MessageType.DELETE_POINTS, arrays={'ids': ids}, on_reply=on_reply, on_complete=on_complete)
+
+        self.schedule_update(send)
+        return future
+
+    def submit_rebalance(self, weights=None):
+        """
+        Resizes shards in proportion to their weights by moving only the surplus points of the shards that are too
+        large to the ones that are too small. Query batches, inserts and deletes wait while points move, so
+        that none of them misses the moving points. Must be called from the thread that runs the event loop.
+        :param weights: Weight of every shard, shard_weights() by default
+        :return: Future that resolves to the number of moved points
+        """
+        future = Future()
+        self.rebalances.append(lambda: self.move_surplus(weights, future))
+        self.dispatch_backlog()
+        return future
+
+    def start_rebalance(self):
+        """
+        Starts the next queued rebalance or drain once no query batch is in flight.
+        :return: None
+        """
+        if self.rebalancing or self.in_flight or not self.rebalances:
+            return
+        self.rebalancing = True
+        self.rebalances.pop(0)()
+
+    def finish_rebalance(self, future, count):
+        """
+        Resolves a finished rebalance or drain and dispatches the query batches that waited for it.
+        :param future: Future of the rebalance
+        :param count: Number of moved points
+        :return: None
+        """
+        self.rebalancing = False
+        self.imbalanced_batches = 0
+        for slave in self.connections:
+            slave.compute_per_query = None
+        future.set_result(count)
+        self.dispatch_backlog()
+
+    def move_surplus(self, weights, future):
+        """
+        Moves the surplus points of the shards that are too large for their weights to the ones that are too small.
+        :param weights: Weight of every shard or None
+        :param future: Future of the rebalance
+        :return: None
+        """
+        weights = weights if weights is not None else self.shard_weights()
+        surplus = np.subtract(self.shard_sizes, balanced_sizes(self.shard_sizes, weights))
+        # Replicas of a shard hold the same points in the same order, so all of them give away the same points
+        requests = {}
+        for replicas, count in zip(self.replicas, surplus):
+            if count > 0:
+                message = ({'count': int(count)}, {})
+                requests.update((slave, message) for slave in replicas)
+        moved = {}
+
+        def on_reply(slave, message):
+            self.expect_type(slave, message, MessageType.DATA_CHUNK)
+            self.shard_sizes[slave.shard_id] = message.fields['count']
+            moved.setdefault(slave.shard_id, PointBatch(message.arrays['points'], message.arrays['ids'],
+                                                        message.arrays['label_codes'], message.fields['label_table']))
+
+        def on_complete():
+            batch = PointBatch.concatenate([moved[shard_id] for shard_id in sorted(moved)]) if moved \
+                else PointBatch(np.empty((0, self.dimensions)))
+            logger.info('Moving %d data points between Slaves', len(batch))
+            self.metrics.increment('moved_points', len(batch))
+            self.send_points(batch, np.maximum(-surplus, 0).tolist(), lambda: self.finish_rebalance(future, len(batch)))
+
+        self.send_request(requests, MessageType.EXTRACT_POINTS, on_reply, on_complete)
+
+    def submit_drain(self, address):
+        """
+        Removes a Slave from the cluster once no query batch is in flight. If another replica holds its shard the
+        Slave just leaves, otherwise its points are extracted and sent to the other shards first. Must be called
+        from the thread that runs the event loop.
+        :param address: Address of the Slave, as in the statistics
+        :return: Future that resolves to the number of moved points
+        """
+        slave = self.leaving_slave(address)
+        future = Future()
+
+        def start():
+            try:
+                self.drain_slave(self.leaving_slave(address), future)
+            except ValueError as error:
+                self.rebalancing = False
+                future.set_exception(error)
+                self.dispatch_backlog()
+
+        self.rebalances.append(start)
+        logger.info('Slave %s will leave the cluster', slave)
+        self.dispatch_backlog()
+        return future
+
+    def leaving_slave(self, address):
+        """
+        Finds a Slave that may leave the cluster.
+        :param address: Address of the Slave
+        :return: SlaveConnection
+        """
+        slave = next((slave for slave in self.connections if str(slave) == address), None)
+        if slave is None or slave.shard_id is None:
+            raise ValueError('No Slave ' + str(address) + ' holds a shard')
+        if any(replica.syncing for replica in self.connections):
+            # Copies of shards refer to them by their ids, which change when a shard is dropped
+            raise ValueError('Slaves cannot leave while a joining Slave copies its shard')
+        if len(self.replicas[slave.shard_id]) == 1 and len(self.replicas) == 1:
+            raise ValueError('Slave ' + address + ' holds the last shard')
+        return slave
+
+    def drain_slave(self, slave, future):
+        """
+        Removes a Slave from the cluster, moving its points to the other shards if it holds the only replica of its
+        shard. The shard is dropped from the shard sizes at once, so that inserted points no longer go to it.
+        :param slave: SlaveConnection
+        :param future: Future of the drain
+        :return: None
+        """
+        shard_id = slave.shard_id
+        if len(self.replicas[shard_id]) > 1:
+            logger.info('Slave %s left the cluster, other replicas keep shard %s', slave, shard_id)
+            self.stop_slave(slave)
+            self.finish_rebalance(future, 0)
+            return
+        count = self.shard_sizes.pop(shard_id)
+        del self.replicas[shard_id]
+        for other_id, replicas in enumerate(self.replicas):
+            for replica in replicas:
+                replica.shard_id = other_id
+        slave.shard_id = None
+        moved = []
+
+        def on_reply(source, message):
+            self.expect_type(source, message, MessageType.DATA_CHUNK)
+            moved.append(PointBatch(message.arrays['points'], message.arrays['ids'], message.arrays['label_codes'],
+                                    message.fields['label_table']))
+
+        def on_complete():
+            self.stop_slave(slave)
+            batch = moved[0]
+            logger.info('Slave %s left the cluster, moving its %d data points to the other shards', slave, len(batch))
+            self.metrics.increment('moved_points', len(batch))
+            self.send_points(batch, fill_counts(self.shard_sizes, len(batch), self.shard_weights()),
+                             lambda: self.finish_rebalance(future, len(batch)))
+
+        self.send_request({slave: ({'count': count}, {})}, MessageType.EXTRACT_POINTS, on_reply, on_complete)
+
+    def stop_slave(self, slave):
+        """
+        Shuts a leaving Slave down and removes it from the cluster.
+        :param slave: SlaveConnection
+        :return: None
+        """
+        slave.send(MessageType.SHUTDOWN)
+        try:
+            slave.flush()
+        except OSError:
+            pass
+        self.remove_slave(slave)
+        self.reroute_pending(slave)
+        self.metrics.increment('drained_slaves')
+
+    def run_in_loop(self, function, *args):
+        """
+        Calls a function that submits work to the event loop and waits for the result. Can be called from any thread:
+        while the Master is serving, the call is handed over to the thread that runs the event loop.
+        :param function: Function that returns a Future, it is called in the event loop thread
+        :param args: Arguments of the function
+        :return: result of the Future
+        """
+        if self.loop_thread is not None and self.loop_thread != threading.get_ident():
+            future = Future()
+            self.submissions.put((function, args, future))
+            self.wakeup_writer.send(b'\0')
+            return future.result()
+        future = function(*args)
+        self.run_until(future.done)
+        return future.result()
+
+    def classify(self, points, k=None, nprobe=None):
+        """
+        Classifies points on the cluster. Can be called from any thread while the Master is serving.
+        :param points: PointBatch, list of DataPoints or [m x d] array of query points
+        :param k: Number of neighbours, Master's k by default
+        :param nprobe: Number of IVF lists probed by approximate search, Master's nprobe by default
+        :return: list of labels
+        """
+        return self.run_in_loop(lambda *args: self.submit(*args).future, as_query_matrix(points), k, nprobe)
+
+    def insert(self, points):
+        """
+        Inserts labelled points into the cluster. Can be called from any thread while the Master is serving.
+        :param points: PointBatch or list of DataPoints
+        :return: array of ids given to the points
+        """
+        return self.run_in_loop(self.submit_insert, points)
+
+    def delete(self, ids):
+        """
+        Deletes points from the cluster. Can be called from any thread while the Master is serving.
+        :param ids: Ids of the points
+        :return: number of deleted points
+        """
+        return self.run_in_loop(self.submit_delete, ids)
+
+    def rebalance(self, weights=None):
+        """
+        Resizes shards in proportion to their weights. Can be called from any thread while the Master is serving.
+        :param weights: Weight of every shard, shard_weights() by default
+        :return: number of moved points
+        """
+        return self.run_in_loop(self.submit_rebalance, weights)
+
+    def drain(self, address):
+        """
+        Removes a Slave from the cluster. Can be called from any thread while the Master is serving.
+        :param address: Address of the Slave, as in the statistics
+        :return: number of moved points
+        """
+        return self.run_in_loop(self.submit_drain, address)
+
+    def accept_submissions(self):
+        """
+        Submits work handed over by other threads.
+        :return: None
+        """
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.submissions.empty():
+            submission = self.submissions.get()
+            if submission is None:
+                self.shutdown_requested = True
+                continue
+            function, args, future = submission
+            try:
+                submitted = function(*args)
+            except ValueError as error:
+                future.set_exception(error)
+                continue
+            submitted.add_done_callback(lambda done, f=future: f.set_exception(done.exception())
+                                        if done.exception() is not None else f.set_result(done.result()))
+
+    def request_shutdown(self):
+        """
+        Stops the serving phase. Can be called from any thread.
+        :return: None
+        """
+        self.submissions.put(None)
+        self.wakeup_writer.send(b'\0')
+
+    @measure_phase('serving')
+    def start_serving_phase(self, address):
+        """
+        Starts Serving Phase where shards stay resident on the slaves and query batches from the local API and the
+        front end are answered until a shutdown command is received.
+        :param address: Front end address ('host:port' or 'unix:/path')
+        :return: None
+        """
+        logger.info('SERVING PHASE')
+        family, sockaddr = messages.parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+        self.frontend = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.frontend.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.frontend.bind(sockaddr)
+        self.frontend.listen()
+        self.frontend.setblocking(False)
+        self.selector.register(self.frontend, selectors.EVENT_READ, FRONTEND)
+        # Slaves may join the cluster while it is serving
+        self.socket.listen()
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, JOIN)
+        logger.info('Serving queries at %s', address)
+        self.loop_thread = threading.get_ident()
+        try:
+            self.run_until(lambda: self.shutdown_requested and not (self.in_flight or self.backlog or self.rebalancing
+                                                                    or self.micro_batches))
+            while any(client.has_outgoing() for client in self.clients):
+                self.poll(self.timeout)
+        finally:
+            self.loop_thread = None
+            for connection in self.clients + self.joining:
+                self.unregister(connection)
+            self.clients = []
+            self.joining = []
+            self.selector.unregister(self.frontend)
+            self.selector.unregister(self.socket)
+            self.frontend.close()
+            if family == socket.AF_UNIX:
+                os.unlink(sockaddr)
+        logger.info('SERVING PHASE IS FINISHED')
+
+    def accept_client(self):
+        connection, address = self.frontend.accept()
+        client = Connection(connection, address)
+        self.register(client)
+        self.clients.append(client)
+
+    def handle_client(self, client, mask):
+        """
+        Handles socket events of one front end client.
+        :param client: Connection
+        :param mask: Selector events mask
+        :return: None
+        """
+        if mask & selectors.EVENT_WRITE:
+            client.flush()
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            received = client.read_messages()
+        except (ConnectionError, messages.ProtocolError):
+            self.clients.remove(client)
+            self.unregister(client)
+            return
+        for message in received:
+            if message.type == MessageType.SHUTDOWN:
+                self.shutdown_requested = True
+            elif message.type == MessageType.STATS:
+                client.send(MessageType.STATS, {'request_id': message.fields.get('request_id'), 'stats': self.stats()})
+            elif message.type == MessageType.INSERT_POINTS:
+                try:
+                    if any(name not in message.arrays for name in ('points', 'label_codes')) \
+                            or 'label_table' not in message.fields:
+                        raise ValueError('Inserted points need points, label_codes and label_table')
+                    inserted = self.submit_insert(PointBatch(message.arrays['points'], None,
+                                                             message.arrays['label_codes'],
+                                                             message.fields['label_table']))
+                except ValueError as error:
+                    logger.warning('Rejected insert: %s', error)
+                    self.reply_to_update(client, MessageType.INSERT_POINTS, message.fields, {'error': str(error)})
+                    continue
+                inserted.add_done_callback(
+                    lambda future, fields=message.fields: self.reply_to_update(
+                        client, MessageType.INSERT_POINTS, fields, {'error': str(future.exception())}
+                        if future.exception() is not None else None, {'ids': future.result()}
+                        if future.exception() is None else None))
+            elif message.type == MessageType.DELETE_POINTS:
+                try:
+                    deleted = self.submit_delete(message.arrays.get('ids'))
+                except ValueError as error:
+                    logger.warning('Rejected delete: %s', error)
+                    self.reply_to_update(client, MessageType.DELETE_POINTS, message.fields, {'error': str(error)})
+                    continue
+                deleted.add_done_callback(
+                    lambda future, fields=message.fields: self.reply_to_update(
+                        client, MessageType.DELETE_POINTS, fields, {'error': str(future.exception())}
+                        if future.exception() is not None else {'removed': future.result()}))
+            elif message.type == MessageType.REBALANCE:
+                self.submit_rebalance().add_done_callback(
+                    lambda future, fields=message.fields: self.reply_to_update(client, MessageType.REBALANCE, fields,
+                                                                               {'moved': future.result()}))
+            elif message.type == MessageType.DRAIN:
+                try:
+                    drained = self.submit_drain(message.fields.get('slave'))
+                except ValueError as error:
+                    self.reply_to_update(client, MessageType.DRAIN, message.fields, {'error': str(error)})
+                    continue
+                drained.add_done_callback(
+                    lambda future, fields=message.fields: self.reply_to_update(
+                        client, MessageType.DRAIN, fields, {'error': str(future.exception())}
+                        if future.exception() is not None else {'moved': future.result()}))
+            elif message.type == MessageType.CLASSIFY_REQUEST:
+                try:
+                    batch = self.submit(message.arrays.get('points'), message.fields.get('k'),
+                                        message.fields.get('nprobe'))
+                except ValueError as error:
+                    logger.warning('Rejected query batch: %s', error)
+                    client.send(MessageType.CLASSIFY_RESULT, {'request_id': message.fields.get('request_id'),
+                                                              'error': str(error)})
+                    continue
+                batch.future.add_done_callback(
+                    lambda future, batch=batch, fields=message.fields: self.reply_to_client(client, fields, batch))
+
+    @staticmethod
+    def reply_to_update(client, msg_type, request_fields, fields=None, arrays=None):
+        """
+        Tells the front end client that its insert, delete, rebalance or drain request is done.
+        :param client: Connection
+        :param msg_type: Type of the request message, which is also the type of the reply
+        :param request_fields: Fields of the request message
+        :param fields: Fields of the reply
+        :param arrays: Arrays of the reply
+        :return: None
+        """
+        client.send(msg_type, dict(fields or {}, request_id=request_fields.get('request_id')), arrays)
+
+    @staticmethod
+    def reply_to_client(client, request_fields, batch):
+        """
+        Sends labels of a finished batch to the front end client, with the neighbour ids if it asked for them, or
+        the error that failed the batch.
+        :param client: Connection
+        :param request_fields: Fields of the CLASSIFY_REQUEST message
+        :param batch: Finished QueryBatch
+        :return: None
+        """
+        if batch.future.exception() is not None:
+            client.send(MessageType.CLASSIFY_RESULT, {'request_id': request_fields.get('request_id'),
+                                                      'error': str(batch.future.exception())})
+            return
+        label_codes, label_table = encode_labels(batch.labels)
+        arrays = {'label_codes': label_codes}
+        if request_fields.get('neighbours'):
+            arrays['neighbour_ids'] = batch.neighbour_ids()
+        client.send(MessageType.CLASSIFY_RESULT, {'request_id': request_fields.get('request_id'),
+                                                  'label_table': label_table}, arrays)
+
+    @measure_phase('shutdown')
     def start_shutdown_phase(self):
         """
         Starts Shutdown Phase where all connections are closed
         :return:
         """
-        print('SHUTDOWN PHASE')
-        for connection in self.connections:
-            print('\t', 'Closing connection with', connection[1][0] + ':' + str(connection[1][1]))
-            connection[0].close()
+        logger.info('SHUTDOWN PHASE')
+        for slave in self.connections:
+            slave.send(MessageType.SHUTDOWN)
+        self.run_until(lambda: not any(slave.has_outgoing() for slave in self.connections))
+        for slave in self.connections:
+            logger.info('\t Closing connection with %s', slave)
+            self.unregister(slave)
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
         self.socket.close()
-        print('SHUTDOWN PHASE IS FINISHED')
-        print('Classified points:')
-        for point in self.points:
-            print(point.data, '->', point.label)
+        logger.info('SHUTDOWN PHASE IS FINISHED')
 
 
 if __name__ == '__main__':
@@ -202,7 +1928,56 @@ if __name__ == '__main__':
     parser.add_argument('--port', help='Set Master node port number')
     parser.add_argument('-k', help='Set number for k in kNN')
     parser.add_argument('-n', '--num-slaves', help='Set number of Slave nodes')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Set number of seconds a Slave may stay silent before it is considered failed')
+    parser.add_argument('--serve', help='Keep serving query batches at this address (host:port or unix:/path) '
+                                        'until a shutdown command is received')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='Set maximum number of query batches processed by Slaves at the same time')
+    parser.add_argument('--max-batch-size', type=int, default=0,
+                        help='Collect queries into micro-batches of up to this many queries, 0 disables it')
+    parser.add_argument('--max-batch-wait-ms', type=float, default=DEFAULT_MAX_BATCH_WAIT * 1000,
+                        help='Set maximum number of milliseconds queries wait in a micro-batch')
+    parser.add_argument('--index', choices=INDEX_TYPES, default=INDEX_AUTO,
+                        help='Set index built by Slaves over their shards')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS,
+                        help='Scan shards quantized to int8 or float16, re-ranking candidates at full precision')
+    parser.add_argument('--write-shards', help='Write every shard to this directory in the on-disk shard format')
+    parser.add_argument('--seed', type=int, default=0, help='Set seed of the dataset shuffle')
+    parser.add_argument('--fan-out', default=FAN_OUT_EXACT,
+                        help='Set number of candidates requested from every Slave: exact, adaptive or a number')
+    parser.add_argument('--nprobe', type=int,
+                        help='Search approximately, probing this many nearest IVF lists of every shard per query')
+    parser.add_argument('--pruning', action='store_true',
+                        help='Query Slaves in rounds of growing size, sending k-th distance bounds to later rounds')
+    parser.add_argument('--train', help='Stream the dataset from this CSV, .npy or .npz file to the Slaves')
+    parser.add_argument('--queries', help='Classify the points of this CSV, .npy or .npz file')
+    parser.add_argument('--label-column', type=int, default=-1,
+                        help='Set column of training CSV and .npy files that holds the labels (default last)')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS,
+                        help='Set number of rows read from dataset files at once')
+    parser.add_argument('--assignment', choices=ASSIGNMENTS, default=ASSIGN_HASH,
+                        help='Assign rows of the streamed dataset to Slaves round-robin or by a hash of their id')
+    parser.add_argument('--sizing', choices=SIZINGS, default=SIZING_CAPACITY,
+                        help='Size shards equally or by the capacity Slaves report, moving rows away from stragglers')
+    parser.add_argument('--replication', type=int, default=1,
+                        help='Set number of Slaves that store every shard, replicas take over when a Slave fails')
+    parser.add_argument('--hedge-percentile', type=float, default=DEFAULT_HEDGE_PERCENTILE,
+                        help='Also send a query to another replica once it takes longer than this percentile of '
+                             'recent round trips')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Cache results of this many queries on the Master, 0 disables the cache')
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES,
+                        help='Set maximum memory taken by cached query results')
+    parser.add_argument('--cache-precision', type=float,
+                        help='Round query coordinates to multiples of this value before looking them up in the cache')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='Set logging level, DEBUG logs every classified point')
+    parser.add_argument('--stats', action='append', default=[],
+                        help='Write statistics to this file at shutdown, in Prometheus text format if its name '
+                             'ends with .prom and as JSON otherwise, can be repeated')
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
     if args.host:
         host_arg = args.host
     if args.port:
@@ -212,17 +1987,36 @@ if __name__ == '__main__':
     if args.num_slaves:
         n = int(args.num_slaves)
 
-    master = MasterNode(dataset=[DataPoint([10, 100], '1'),
-                                 DataPoint([20, 90], '1'),
-                                 DataPoint([30, 80], '1'),
-                                 DataPoint([40, 70], '1'),
-                                 DataPoint([50, 60], '1'),
-                                 DataPoint([60, 50], '0'),
-                                 DataPoint([70, 40], '0'),
-                                 DataPoint([80, 30], '0'),
-                                 DataPoint([90, 20], '0'),
-                                 DataPoint([100, 10], '0')],
-                        points=[DataPoint([20, 50]),
-                                DataPoint([80, 50])],
-                        k=k_arg, host=host_arg, port=port_arg)
+    dataset_arg = [DataPoint([10, 100], '1'),
+                   DataPoint([20, 90], '1'),
+                   DataPoint([30, 80], '1'),
+                   DataPoint([40, 70], '1'),
+                   DataPoint([50, 60], '1'),
+                   DataPoint([60, 50], '0'),
+                   DataPoint([70, 40], '0'),
+                   DataPoint([80, 30], '0'),
+                   DataPoint([90, 20], '0'),
+                   DataPoint([100, 10], '0')]
+    points_arg = [DataPoint([20, 50]),
+                  DataPoint([80, 50])]
+    if args.train:
+        dataset_arg = DatasetFile(args.train, args.chunk_rows, args.label_column)
+        points_arg = None
+    if args.queries:
+        points_arg = DatasetFile(args.queries, args.chunk_rows, label_column=None).read()
+
+    master = MasterNode(dataset=dataset_arg, points=points_arg, k=k_arg, host=host_arg, port=port_arg,
+                        fan_out=args.fan_out, timeout=args.timeout, serve_address=args.serve,
+                        max_in_flight=args.max_in_flight, index_type=args.index, shard_directory=args.write_shards,
+                        shuffle_seed=args.seed, nprobe=args.nprobe, pruning=args.pruning, assignment=args.assignment,
+                        sizing=args.sizing, replication=args.replication, hedge_percentile=args.hedge_percentile,
+                        cache_size=args.cache_size, cache_bytes=args.cache_bytes,
+                        cache_precision=args.cache_precision, quantization=args.quantization,
+                        max_batch_size=args.max_batch_size, max_batch_wait=args.max_batch_wait_ms / 1000)
     master.run(n)
+    for path in args.stats:
+        master.metrics.write(path)
+    if master.points:
+        print('Classified points:')
+        for point in master.points:
+            print(point.data, '->', point.label)
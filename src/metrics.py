@@ -0,0 +1,268 @@
+"""
+Module contains instrumentation of the nodes: phase statistics, per-slave round trip and compute times, latency
+histograms, counters and rates, with JSON and Prometheus text exports.
+"""
+import bisect
+import functools
+import json
+import time
+
+# Upper bounds (in seconds) of latency histogram buckets: 100us doubling up to about 52 seconds
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(20))
+# Upper bounds of size histogram buckets: powers of two up to about a million
+SIZE_BUCKETS = tuple(2 ** i for i in range(21))
+TRAFFIC_KEYS = ('bytes_sent', 'bytes_received', 'messages_sent', 'messages_received')
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bucket bounds, so it takes constant memory however many values are observed
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS, unit='seconds'):
+        """
+        Constructor for Histogram.
+        :param bounds: Sorted upper bounds of the buckets, values above the last one go to an overflow bucket
+        :param unit: Unit of the values, which suffixes the exported metric name, or None for plain counts
+        """
+        self.bounds = tuple(bounds)
+        self.unit = unit
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value, count=1):
+        """
+        Records a value.
+        :param value: Observed value
+        :param count: Number of times the value was observed
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.sum += value * count
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Estimates a percentile as the upper bound of the bucket it falls into.
+        :param p: Percentile between 0 and 100
+        :return: estimated value, 0 if nothing was observed
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count in zip(self.bounds + (float('inf'),), self.counts)
+                            if count]}
+
+
+class Rate(object):
+    """
+    Number of events per second since the rate was started
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.started = None
+
+    def start(self):
+        if self.started is None:
+            self.started = time.perf_counter()
+
+    def add(self, count=1):
+        self.start()
+        self.count += count
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started if self.started is not None else 0.0
+
+    @property
+    def per_second(self):
+        seconds = self.seconds
+        return self.count / seconds if seconds > 0 else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'seconds': self.seconds, 'per_second': self.per_second}
+
+
+class PhaseStats(object):
+    """
+    Wall time and traffic of one phase
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.runs = 0
+        self.traffic = dict.fromkeys(TRAFFIC_KEYS, 0)
+
+    def to_dict(self):
+        return dict(self.traffic, seconds=self.seconds, runs=self.runs)
+
+
+class SlaveStats(object):
+    """
+    Round trip times of requests to one Slave, compute times it reported, its capacity and shard size
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.round_trip = Histogram()
+        self.compute = Histogram()
+        self.capacity = 0.0
+        self.shard_size = 0
+        self.compute_per_query = 0.0
+
+    def to_dict(self):
+        return {'requests': self.requests, 'round_trip_seconds': self.round_trip.to_dict(),
+                'compute_seconds': self.compute.to_dict(), 'capacity': self.capacity, 'shard_size': self.shard_size,
+                'compute_per_query_seconds': self.compute_per_query}
+
+
+class Metrics(object):
+    """
+    Statistics collected by one node
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.slaves = {}
+        self.histograms = {}
+        self.counters = {}
+        self.rates = {}
+
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseStats()
+        return self.phases[name]
+
+    def slave(self, name):
+        if name not in self.slaves:
+            self.slaves[name] = SlaveStats()
+        return self.slaves[name]
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, unit='seconds'):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds, unit)
+        return self.histograms[name]
+
+    def rate(self, name):
+        if name not in self.rates:
+            self.rates[name] = Rate()
+        return self.rates[name]
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {'phases': {name: phase.to_dict() for name, phase in self.phases.items()},
+                'slaves': {name: slave.to_dict() for name, slave in self.slaves.items()},
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'rates': {name: rate.to_dict() for name, rate in self.rates.items()}}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='knn'):
+        """
+        Formats the statistics in the Prometheus text exposition format.
+        :param prefix: Prefix of metric names
+        :return: str
+        """
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE ' + prefix + '_' + name + ' ' + kind)
+            for suffix, labels, value in samples:
+                label_text = ','.join(key + '="' + str(label).replace('"', '\\"') + '"' for key, label in labels)
+                lines.append(prefix + '_' + name + suffix + ('{' + label_text + '}' if label_text else '') + ' '
+                             + repr(float(value)))
+
+        def histogram_samples(histogram, labels):
+            samples = []
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', repr(bound))], cumulative))
+            samples.append(('_bucket', labels + [('le', '+Inf')], histogram.count))
+            samples.append(('_sum', labels, histogram.sum))
+            samples.append(('_count', labels, histogram.count))
+            return samples
+
+        metric('phase_seconds', 'gauge', [('', [('phase', name)], phase.seconds)
+                                          for name, phase in self.phases.items()])
+        for key in TRAFFIC_KEYS:
+            metric('phase_' + key, 'counter', [('', [('phase', name)], phase.traffic[key])
+                                               for name, phase in self.phases.items()])
+        metric('slave_requests', 'counter', [('', [('slave', name)], slave.requests)
+                                             for name, slave in self.slaves.items()])
+        metric('slave_round_trip_seconds', 'histogram',
+               [s for name, slave in self.slaves.items() for s in histogram_samples(slave.round_trip,
+                                                                                     [('slave', name)])])
+        metric('slave_compute_seconds', 'histogram',
+               [s for name, slave in self.slaves.items() for s in histogram_samples(slave.compute, [('slave', name)])])
+        for key, attribute in (('capacity', 'capacity'), ('shard_size', 'shard_size'),
+                               ('compute_per_query_seconds', 'compute_per_query')):
+            metric('slave_' + key, 'gauge', [('', [('slave', name)], getattr(slave, attribute))
+                                             for name, slave in self.slaves.items()])
+        for name, histogram in self.histograms.items():
+            suffix = '_' + histogram.unit if histogram.unit else ''
+            metric(name + suffix, 'histogram', histogram_samples(histogram, []))
+        for name, value in self.counters.items():
+            metric(name, 'counter', [('', [], value)])
+        for name, rate in self.rates.items():
+            metric(name + '_per_second', 'gauge', [('', [], rate.per_second)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the statistics to a file, in Prometheus text format if its name ends with .prom and as JSON otherwise.
+        :param path: Output file
+        :return: None
+        """
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+def measure_phase(name):
+    """
+    Decorator of node phase methods that records the wall time of the phase and, if the node has a traffic()
+    method returning totals of TRAFFIC_KEYS, the traffic of the phase into the node's metrics.
+    :param name: Name of the phase
+    :return: decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(node, *args, **kwargs):
+            traffic = getattr(node, 'traffic', None)
+            before = traffic() if traffic is not None else None
+            start = time.perf_counter()
+            try:
+                return method(node, *args, **kwargs)
+            finally:
+                phase = node.metrics.phase(name)
+                phase.seconds += time.perf_counter() - start
+                phase.runs += 1
+                if before is not None:
+                    after = traffic()
+                    for key in TRAFFIC_KEYS:
+                        phase.traffic[key] += after[key] - before[key]
+        return wrapper
+    return decorator
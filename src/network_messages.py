@@ -1,16 +1,264 @@
 """
-This module contains all messages that will be sent between Master and Slaves to establish connection and etc.
+This module contains the binary wire protocol used between Master and Slaves.
+Every message is sent as one frame:
+    header | meta | body
+header - magic bytes, protocol version, message type, meta length and body length
+meta   - UTF-8 JSON object with scalar fields and descriptors of the arrays stored in the body
+body   - raw NumPy array buffers, each one aligned to 8 bytes
 """
+import json
+import socket
+import struct
+import numpy as np
 
+MAGIC = b'KN'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBIQ')
+ALIGNMENT = 8
+# Largest meta and body accepted, so that a corrupt or foreign header cannot make the reader allocate any length
+MAX_META_BYTES = 1 << 26
+MAX_BODY_BYTES = 1 << 36
 
-class ClientMessages:
-    GREET_SERVER = b'Request for connection'
-    SEND_DATA_REQUEST = b'Ready to receive data'
-    READY = b'Ready'
-    REQUEST_FOR_K = b'Request for k'
-    SEND_CLASSIFICATION_DATA_REQUEST = b'Ready to send classified points'
 
+class MessageType:
+    GREET_SERVER = 1
+    GREET_CLIENT = 2
+    DATA_BATCH = 3
+    DATA_RECEIVED = 4
+    QUERY_BATCH = 5
+    NEIGHBOURS = 6
+    SHUTDOWN = 7
+    CLASSIFY_REQUEST = 8
+    CLASSIFY_RESULT = 9
+    STATS = 10
+    DATA_CHUNK = 11
+    INSERT_POINTS = 12
+    DELETE_POINTS = 13
+    EXTRACT_POINTS = 14
+    REBALANCE = 15
+    DRAIN = 16
 
-class ServerMessages:
-    GREET_CLIENT = b'Connection established'
-    ALLOW_PROCEED = b'Allowing, proceed'
+
+class ProtocolError(Exception):
+    """
+    Raised when a received frame does not follow the protocol
+    """
+
+
+class Message(object):
+    """
+    Decoded message: its type, scalar fields and named arrays
+    """
+
+    def __init__(self, msg_type, fields=None, arrays=None, size=0):
+        """
+        Constructor for Message.
+        :param msg_type: One of MessageType values
+        :param fields: Dictionary of JSON serializable values
+        :param arrays: Dictionary of NumPy arrays
+        :param size: Size of the received frame in bytes
+        """
+        self.type = msg_type
+        self.fields = fields if fields is not None else {}
+        self.arrays = arrays if arrays is not None else {}
+        self.size = size
+
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+
+def encode_message(msg_type, fields=None, arrays=None):
+    """
+    Encodes message into a list of buffers that form one frame. Array data is not copied.
+    :param msg_type: One of MessageType values
+    :param fields: Dictionary of JSON serializable values
+    :param arrays: Dictionary of NumPy arrays
+    :return: list of bytes-like objects
+    """
+    descriptors = []
+    buffers = []
+    offset = 0
+    for name, array in (arrays or {}).items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ProtocolError('Array ' + name + ' has object dtype and cannot be sent')
+        descriptors.append({'name': name, 'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset})
+        buffers.append(array.reshape(-1).view(np.uint8))
+        offset += array.nbytes
+        pad = _padding(array.nbytes)
+        if pad:
+            buffers.append(bytes(pad))
+            offset += pad
+    meta = json.dumps({'fields': fields or {}, 'arrays': descriptors}).encode()
+    header = HEADER.pack(MAGIC, PROTOCOL_VERSION, msg_type, len(meta), offset)
+    return [header, meta] + buffers
+
+
+def unpack_header(buffer):
+    """
+    Unpacks and validates a frame header before any of the meta or body is read.
+    :param buffer: HEADER.size bytes
+    :return: header tuple of (magic, version, message type, meta length, body length)
+    """
+    header = HEADER.unpack(buffer)
+    magic, version, _, meta_size, body_size = header
+    if magic != MAGIC:
+        raise ProtocolError('Unexpected magic bytes ' + repr(magic))
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError('Unsupported protocol version ' + str(version))
+    if meta_size > MAX_META_BYTES or body_size > MAX_BODY_BYTES:
+        raise ProtocolError('Frame of ' + str(meta_size) + ' meta and ' + str(body_size) + ' body bytes is too large')
+    return header
+
+
+def decode_message(header, meta, body):
+    """
+    Decodes one frame. Arrays are views into the body buffer.
+    :param header: Header tuple returned by unpack_header
+    :param meta: Meta bytes
+    :param body: Body buffer
+    :return: Message
+    """
+    msg_type = header[2]
+    meta_bytes = meta
+    meta = json.loads(bytes(meta).decode())
+    arrays = {}
+    for descriptor in meta['arrays']:
+        dtype = np.dtype(descriptor['dtype'])
+        shape = tuple(descriptor['shape'])
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays[descriptor['name']] = np.frombuffer(body, dtype, count, descriptor['offset']).reshape(shape)
+    return Message(msg_type, meta['fields'], arrays, HEADER.size + len(meta_bytes) + len(body))
+
+
+def set_no_delay(sock):
+    """
+    Disables Nagle's algorithm on TCP sockets. Frames are written as several buffers, so without it the last buffer
+    of a small message waits for the acknowledgement of the previous one.
+    :param sock: Socket
+    :return: None
+    """
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_message(sock, msg_type, fields=None, arrays=None):
+    """
+    Sends one message over the socket.
+    :param sock: Connected socket
+    :param msg_type: One of MessageType values
+    :param fields: Dictionary of JSON serializable values
+    :param arrays: Dictionary of NumPy arrays
+    :return: number of bytes sent
+    """
+    sent = 0
+    for buffer in encode_message(msg_type, fields, arrays):
+        sock.sendall(buffer)
+        sent += memoryview(buffer).nbytes
+    return sent
+
+
+def recv_exactly(sock, size):
+    """
+    Receives exactly size bytes from the socket.
+    :param sock: Connected socket
+    :param size: Number of bytes to receive
+    :return: bytearray with received data
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Connection closed while receiving message')
+        received += n
+    return buffer
+
+
+def recv_message(sock, expected_type=None):
+    """
+    Receives one message from the socket.
+    :param sock: Connected socket
+    :param expected_type: If set, ProtocolError is raised for messages of any other type
+    :return: Message
+    """
+    header = unpack_header(recv_exactly(sock, HEADER.size))
+    meta = recv_exactly(sock, header[3])
+    body = recv_exactly(sock, header[4])
+    message = decode_message(header, meta, body)
+    if expected_type is not None and message.type != expected_type:
+        raise ProtocolError('Expected message ' + str(expected_type) + ' but received ' + str(message.type))
+    return message
+
+
+def parse_address(address):
+    """
+    Parses a front end address: 'host:port' for TCP or 'unix:/path/to/socket' for a Unix socket.
+    :param address: Address string
+    :return: tuple of (socket family, socket address)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+class FrameReader(object):
+    """
+    Incremental reader of frames from a non-blocking socket
+    """
+
+    def __init__(self):
+        """
+        Constructor for FrameReader.
+        """
+        self.bytes_received = 0
+        self.closed = False
+        self._header = None
+        self._meta = None
+        self._start_section(HEADER.size)
+
+    def _start_section(self, size):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._received = 0
+
+    def _complete_section(self, messages):
+        if self._header is None:
+            self._header = unpack_header(self._buffer)
+            self._start_section(self._header[3])
+        elif self._meta is None:
+            self._meta = self._buffer
+            self._start_section(self._header[4])
+        else:
+            messages.append(decode_message(self._header, self._meta, self._buffer))
+            self._header = None
+            self._meta = None
+            self._start_section(HEADER.size)
+
+    def read(self, sock):
+        """
+        Reads all bytes that are currently available on the socket.
+        :param sock: Non-blocking connected socket
+        :return: list of Messages completed by the read
+        """
+        if self.closed:
+            raise ConnectionError('Connection closed while receiving message')
+        messages = []
+        while True:
+            while self._received == len(self._buffer):
+                self._complete_section(messages)
+            try:
+                n = sock.recv_into(self._view[self._received:])
+            except (BlockingIOError, InterruptedError):
+                return messages
+            if n == 0:
+                # Messages received before the connection was closed are still delivered
+                self.closed = True
+                if messages:
+                    return messages
+                raise ConnectionError('Connection closed while receiving message')
+            self._received += n
+            self.bytes_received += n
@@ -0,0 +1,162 @@
+"""
+Module contains a multi-core index that splits the shard into row ranges searched by a pool of workers.
+"""
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from knn_classifier import select_k_smallest
+from point_batch import split_sizes
+from spatial_index import build_index, choose_index_type, INDEX_AUTO
+
+WORKER_THREAD = 'thread'
+WORKER_PROCESS = 'process'
+WORKER_MODES = (WORKER_THREAD, WORKER_PROCESS)
+
+
+def split_rows(n, parts):
+    """
+    Splits n rows into contiguous ranges that differ by at most one row.
+    :param n: Number of rows
+    :param parts: Number of ranges
+    :return: list of (start, end) tuples
+    """
+    bounds = np.cumsum([0] + split_sizes(n, parts))
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(parts)]
+
+
+def share_matrix(matrix):
+    """
+    Makes the matrix available to worker processes without copying it per worker. Memory mapped shards are shared
+    through their file, any other matrix is copied once into shared memory.
+    :param matrix: [n x d] array
+    :return: tuple of (descriptor for attach_matrix, SharedMemory or None)
+    """
+    if isinstance(matrix, np.memmap) and matrix.filename is not None and matrix.flags.c_contiguous:
+        return ('file', matrix.filename, matrix.offset, matrix.shape, matrix.dtype.str), None
+    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+    memory = SharedMemory(create=True, size=max(1, matrix.nbytes))
+    np.ndarray(matrix.shape, matrix.dtype, buffer=memory.buf)[...] = matrix
+    return ('shm', memory.name, 0, matrix.shape, matrix.dtype.str), memory
+
+
+def attach_matrix(descriptor):
+    """
+    Opens the matrix shared with share_matrix in a worker process.
+    :param descriptor: Descriptor returned by share_matrix
+    :return: tuple of (matrix, SharedMemory or None)
+    """
+    kind, name, offset, shape, dtype = descriptor
+    if kind == 'file':
+        return np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=tuple(shape)), None
+    memory = SharedMemory(name=name)
+    return np.ndarray(tuple(shape), dtype, buffer=memory.buf), memory
+
+
+def worker_main(connection, descriptor, start, end, index_type, quantization=None):
+    """
+    Main loop of a worker process: builds the index over its row range and answers queries until it receives None.
+    """
+    matrix, memory = attach_matrix(descriptor)
+    index = build_index(index_type, matrix[start:end], quantization=quantization)
+    connection.send(True)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        queries, k, options = request
+        connection.send(index.query(queries, k, **options))
+    del index, matrix
+    if memory is not None:
+        memory.close()
+    connection.close()
+
+
+class ParallelIndex(object):
+    """
+    Index over a shard split into row ranges, one per worker. Every worker searches its range and their top-k are
+    merged locally. Workers are threads running NumPy/BLAS kernels that release the GIL, or processes that read the
+    shard from shared memory.
+    """
+
+    def __init__(self, index_type, matrix, norms=None, workers=2, mode=WORKER_THREAD, quantization=None):
+        """
+        Constructor for ParallelIndex.
+        :param index_type: Index built over every row range, one of spatial_index.INDEX_TYPES
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param norms: Optional precomputed squared norms of the points
+        :param workers: Number of workers
+        :param mode: WORKER_THREAD or WORKER_PROCESS
+        :param quantization: If set, every worker scans its row range quantized to 'int8' or 'float16'
+        """
+        if mode not in WORKER_MODES:
+            raise ValueError('Unknown worker mode ' + str(mode))
+        self.n = len(matrix)
+        self.mode = mode
+        self.ranges = split_rows(self.n, max(1, min(workers, self.n)))
+        if index_type == INDEX_AUTO:
+            index_type = choose_index_type(self.ranges[0][1], matrix.shape[1] if np.ndim(matrix) == 2 else 1)
+        self.index_type = index_type
+        self.pool = ThreadPoolExecutor(len(self.ranges))
+        self.indexes = []
+        self.processes = []
+        self.memory = None
+        if mode == WORKER_THREAD:
+            self.indexes = list(self.pool.map(
+                lambda r: build_index(index_type, matrix[r[0]:r[1]], norms[r[0]:r[1]] if norms is not None else None,
+                                      quantization),
+                self.ranges))
+            return
+        descriptor, self.memory = share_matrix(matrix)
+        context = multiprocessing.get_context('spawn')
+        for start, end in self.ranges:
+            parent, child = context.Pipe()
+            process = context.Process(target=worker_main,
+                                      args=(child, descriptor, start, end, index_type, quantization), daemon=True)
+            process.start()
+            child.close()
+            self.processes.append((process, parent))
+        for _, connection in self.processes:
+            connection.recv()
+
+    def __len__(self):
+        return self.n
+
+    def query_range(self, worker, queries, k, options):
+        if self.mode == WORKER_THREAD:
+            return self.indexes[worker].query(queries, k, **options)
+        connection = self.processes[worker][1]
+        connection.send((queries, k, options))
+        return connection.recv()
+
+    def query(self, queries, k, **options):
+        """
+        Finds k nearest shard points for every query.
+        :param queries: [m x d] array of query points
+        :param k: number of neighbours to return
+        :param options: Search options passed to the index of every worker, e.g. nprobe of IVF indexes
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float64)
+        results = list(self.pool.map(lambda w: self.query_range(w, queries, k, options), range(len(self.ranges))))
+        indices = np.hstack([i + start for (i, _), (start, _) in zip(results, self.ranges)])
+        distances = np.hstack([d for _, d in results])
+        indices, distances = select_k_smallest(distances, indices, min(k, self.n))
+        order = np.lexsort((indices, distances))
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def close(self):
+        """
+        Stops the workers and releases shared memory.
+        :return: None
+        """
+        for process, connection in self.processes:
+            connection.send(None)
+            process.join()
+            connection.close()
+        self.processes = []
+        self.pool.shutdown()
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
@@ -0,0 +1,207 @@
+"""
+Module that contains the columnar representation of many data points.
+"""
+import numpy as np
+from data_point import DataPoint
+
+
+def split_sizes(total, parts):
+    """
+    Splits total number of points into parts that differ by at most one point.
+    :param total: Number of points
+    :param parts: Number of parts
+    :return: list of part sizes
+    """
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def weighted_split_sizes(total, weights, priority=None):
+    """
+    Splits total number of points into parts proportional to the weights. Parts with the largest fractional shares
+    get the remaining points, ties go to parts with higher priority and then to the first parts.
+    :param total: Number of points
+    :param weights: Positive weight of every part
+    :param priority: Optional priority of every part
+    :return: list of part sizes
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    quotas = total * weights / weights.sum()
+    sizes = np.floor(quotas).astype(np.int64)
+    # Quotas of equal weights are equal, so rounding errors cannot reorder them
+    fractions = np.round(quotas - sizes, 9)
+    ties = -np.asarray(priority) if priority is not None else np.arange(len(sizes))
+    sizes[np.lexsort((ties, -fractions))[:total - sizes.sum()]] += 1
+    return sizes.tolist()
+
+
+def encode_labels(labels):
+    """
+    Encodes labels as integer codes and a lookup table.
+    :param labels: Sequence of labels
+    :return: tuple of (int32 array of codes, list of distinct labels)
+    """
+    table = {}
+    codes = np.fromiter((table.setdefault(label, len(table)) for label in labels), dtype=np.int32,
+                        count=len(labels))
+    return codes, list(table)
+
+
+def decode_labels(codes, table):
+    """
+    Decodes labels encoded with encode_labels.
+    :param codes: Array of codes
+    :param table: List of distinct labels
+    :return: object array of labels with the same shape as codes
+    """
+    lookup = np.empty(len(table), dtype=object)
+    lookup[:] = table
+    return lookup[np.asarray(codes)]
+
+
+class PointBatch(object):
+    """
+    Batch of data points stored by columns: one feature matrix, an int64 id array and label codes with a lookup
+    table. Slices share memory with the batch, so a dataset can be split into shards without copying it.
+    """
+
+    def __init__(self, points, ids=None, label_codes=None, label_table=None):
+        """
+        Constructor for PointBatch.
+        :param points: [n x d] feature matrix, kept as it is if it already is a floating point array
+        :param ids: [n] array of point ids, row numbers by default
+        :param label_codes: [n] array of label codes, all points are unlabelled by default
+        :param label_table: List of distinct labels the codes refer to
+        """
+        if not isinstance(points, np.ndarray) or points.dtype.kind != 'f':
+            points = np.array(points, dtype=np.float64)
+        if points.ndim == 1:
+            points = points.reshape(len(points), -1 if len(points) else 0)
+        self.points = points
+        self.ids = ids if ids is not None else np.arange(len(points), dtype=np.int64)
+        if label_codes is None:
+            label_codes, label_table = np.zeros(len(points), dtype=np.int32), [None]
+        self.label_codes = label_codes
+        self.label_table = label_table
+
+    @classmethod
+    def from_labels(cls, points, labels=None, ids=None):
+        """
+        Builds the batch from a feature matrix and a sequence of labels.
+        :param points: [n x d] feature matrix
+        :param labels: Optional sequence of n labels
+        :param ids: Optional [n] array of point ids
+        :return: PointBatch
+        """
+        if labels is None:
+            return cls(points, ids)
+        label_codes, label_table = encode_labels(labels)
+        return cls(points, ids, label_codes, label_table)
+
+    @classmethod
+    def from_data_points(cls, points):
+        """
+        Builds the batch from a list of DataPoints. Their ids are replaced with row numbers.
+        :param points: List of DataPoints
+        :return: PointBatch
+        """
+        matrix = np.array([point.data for point in points], dtype=np.float64)
+        return cls.from_labels(matrix, [point.label for point in points])
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Joins batches into one, merging their label tables.
+        :param batches: List of PointBatches with the same number of features
+        :return: PointBatch
+        """
+        if not batches:
+            return cls(np.empty((0, 0)))
+        table = {}
+        codes = []
+        for batch in batches:
+            lookup = np.array([table.setdefault(label, len(table)) for label in batch.label_table], dtype=np.int32)
+            codes.append(lookup[np.asarray(batch.label_codes)] if len(lookup) else np.asarray(batch.label_codes))
+        return cls(np.concatenate([batch.points for batch in batches]),
+                   np.concatenate([batch.ids for batch in batches]), np.concatenate(codes).astype(np.int32),
+                   list(table))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, index):
+        """
+        Returns a DataPoint view of one point, a zero-copy batch for a slice or a copied batch for an index array.
+        """
+        if isinstance(index, slice):
+            return PointBatch(self.points[index], self.ids[index], self.label_codes[index], self.label_table)
+        if np.ndim(index) == 0:
+            return DataPoint(self.points[index], self.label_table[self.label_codes[index]], int(self.ids[index]))
+        return self.take(index)
+
+    @property
+    def labels(self):
+        return decode_labels(self.label_codes, self.label_table)
+
+    def take(self, indices):
+        """
+        Copies the points at the given indices into a new batch.
+        :param indices: Array of row indices
+        :return: PointBatch
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return PointBatch(self.points[indices], np.asarray(self.ids)[indices], np.asarray(self.label_codes)[indices],
+                          self.label_table)
+
+    def shuffle(self, seed=0):
+        """
+        Shuffles the points by applying one random permutation to every column.
+        :param seed: Seed of the permutation
+        :return: shuffled PointBatch
+        """
+        return self.take(np.random.default_rng(seed).permutation(len(self)))
+
+    def split(self, parts, sizes=None):
+        """
+        Splits the batch into contiguous parts without copying it.
+        :param parts: Number of parts
+        :param sizes: Sizes of the parts, by default they differ by at most one point
+        :return: list of PointBatches
+        """
+        bounds = np.cumsum([0] + list(sizes if sizes is not None else split_sizes(len(self), parts)))
+        return [self[int(bounds[i]):int(bounds[i + 1])] for i in range(parts)]
+
+    def with_labels(self, labels):
+        """
+        Returns the same points and ids with new labels.
+        :param labels: Sequence of labels
+        :return: PointBatch
+        """
+        label_codes, label_table = encode_labels(labels)
+        return PointBatch(self.points, self.ids, label_codes, label_table)
+
+
+def as_point_batch(points):
+    """
+    Converts points to a PointBatch.
+    :param points: PointBatch, list of DataPoints or [n x d] array of unlabelled points
+    :return: PointBatch
+    """
+    if isinstance(points, PointBatch):
+        return points
+    if len(points) and isinstance(points[0], DataPoint):
+        return PointBatch.from_data_points(points)
+    return PointBatch(points)
+
+
+def as_query_matrix(points):
+    """
+    Converts query points to a feature matrix.
+    :param points: PointBatch, list of DataPoints or [m x d] array of query points
+    :return: [m x d] float64 array
+    """
+    if isinstance(points, PointBatch):
+        return np.ascontiguousarray(points.points, dtype=np.float64)
+    return np.array([point.data if isinstance(point, DataPoint) else point for point in points], dtype=np.float64)
@@ -0,0 +1,203 @@
+"""
+Module contains scalar quantized shards. Every dimension is mapped by its own offset and scale to [0, 255] and stored
+as int8, or to [0, 1] and stored as float16, which takes 8 or 4 times less memory than float64. Queries scan the
+compact codes for a candidate set larger than k and re-rank it with the full-precision points, which may stay memory
+mapped on disk. The largest quantization error of any point bounds how far the scan can be off, so the candidate set
+is enlarged until the result is provably the exact k nearest.
+"""
+import logging
+import math
+import numpy as np
+from knn_classifier import ShardEngine, DEFAULT_BLOCK_BYTES, QUERY_BLOCK_SIZE
+
+QUANTIZATION_FLOAT16 = 'float16'
+QUANTIZATION_INT8 = 'int8'
+QUANTIZATIONS = (QUANTIZATION_FLOAT16, QUANTIZATION_INT8)
+INT8_LEVELS = 255
+# Candidates scanned for every neighbour, and the number of extra candidates scanned for small k
+DEFAULT_RERANK = 2.0
+MIN_RERANK_EXTRA = 8
+# Upper bound (in bytes) for full-precision rows quantized at once, so that memory mapped shards are never read whole
+# into memory
+ENCODE_CHUNK_BYTES = 1 << 26
+
+logger = logging.getLogger(__name__)
+
+
+class ScalarQuantizer(object):
+    """
+    Maps every dimension by its own offset and scale to int8 or float16 codes
+    """
+
+    def __init__(self, offset, scale, quantization=QUANTIZATION_INT8):
+        """
+        Constructor for ScalarQuantizer.
+        :param offset: [d] array of values mapped to the smallest code
+        :param scale: [d] array of value differences of consecutive int8 codes, or value ranges mapped to [0, 1]
+        :param quantization: 'int8' or 'float16'
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError('Unknown quantization ' + str(quantization))
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.quantization = quantization
+
+    @classmethod
+    def fit(cls, matrix, quantization=QUANTIZATION_INT8):
+        """
+        Chooses offsets and scales that cover the range of every dimension.
+        :param matrix: [n x d] array of points, may be memory mapped
+        :param quantization: 'int8' or 'float16'
+        :return: ScalarQuantizer
+        """
+        if not len(matrix):
+            return cls(np.zeros(matrix.shape[1]), np.ones(matrix.shape[1]), quantization)
+        low = np.asarray(matrix.min(axis=0), dtype=np.float64)
+        scale = np.asarray(matrix.max(axis=0), dtype=np.float64) - low
+        if quantization == QUANTIZATION_INT8:
+            scale /= INT8_LEVELS
+        scale[scale == 0] = 1.0
+        return cls(low, scale, quantization)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.int8 if self.quantization == QUANTIZATION_INT8 else np.float16)
+
+    def encode(self, points):
+        """
+        Quantizes points.
+        :param points: [n x d] array of points
+        :return: [n x d] int8 or float16 array of codes
+        """
+        units = (np.asarray(points, dtype=np.float64) - self.offset) / self.scale
+        if self.quantization == QUANTIZATION_INT8:
+            return (np.clip(np.rint(units), 0, INT8_LEVELS) - 128).astype(np.int8)
+        return units.astype(np.float16)
+
+    def decode(self, codes):
+        """
+        Maps codes back to approximate points.
+        :param codes: [n x d] array of codes
+        :return: [n x d] float64 array
+        """
+        units = codes.astype(np.float64)
+        if self.quantization == QUANTIZATION_INT8:
+            units += 128
+        units *= self.scale
+        units += self.offset
+        return units
+
+
+class QuantizedIndex(ShardEngine):
+    """
+    Brute-force search over the scalar quantized shard with exact re-ranking against the full-precision points
+    """
+
+    def __init__(self, matrix, quantization=QUANTIZATION_INT8, rerank=DEFAULT_RERANK,
+                 block_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Constructor for QuantizedIndex.
+        :param matrix: [n x d] array of full-precision shard points, may be memory mapped. It is only read to
+                       quantize the shard and to re-rank candidates
+        :param quantization: 'int8' or 'float16'
+        :param rerank: Number of candidates scanned for every neighbour
+        :param block_bytes: Upper bound for memory used by one block of distances
+        """
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(len(matrix), -1 if len(matrix) else 0)
+        self.points = matrix
+        self.quantizer = ScalarQuantizer.fit(matrix, quantization)
+        self.rerank = rerank
+        self.block_bytes = block_bytes
+        self.labels = None
+        self.matrix = np.empty(matrix.shape, dtype=self.quantizer.dtype)
+        self.norms = np.empty(len(matrix))
+        # Largest distance between a point and its quantized copy
+        self.error = 0.0
+        self.norm_order = None
+        chunk = max(1, ENCODE_CHUNK_BYTES // (8 * max(1, matrix.shape[1])))
+        for start in range(0, len(matrix), chunk):
+            rows = np.asarray(matrix[start:start + chunk], dtype=np.float64)
+            codes = self.quantizer.encode(rows)
+            decoded = self.quantizer.decode(codes)
+            self.matrix[start:start + len(rows)] = codes
+            self.norms[start:start + len(rows)] = np.einsum('ij,ij->i', decoded, decoded)
+            decoded -= rows
+            self.error = max(self.error, float(np.sqrt(np.einsum('ij,ij->i', decoded, decoded).max())))
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.norms.nbytes
+
+    def block(self, start, end):
+        return self.quantizer.decode(self.matrix[start:end])
+
+    def gather(self, rows):
+        return self.quantizer.decode(self.matrix[rows])
+
+    def block_rows(self, queries, k):
+        """
+        Number of rows searched together. Every block is decoded to float64, so block_bytes bounds the decoded rows
+        together with their distances, and a single query never decodes the whole shard.
+        :param queries: Number of queries searched together
+        :param k: Number of neighbours, a block is never smaller
+        :return: rows
+        """
+        return max(k, self.block_bytes // (self.dtype.itemsize * (queries + self.matrix.shape[1])))
+
+    def query(self, queries, k, bounds=None):
+        """
+        Finds k nearest shard points for every query. The quantized shard is scanned for more candidates than k,
+        which are re-ranked by their exact distances. Points that were not scanned are at least as far as the last
+        candidate less the quantization error, queries whose k-th exact distance is farther scan twice as many.
+        :param queries: [m x d] array of query points (or a single [d] point)
+        :param k: number of neighbours to return
+        :param bounds: Distance bounds of the queries accepted by all indexes. The scan needs distances beyond them
+                       to know when the candidates are enough, so they are left to the caller
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        n, d = self.matrix.shape
+        queries = np.asarray(queries, dtype=np.float64)
+        queries = queries.reshape(-1, d) if d else np.atleast_2d(queries)
+        m = len(queries)
+        k = min(k, n)
+        indices = np.empty((m, k), dtype=np.int64)
+        distances = np.empty((m, k), dtype=np.float64)
+        if k == 0 or m == 0:
+            return indices, distances
+        rows = np.arange(m)
+        candidates = min(n, max(k + MIN_RERANK_EXTRA, int(math.ceil(k * self.rerank))))
+        while len(rows):
+            scanned_i, scanned_d = ShardEngine.query(self, queries[rows], candidates)
+            exact_i, exact_d = self.rank_exactly(queries[rows], scanned_i, k)
+            done = scanned_d[:, -1] - self.error >= exact_d[:, -1] if candidates < n else np.ones(len(rows), bool)
+            indices[rows[done]] = exact_i[done]
+            distances[rows[done]] = exact_d[done]
+            rows = rows[~done]
+            if len(rows):
+                logger.debug('Scanning %d candidates again for %d queries', 2 * candidates, len(rows))
+            candidates = min(n, 2 * candidates)
+        return indices, distances
+
+    def rank_exactly(self, queries, candidates, k):
+        """
+        Computes exact distances to the candidates and keeps k nearest of them.
+        :param queries: [m x d] array of query points
+        :param candidates: [m x c] array of candidate indices
+        :param k: number of neighbours to return
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        distances = np.empty(candidates.shape)
+        for qs in range(0, len(queries), QUERY_BLOCK_SIZE):
+            block = candidates[qs:qs + QUERY_BLOCK_SIZE]
+            # Candidates are read in row order, which keeps reads of memory mapped shards sequential
+            rows, inverse = np.unique(block, return_inverse=True)
+            points = np.asarray(self.points[rows], dtype=np.float64)[inverse.reshape(block.shape)]
+            points -= queries[qs:qs + QUERY_BLOCK_SIZE, None, :]
+            distances[qs:qs + QUERY_BLOCK_SIZE] = np.sqrt(np.einsum('mcd,mcd->mc', points, points))
+        order = np.lexsort((candidates, distances))[:, :k]
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(distances, order, axis=1)
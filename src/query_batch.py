@@ -0,0 +1,139 @@
+"""
+This module contains the state of one batch of queries processed by the cluster.
+"""
+import time
+from concurrent.futures import Future
+import numpy as np
+from knn_classifier import get_majority_label, merge_candidates, to_candidates
+from point_batch import decode_labels
+
+
+class QueryBatch(object):
+    """
+    Batch of queries in flight: candidates gathered from every shard and the merged result
+    """
+
+    def __init__(self, queries, k, request_size, num_shards, nprobe=None):
+        """
+        Constructor for QueryBatch.
+        :param queries: [m x d] array of query points
+        :param k: Number of neighbours
+        :param request_size: Number of candidates requested from every shard for one query
+        :param num_shards: Number of shards, every one is answered by one of its replicas
+        :param nprobe: If set, Slaves search approximately, probing this many IVF lists for every query
+        """
+        self.queries = np.ascontiguousarray(queries, dtype=np.float64)
+        self.k = k
+        self.request_size = request_size
+        self.nprobe = nprobe
+        self.candidates = [[[] for _ in range(len(self.queries))] for _ in range(num_shards)]
+        self.neighbours = None
+        self.labels = None
+        self.error = None
+        self.future = Future()
+        self.created = time.perf_counter()
+
+    def __len__(self):
+        return len(self.queries)
+
+    def encode(self, query_ids=None, request_size=None, bounds=None):
+        """
+        Encodes the queries once so that they can be broadcast to many Slaves.
+        :param query_ids: Ids (indices) of the queries to send, all queries by default
+        :param request_size: Number of candidates to request, the batch request size by default
+        :param bounds: Optional [m] array of k-th distance bounds of all queries, Slaves then return only
+                       candidates within them
+        :return: tuple of (fields, arrays) of a QUERY_BATCH message
+        """
+        if query_ids is None:
+            query_ids = np.arange(len(self.queries), dtype=np.int64)
+        fields = {'k': request_size if request_size is not None else self.request_size}
+        if self.nprobe is not None:
+            fields['nprobe'] = self.nprobe
+        arrays = {'queries': self.queries[query_ids], 'ids': query_ids}
+        if bounds is not None:
+            arrays['bounds'] = bounds[query_ids]
+        return fields, arrays
+
+    def add_reply(self, shard_id, message):
+        """
+        Stores candidates received from a replica of one shard.
+        :param shard_id: Shard the replica stores
+        :param message: NEIGHBOURS message
+        :return: None
+        """
+        candidates = self.candidates[shard_id]
+        labels = decode_labels(message.arrays['label_codes'], message.fields['label_table'])
+        ids, distances = message.arrays['neighbour_ids'], message.arrays['distances']
+        if 'counts' in message.arrays:
+            # Rows pruned by bounds have different lengths and are sent concatenated
+            splits = np.cumsum(message.arrays['counts'])[:-1]
+            ids, distances, labels = np.split(ids, splits), np.split(distances, splits), np.split(labels, splits)
+        for query_id, row_ids, row_distances, row_labels in zip(message.arrays['query_ids'], ids, distances, labels):
+            candidates[query_id] = to_candidates(row_ids, row_distances, row_labels)
+
+    def merge(self, query_ids=None):
+        """
+        Merges candidates of all shards keeping exactly k nearest for every query.
+        :param query_ids: Queries to merge again, all queries by default
+        :return: None
+        """
+        if query_ids is None or self.neighbours is None:
+            self.neighbours = [merge_candidates([c[q] for c in self.candidates], self.k) for q in range(len(self))]
+            return
+        for q in query_ids:
+            self.neighbours[q] = merge_candidates([c[q] for c in self.candidates], self.k)
+
+    def bounds(self):
+        """
+        Upper bounds of the global k-th nearest distance of every query given the candidates merged so far.
+        :return: [m] array, infinite for queries with fewer than k candidates
+        """
+        return np.array([merged[-1].distance if len(merged) == self.k else np.inf for merged in self.neighbours])
+
+    def find_truncated(self, shard_sizes):
+        """
+        Correctness check for reduced fan-out. If the last candidate of a truncated shard list made it into the
+        global k nearest, the shard may hold more of them, so its full k candidates have to be requested.
+        :param shard_sizes: Number of points stored in every shard
+        :return: list with a list of query ids to request again for every shard
+        """
+        retries = []
+        for shard_candidates, shard_size in zip(self.candidates, shard_sizes):
+            if self.request_size >= self.k or shard_size <= self.request_size:
+                retries.append([])
+                continue
+            retries.append([q for q, merged in enumerate(self.neighbours)
+                            if len(merged) < self.k or shard_candidates[q][-1] <= merged[-1]])
+        return retries
+
+    def neighbour_ids(self):
+        """
+        Ids of the merged neighbours of every query, padded with -1 if fewer than k points were found.
+        :return: [m x k] int64 array
+        """
+        ids = np.full((len(self), self.k), -1, dtype=np.int64)
+        for row, neighbours in zip(ids, self.neighbours):
+            row[:len(neighbours)] = [neighbour.id for neighbour in neighbours]
+        return ids
+
+    def finish(self, labels=None):
+        """
+        Votes over the merged neighbours and resolves the future with the labels.
+        :param labels: Labels that are already known, for example cached ones, are used instead of voting
+        :return: None
+        """
+        if labels is None:
+            labels = [get_majority_label([n.label for n in neighbours]) if neighbours else None
+                      for neighbours in self.neighbours]
+        self.labels = labels
+        self.future.set_result(self.labels)
+
+    def fail(self, error):
+        """
+        Resolves the future with the error that prevented the batch from being answered.
+        :param error: Exception
+        :return: None
+        """
+        self.error = error
+        self.future.set_exception(error)
@@ -0,0 +1,114 @@
+"""
+Module contains the Master's cache of query results. Queries are keyed by a hash of their feature vector, exact or
+rounded to a precision so that near-duplicate vectors share their result, together with k and nprobe. Every result
+belongs to one version of the dataset: when points are inserted or deleted, the version changes and the cache is
+emptied.
+"""
+import hashlib
+import sys
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_CACHE_BYTES = 64 << 20
+# Size of the hash of a query vector
+DIGEST_BYTES = 16
+
+
+def entry_bytes(key, neighbours, label):
+    """
+    Approximate memory taken by one cached result. Labels are shared with the label tables and are not counted.
+    :param key: Cache key
+    :param neighbours: List of Candidates
+    :param label: Voted label
+    :return: number of bytes
+    """
+    size = sys.getsizeof(key) + DIGEST_BYTES + sys.getsizeof(neighbours) + sys.getsizeof(label)
+    return size + sum(sys.getsizeof(c) + sys.getsizeof(c.distance) + sys.getsizeof(c.id) for c in neighbours)
+
+
+class QueryCache(object):
+    """
+    Least recently used cache of merged neighbour lists and labels with caps on entries and memory
+    """
+
+    def __init__(self, max_entries, max_bytes=DEFAULT_CACHE_BYTES, precision=None):
+        """
+        Constructor for QueryCache.
+        :param max_entries: Maximum number of cached results
+        :param max_bytes: Maximum memory taken by cached results
+        :param precision: If set, query coordinates are rounded to multiples of it before they are hashed, so that
+                          vectors closer than the precision usually share their result
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self, queries, k, nprobe=None):
+        """
+        Computes the cache keys of a batch of queries.
+        :param queries: [m x d] float64 array of query points
+        :param k: Number of neighbours
+        :param nprobe: Number of probed IVF lists of approximate queries, None for exact ones
+        :return: list of keys
+        """
+        if self.precision is None:
+            # Adding zero turns -0.0 into 0.0, which has other bytes but the same neighbours
+            rows = np.ascontiguousarray(queries + 0.0, dtype=np.float64)
+        else:
+            rows = np.ascontiguousarray(np.round(queries / self.precision), dtype=np.int64)
+        return [(hashlib.blake2b(row.tobytes(), digest_size=DIGEST_BYTES).digest(), k, nprobe) for row in rows]
+
+    def get(self, key):
+        """
+        Looks up the result of a query and marks it as recently used.
+        :param key: Cache key
+        :return: tuple of (neighbours, label) or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[:2]
+
+    def put(self, key, neighbours, label, version):
+        """
+        Stores the result of a query, evicting the least recently used results beyond the caps. Results computed
+        for another version of the dataset are not stored.
+        :param key: Cache key
+        :param neighbours: Merged list of Candidates
+        :param label: Voted label
+        :param version: Dataset version the result was computed for
+        :return: number of evicted results
+        """
+        size = entry_bytes(key, neighbours, label)
+        if version != self.version or self.max_entries <= 0 or size > self.max_bytes:
+            return 0
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[2]
+        self.entries[key] = (neighbours, label, size)
+        self.bytes += size
+        evicted = 0
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.bytes -= self.entries.popitem(last=False)[1][2]
+            evicted += 1
+        return evicted
+
+    def invalidate(self, version):
+        """
+        Empties the cache after the dataset changed.
+        :param version: New dataset version
+        :return: None
+        """
+        self.version = version
+        self.entries.clear()
+        self.bytes = 0
+
+    def to_dict(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes, 'version': self.version}
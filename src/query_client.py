@@ -0,0 +1,189 @@
+"""
+This module contains a client for the Master node's query front end.
+"""
+import itertools
+import socket
+import numpy as np
+import network_messages as messages
+from network_messages import MessageType
+from point_batch import PointBatch, as_point_batch, as_query_matrix, decode_labels
+import argparse
+import json
+
+
+class QueryClient(object):
+    """
+    Client that sends query batches to a serving Master node
+    """
+
+    def __init__(self, address='localhost:1224'):
+        """
+        Constructor for QueryClient.
+        :param address: Front end address of the Master ('host:port' or 'unix:/path')
+        """
+        family, sockaddr = messages.parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(sockaddr)
+        messages.set_no_delay(self.socket)
+        self.request_ids = itertools.count(1)
+
+    def send_batch(self, points, k=None, nprobe=None, neighbours=False):
+        """
+        Sends a batch of points without waiting for the result, so several batches can be in flight.
+        :param points: PointBatch, list of DataPoints or [m x d] array of query points
+        :param k: Number of neighbours, Master's k by default
+        :param nprobe: Number of IVF lists probed by approximate search, Master's nprobe by default
+        :param neighbours: Ask the Master to send the ids of the neighbours together with the labels
+        :return: request id
+        """
+        queries = as_query_matrix(points)
+        request_id = next(self.request_ids)
+        fields = {'request_id': request_id}
+        if k is not None:
+            fields['k'] = k
+        if nprobe is not None:
+            fields['nprobe'] = nprobe
+        if neighbours:
+            fields['neighbours'] = True
+        messages.send_message(self.socket, MessageType.CLASSIFY_REQUEST, fields, {'points': queries})
+        return request_id
+
+    def receive_result(self, with_neighbours=False):
+        """
+        Receives the result of the next finished batch. Raises ValueError if the Master rejected the batch.
+        :param with_neighbours: Also return the neighbour ids, the batch must have been sent with neighbours=True
+        :return: tuple of (request id, list of labels) or (request id, list of labels, [m x k] neighbour ids)
+        """
+        message = messages.recv_message(self.socket, MessageType.CLASSIFY_RESULT)
+        if 'error' in message.fields:
+            raise ValueError('Batch ' + str(message.fields['request_id']) + ' failed: ' + message.fields['error'])
+        labels = decode_labels(message.arrays['label_codes'], message.fields['label_table'])
+        if with_neighbours:
+            return message.fields['request_id'], list(labels), message.arrays['neighbour_ids']
+        return message.fields['request_id'], list(labels)
+
+    def classify(self, points, k=None, nprobe=None):
+        """
+        Classifies a batch of points.
+        :param points: PointBatch, list of DataPoints or [m x d] array of query points
+        :param k: Number of neighbours, Master's k by default
+        :param nprobe: Number of IVF lists probed by approximate search, Master's nprobe by default
+        :return: list of labels
+        """
+        request_id = self.send_batch(points, k, nprobe)
+        results = {}
+        while request_id not in results:
+            received_id, labels = self.receive_result()
+            results[received_id] = labels
+        return results[request_id]
+
+    def stats(self):
+        """
+        Requests statistics of the Master. Must not be called while batches sent with send_batch are unanswered.
+        :return: dictionary returned by MasterNode.stats
+        """
+        return self.request(MessageType.STATS).fields['stats']
+
+    def request(self, msg_type, fields=None, arrays=None):
+        """
+        Sends one request and waits for its reply. Must not be called while batches sent with send_batch are
+        unanswered.
+        :return: reply Message
+        """
+        messages.send_message(self.socket, msg_type, dict(fields or {}, request_id=next(self.request_ids)), arrays)
+        return messages.recv_message(self.socket, msg_type)
+
+    def insert(self, points):
+        """
+        Inserts labelled points into the running cluster. Raises ValueError if the Master rejects the points.
+        :param points: PointBatch or list of DataPoints
+        :return: array of ids given to the points
+        """
+        batch = as_point_batch(points)
+        reply = self.request(MessageType.INSERT_POINTS, {'label_table': batch.label_table},
+                             {'points': batch.points, 'label_codes': batch.label_codes})
+        if 'error' in reply.fields:
+            raise ValueError(reply.fields['error'])
+        return reply.arrays['ids']
+
+    def delete(self, ids):
+        """
+        Deletes points from the running cluster. Raises ValueError if the Master rejects the ids.
+        :param ids: Ids of the points
+        :return: number of deleted points
+        """
+        reply = self.request(MessageType.DELETE_POINTS, arrays={'ids': np.asarray(ids, dtype=np.int64)})
+        if 'error' in reply.fields:
+            raise ValueError(reply.fields['error'])
+        return reply.fields['removed']
+
+    def rebalance(self):
+        """
+        Moves points between Slaves until their shard sizes differ by at most one point.
+        :return: number of moved points
+        """
+        return self.request(MessageType.REBALANCE).fields['moved']
+
+    def drain(self, slave):
+        """
+        Removes a Slave from the cluster, its points move to the other Slaves unless another replica holds them.
+        Raises ValueError if the Slave cannot leave.
+        :param slave: Address of the Slave, as in the statistics
+        :return: number of moved points
+        """
+        reply = self.request(MessageType.DRAIN, {'slave': slave})
+        if 'error' in reply.fields:
+            raise ValueError(reply.fields['error'])
+        return reply.fields['moved']
+
+    def shutdown(self):
+        """
+        Asks the Master to stop serving and shut the cluster down.
+        :return: None
+        """
+        messages.send_message(self.socket, MessageType.SHUTDOWN)
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', '-a', default='localhost:1224',
+                        help='Set Master front end address (host:port or unix:/path)')
+    parser.add_argument('--point', '-p', action='append', default=[],
+                        help='Point to classify as comma separated values, can be repeated')
+    parser.add_argument('-k', type=int, help='Set number for k in kNN')
+    parser.add_argument('--nprobe', type=int, help='Search approximately, probing this many IVF lists per query')
+    parser.add_argument('--insert', '-i', action='append', default=[],
+                        help='Point to insert as comma separated values followed by its label, can be repeated')
+    parser.add_argument('--delete', '-d', type=int, action='append', default=[],
+                        help='Id of a point to delete, can be repeated')
+    parser.add_argument('--rebalance', action='store_true', help='Even out shard sizes of the Slaves')
+    parser.add_argument('--drain', action='append', default=[],
+                        help='Address of a Slave that leaves the cluster, can be repeated')
+    parser.add_argument('--stats', action='store_true', help='Print statistics of the Master as JSON')
+    parser.add_argument('--shutdown', action='store_true', help='Shut the cluster down afterwards')
+    args = parser.parse_args()
+
+    client = QueryClient(args.address)
+    if args.insert:
+        rows = [point.split(',') for point in args.insert]
+        batch = PointBatch.from_labels([[float(value) for value in row[:-1]] for row in rows],
+                                       [row[-1] for row in rows])
+        print('Inserted points with ids', client.insert(batch).tolist())
+    if args.delete:
+        print('Deleted', client.delete(args.delete), 'points')
+    if args.rebalance:
+        print('Moved', client.rebalance(), 'points')
+    for slave in args.drain:
+        print('Slave', slave, 'left, moved', client.drain(slave), 'points')
+    if args.point:
+        points = [[float(value) for value in point.split(',')] for point in args.point]
+        for point, label in zip(points, client.classify(points, args.k, args.nprobe)):
+            print(point, '->', label)
+    if args.stats:
+        print(json.dumps(client.stats(), indent=2))
+    if args.shutdown:
+        client.shutdown()
+    client.close()
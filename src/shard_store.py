@@ -0,0 +1,160 @@
+"""
+Module contains the columnar on-disk format of shards. A shard is a directory with:
+    points.npy    - [n x d] feature matrix
+    norms.npy     - [n] squared norms of the points
+    ids.npy       - [n] int64 point ids
+    labels.npy    - [n] int32 label codes
+    manifest.json - format version, shard id, size, label lookup table and checksum
+Slaves open shards with np.memmap, so queries are served straight from the page cache and shards may be larger
+than RAM.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+from point_batch import PointBatch
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+CHECKSUM_CHUNK_BYTES = 1 << 24
+COPY_CHUNK_BYTES = 1 << 24
+
+
+class Shard(PointBatch):
+    """
+    Shard data: PointBatch of the shard points with their squared norms and the manifest
+    """
+
+    def __init__(self, points, ids, label_codes, label_table, norms=None, manifest=None):
+        """
+        Constructor for Shard.
+        :param points: [n x d] feature matrix
+        :param ids: [n] array of point ids
+        :param label_codes: [n] array of label codes
+        :param label_table: List of distinct labels
+        :param norms: Optional [n] array of squared norms of the points
+        :param manifest: Manifest of the shard if it is stored on disk
+        """
+        super().__init__(points, ids, label_codes, label_table)
+        self.norms = norms
+        self.manifest = manifest
+
+
+def _update_hash(digest, array):
+    flat = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    for start in range(0, len(flat), CHECKSUM_CHUNK_BYTES):
+        digest.update(flat[start:start + CHECKSUM_CHUNK_BYTES])
+
+
+def shard_checksum(points, ids, label_codes, label_table):
+    """
+    Computes checksum of the shard contents.
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([FORMAT_VERSION, np.shape(points), str(np.asarray(points).dtype),
+                              label_table]).encode())
+    for array in (points, ids, label_codes):
+        _update_hash(digest, array)
+    return digest.hexdigest()
+
+
+def write_shard(directory, shard_id, points, ids, label_codes, label_table, checksum=None):
+    """
+    Writes the shard to the directory, replacing any shard stored there.
+    :param directory: Shard directory
+    :param shard_id: Id of the shard
+    :param points: [n x d] feature matrix
+    :param ids: [n] array of point ids
+    :param label_codes: [n] array of label codes
+    :param label_table: List of distinct labels
+    :param checksum: Checksum of the shard if it is already known
+    :return: manifest
+    """
+    points = np.ascontiguousarray(points)
+    if points.ndim == 1:
+        points = points.reshape(len(points), -1 if len(points) else 0)
+    manifest = {'version': FORMAT_VERSION,
+                'shard_id': shard_id,
+                'count': len(ids),
+                'dim': points.shape[1],
+                'dtype': points.dtype.str,
+                'label_table': label_table,
+                'checksum': checksum if checksum is not None else shard_checksum(points, ids, label_codes,
+                                                                                 label_table)}
+    directory = os.path.abspath(directory)
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    np.save(os.path.join(temporary, 'points.npy'), points)
+    np.save(os.path.join(temporary, 'norms.npy'), np.einsum('ij,ij->i', points, points))
+    np.save(os.path.join(temporary, 'ids.npy'), np.asarray(ids, dtype=np.int64))
+    np.save(os.path.join(temporary, 'labels.npy'), np.asarray(label_codes, dtype=np.int32))
+    with open(os.path.join(temporary, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(temporary, directory)
+    return manifest
+
+
+def spill_points(points, directory=None, rows=None):
+    """
+    Moves points to a temporary file and memory maps them from it, for Slaves that keep a shard without a shard
+    directory but should not hold its full-precision points in memory, and for indexes that reorder a memory mapped
+    shard. The file is removed once the map is released.
+    :param points: [n x d] feature matrix, may be memory mapped
+    :param directory: Directory of the temporary file, the system default if None
+    :param rows: Optional array of the rows to write in their order, all rows by default
+    :return: [r x d] read-only memory mapped matrix
+    """
+    if points.ndim == 1:
+        points = points.reshape(len(points), -1 if len(points) else 0)
+    shape = (len(rows) if rows is not None else len(points), points.shape[1])
+    if not shape[0] or not shape[1]:
+        return np.empty(shape, dtype=points.dtype)
+    descriptor, path = tempfile.mkstemp(prefix='knn-points-', suffix='.bin', dir=directory)
+    os.close(descriptor)
+    spilled = np.memmap(path, dtype=points.dtype, mode='w+', shape=shape)
+    chunk = max(1, COPY_CHUNK_BYTES // (points.dtype.itemsize * shape[1]))
+    for start in range(0, shape[0], chunk):
+        spilled[start:start + chunk] = points[rows[start:start + chunk]] if rows is not None \
+            else points[start:start + chunk]
+    spilled.flush()
+    del spilled
+    spilled = np.memmap(path, dtype=points.dtype, mode='r', shape=shape)
+    weakref.finalize(spilled, os.remove, path)
+    return spilled
+
+
+def read_manifest(directory):
+    """
+    Reads the manifest of a shard.
+    :param directory: Shard directory
+    :return: manifest or None if there is no valid shard in the directory
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == FORMAT_VERSION else None
+
+
+def open_shard(directory):
+    """
+    Opens the shard stored in the directory with memory mapped arrays.
+    :param directory: Shard directory
+    :return: Shard
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError('No shard found in ' + str(directory))
+
+    def load(name):
+        return np.load(os.path.join(directory, name), mmap_mode='r')
+
+    return Shard(load('points.npy'), load('ids.npy'), load('labels.npy'), manifest['label_table'],
+                 load('norms.npy'), manifest)
@@ -1,26 +1,92 @@
 """
 This module contains everything needed for Slave node
 """
-from data_point import parse_data_point
+import logging
+import os
 import socket
+import time
+import numpy as np
 import network_messages as messages
-import knn_classifier
+from network_messages import MessageType
+import shard_store
+from live_shard import LiveShard
+from point_batch import PointBatch
+import spatial_index
+from parallel_index import ParallelIndex, WORKER_MODES, WORKER_THREAD
+from knn_classifier import ShardEngine
+from quantization import QuantizedIndex
+from metrics import Metrics, measure_phase
 import argparse
 
+# Shape of the synthetic shard and query block of the self-benchmark run during the handshake
+BENCHMARK_SHAPE = (8192, 32, 64)
+BENCHMARK_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+def measure_throughput(shape=BENCHMARK_SHAPE, seconds=BENCHMARK_SECONDS):
+    """
+    Quick self-benchmark of one core: brute-force search of a block of queries in a synthetic shard, repeated for
+    about the given time. BLAS may spread the search over several threads, so the work is divided by the CPU time
+    of the process rather than by the elapsed time.
+    :param shape: Tuple of (shard points, dimensions, queries)
+    :param seconds: Minimum time to measure
+    :return: distances computed per second of one core
+    """
+    rows, dimensions, queries = shape
+    rng = np.random.default_rng(0)
+    engine = ShardEngine(rng.random((rows, dimensions)))
+    block = rng.random((queries, dimensions))
+    repeats = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    while repeats == 0 or time.perf_counter() - start < seconds:
+        engine.query(block, 1)
+        repeats += 1
+    cpu_seconds = time.process_time() - cpu_start
+    return repeats * rows * queries / (cpu_seconds if cpu_seconds > 0 else time.perf_counter() - start)
+
+
+def physical_memory():
+    """
+    Size of the physical memory of the machine.
+    :return: bytes or None if the platform does not report it
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
 
 class SlaveNode(object):
     """
     Slave node class
     """
 
-    def __init__(self, master_host='localhost', master_port=1223):
+    def __init__(self, master_host='localhost', master_port=1223, shard_directory=None, workers=1,
+                 worker_mode=WORKER_THREAD):
         """
         Constructor for Master Node class.
         :param master_host: Host name at which Master node to which we want to connect will be located
         :param master_port: Port number at which Master node to which we want to connect will be located
+        :param shard_directory: If set, the received shard is stored in this directory and memory mapped from it,
+                                and a shard already stored there is offered to the Master so it is not sent again
+        :param workers: Number of cores the shard is searched with, each worker owns a contiguous range of rows
+        :param worker_mode: 'thread' or 'process' workers
         """
-        self.data = []
-        self.points_to_process = []
+        self.engine = None
+        self.approximate_engine = None
+        self.requested_index = spatial_index.INDEX_AUTO
+        self.quantization = None
+        self.approximate = False
+        self.shard = None
+        self.live = None
+        self.shard_directory = shard_directory
+        self.workers = workers
+        self.worker_mode = worker_mode
+        self.metrics = Metrics()
+        self.totals = dict.fromkeys(('bytes_sent', 'bytes_received', 'messages_sent', 'messages_received'), 0)
         self.host = master_host
         self.port = master_port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -31,94 +97,296 @@ class SlaveNode(object):
         self.start_classification_phase()
         self.start_shutdown_phase()
 
+    def send(self, msg_type, fields=None, arrays=None):
+        self.totals['bytes_sent'] += messages.send_message(self.socket, msg_type, fields, arrays)
+        self.totals['messages_sent'] += 1
+
+    def receive(self, expected_type=None):
+        message = messages.recv_message(self.socket, expected_type)
+        self.totals['bytes_received'] += message.size
+        self.totals['messages_received'] += 1
+        return message
+
+    def traffic(self):
+        return dict(self.totals)
+
+    @measure_phase('connection')
     def start_connection_phase(self):
         """
         Starts Connection phase where connection to master is established.
         :return: None
         """
-        print('CONNECTION PHASE')
+        logger.info('CONNECTION PHASE')
         self.socket.connect((self.host, self.port))
-        print('Starting handshake')
-        self.socket.send(messages.ClientMessages.GREET_SERVER)
-        data = self.socket.recv(1024)
-        print('Slave received:', data)
-        if data and data == messages.ServerMessages.GREET_CLIENT:
-            print('Handshake completed')
-        print('CONNECTION PHASE IS FINISHED')
+        messages.set_no_delay(self.socket)
+        logger.info('Starting handshake')
+        manifest = shard_store.read_manifest(self.shard_directory) if self.shard_directory else None
+        if manifest is not None:
+            logger.info('Offering stored shard %s with %d data points', manifest['shard_id'], manifest['count'])
+        throughput = measure_throughput()
+        logger.info('Measured %.3g distances per second per core', throughput)
+        self.send(MessageType.GREET_SERVER, {'shard': manifest, 'cores': os.cpu_count(), 'workers': self.workers,
+                                             'memory': physical_memory(), 'throughput': throughput})
+        self.receive(MessageType.GREET_CLIENT)
+        logger.info('Handshake completed')
+        logger.info('CONNECTION PHASE IS FINISHED')
 
+    @measure_phase('distribution')
     def start_data_collection_phase(self):
         """
         Starts Data Distribution Phase where dataset is received from the Master.
         :return: None
         """
-        print('DATA DISTRIBUTION PHASE')
-        self.socket.send(messages.ClientMessages.SEND_DATA_REQUEST)
-        data = self.socket.recv(1024)
-        if data:
-            batch_size = int(data.decode())
-            print('Ready to receive', batch_size, 'data points')
-            self.socket.send(messages.ClientMessages.READY)
-            self.data = []
-            for i in range(batch_size):
-                data = self.socket.recv(1024)
-                if not data:
-                    continue
-                self.data.append(parse_data_point(data.decode()))
-            print('Received points:', str([p.data for p in self.data]))
-        print('DATA DISTRIBUTION PHASE IS FINISHED')
+        logger.info('DATA DISTRIBUTION PHASE')
+        chunks = []
+        message = self.receive()
+        while message.type == MessageType.DATA_CHUNK:
+            chunks.append(PointBatch(message.arrays['points'], message.arrays['ids'], message.arrays['label_codes'],
+                                     message.fields['label_table']))
+            message = self.receive()
+        if message.type != MessageType.DATA_BATCH:
+            raise messages.ProtocolError('Expected message ' + str(MessageType.DATA_BATCH) + ' but received '
+                                         + str(message.type))
+        self.requested_index = message.fields.get('index', spatial_index.INDEX_AUTO)
+        self.quantization = message.fields.get('quantization')
+        self.approximate = bool(message.fields.get('approximate'))
+        if message.fields.get('streamed'):
+            self.shard = self.store_shard(message, PointBatch.concatenate(chunks))
+            logger.info('Received %d data points in %d chunks', len(self.shard), len(chunks))
+        elif message.fields.get('reuse'):
+            self.shard = shard_store.open_shard(self.shard_directory)
+            logger.info('Reusing stored shard with %d data points', len(self.shard))
+        else:
+            self.shard = self.store_shard(message, PointBatch(message.arrays['points'], message.arrays['ids'],
+                                                              message.arrays['label_codes'],
+                                                              message.fields['label_table']))
+            logger.info('Received %d data points', len(self.shard))
+        start = time.perf_counter()
+        self.live = LiveShard(self.shard)
+        self.build_engines()
+        self.send(MessageType.DATA_RECEIVED, {'request_id': message.fields.get('request_id'), 'count': len(self.shard),
+                                              'max_id': self.live.max_id,
+                                              'compute_seconds': time.perf_counter() - start})
+        logger.info('DATA DISTRIBUTION PHASE IS FINISHED')
+
+    def build_engines(self):
+        """
+        Builds the shard index, which also serves approximate queries if it is an IVF index. If the Master searches
+        approximately by default, the IVF index is built here as well, so that the first query does not wait for it.
+        :return: None
+        """
+        self.engine = self.build_engine(self.requested_index)
+        self.approximate_engine = self.engine if self.index_type(self.engine) == spatial_index.INDEX_IVF else None
+        if self.approximate and self.approximate_engine is None:
+            self.approximate_engine = self.build_engine(spatial_index.INDEX_IVF)
+
+    def close_engines(self):
+        for engine in {id(self.engine): self.engine, id(self.approximate_engine): self.approximate_engine}.values():
+            if isinstance(engine, ParallelIndex):
+                engine.close()
+
+    def build_engine(self, index_type):
+        """
+        Builds an index over the shard, split between workers if the Slave has more than one. Empty shards of Slaves
+        that joined a running cluster are searched by brute force until they are filled. With quantization, exact
+        indexes scan a quantized copy of the shard and read the full-precision points only to re-rank candidates.
+        :param index_type: One of spatial_index.INDEX_TYPES
+        :return: index
+        """
+        if not len(self.shard):
+            index_type = spatial_index.INDEX_BRUTE
+        if self.workers > 1 and len(self.shard) >= self.workers:
+            engine = ParallelIndex(index_type, self.shard.points, self.shard.norms, self.workers, self.worker_mode,
+                                   self.quantization)
+            logger.info('Built %s index over the shard for %d %s workers', engine.index_type, len(engine.ranges),
+                        self.worker_mode)
+        else:
+            engine = spatial_index.build_index(index_type, self.shard.points, self.shard.norms, self.quantization)
+            logger.info('Built %s over the shard', type(engine).__name__)
+        if isinstance(engine, QuantizedIndex):
+            logger.info('Quantized %d shard points to %s: %d bytes instead of %d', len(engine), self.quantization,
+                        engine.nbytes, engine.points.nbytes)
+        return engine
+
+    @staticmethod
+    def index_type(engine):
+        if isinstance(engine, ParallelIndex):
+            return engine.index_type
+        return spatial_index.INDEX_IVF if isinstance(engine, spatial_index.IVFIndex) else None
+
+    def store_shard(self, message, points):
+        """
+        Keeps the shard received from the Master, writing it to the shard directory if one is configured.
+        :param message: DATA_BATCH message
+        :param points: PointBatch of the shard
+        :return: Shard
+        """
+        shard = shard_store.Shard(points.points, points.ids, points.label_codes, points.label_table)
+        if self.shard_directory is None:
+            return self.spill_points(shard)
+        shard_store.write_shard(self.shard_directory, message.fields.get('shard_id'), shard.points, shard.ids,
+                                shard.label_codes, shard.label_table, message.fields.get('checksum'))
+        return shard_store.open_shard(self.shard_directory)
+
+    def spill_points(self, shard):
+        """
+        Quantized shards read their full-precision points only to re-rank candidates, so points that are not memory
+        mapped from the shard directory are moved to a temporary file and only the quantized copy stays in memory.
+        :param shard: Shard
+        :return: Shard
+        """
+        if self.quantization is None or isinstance(shard.points, np.memmap) or not len(shard):
+            return shard
+        logger.info('Moving %d bytes of full-precision points to a temporary file', shard.points.nbytes)
+        shard.points = shard_store.spill_points(shard.points)
+        return shard
 
+    @measure_phase('classification')
     def start_classification_phase(self):
         """
-        Starts Classification Phase where points are sent to Slave nodes for classification.
-        :return: Classification results
-        """
-        print('CLASSIFICATION PHASE')
-        self.socket.send(messages.ClientMessages.SEND_DATA_REQUEST)
-        data = self.socket.recv(1024)
-        if data:
-            batch_size = int(data.decode())
-            print('Ready to receive', batch_size, 'data points')
-            self.socket.send(messages.ClientMessages.READY)
-            self.points_to_process = []
-            for i in range(batch_size):
-                data = self.socket.recv(1024)
-                if not data:
-                    continue
-                self.points_to_process.append(parse_data_point(data.decode()))
-        for p in self.points_to_process:
-            print(p.data)
-        self.socket.send(messages.ClientMessages.REQUEST_FOR_K)
-        data = self.socket.recv(1024)
-        if data:
-            k = int(data.decode())
-            data = self.socket.recv(1024)
-            if data:
-                n = int(data.decode())
-                points_to_send = {}
-                print('Extracting', (k//n)+1, 'neighbouring points for each data point')
-                for point in self.points_to_process:
-                    neighbours = knn_classifier.get_neighbours(self.data, point, (k // n) + 1)
-                    points_to_send[point.id] = neighbours
-                self.socket.send(messages.ClientMessages.SEND_CLASSIFICATION_DATA_REQUEST)
-                data = self.socket.recv(1024)
-                if data and data == messages.ServerMessages.ALLOW_PROCEED:
-                    self.socket.send(str.encode(str(len(points_to_send.keys()))))
-                    for point in points_to_send.keys():
-                        self.socket.send(str.encode(str(len(points_to_send[point]))))
-                        self.socket.send(str.encode(str(point)))
-                        print('Sending neighbours for', point, str([p.label for p in points_to_send[point]]))
-                        for neighbour in points_to_send[point]:
-                            self.socket.send(str.encode(str(neighbour)))
-        print('CLASSIFICATION PHASE IS FINISHED')
+        Starts Classification Phase where query batches from the Master are answered until it requests shutdown.
+        :return: None
+        """
+        logger.info('CLASSIFICATION PHASE')
+        while True:
+            try:
+                message = self.receive()
+            except ConnectionError:
+                logger.warning('Master closed the connection')
+                break
+            if message.type == MessageType.SHUTDOWN:
+                break
+            if message.type == MessageType.QUERY_BATCH:
+                try:
+                    self.answer_query_batch(message)
+                except (ValueError, IndexError, KeyError) as error:
+                    # One malformed batch fails alone, the Master is told so that it does not wait for the reply
+                    logger.warning('Could not answer query batch: %s', error)
+                    self.send(MessageType.NEIGHBOURS, {'request_id': message.fields.get('request_id'),
+                                                       'error': str(error)})
+            elif message.type in (MessageType.INSERT_POINTS, MessageType.DELETE_POINTS):
+                try:
+                    self.update_shard(message)
+                except (ValueError, IndexError, KeyError, TypeError) as error:
+                    # One malformed update fails alone, the Master is told so that it does not wait for the reply
+                    logger.warning('Could not update the shard: %s', error)
+                    self.send(MessageType.DATA_RECEIVED, {'request_id': message.fields.get('request_id'),
+                                                          'count': len(self.live), 'removed': 0,
+                                                          'max_id': self.live.max_id, 'error': str(error)})
+            elif message.type == MessageType.EXTRACT_POINTS:
+                try:
+                    self.extract_points(message)
+                except (ValueError, IndexError, KeyError, TypeError) as error:
+                    logger.warning('Could not extract points: %s', error)
+                    empty = self.live.buffer[:0]
+                    self.send(MessageType.DATA_CHUNK, {'request_id': message.fields.get('request_id'),
+                                                       'count': len(self.live), 'label_table': self.live.label_table,
+                                                       'error': str(error)},
+                              {'points': empty.points, 'ids': empty.ids, 'label_codes': empty.label_codes})
+        logger.info('CLASSIFICATION PHASE IS FINISHED')
+
+    def answer_query_batch(self, message):
+        """
+        Finds nearest shard points for every query in the batch and sends them back with their distances. Batches
+        with nprobe are answered approximately by the IVF index. It is built with the shard index if the Master
+        searches approximately by default, otherwise on the first such batch.
+        :param message: QUERY_BATCH message
+        :return: None
+        """
+        k = message.fields['k']
+        nprobe = message.fields.get('nprobe')
+        queries = message.arrays['queries']
+        bounds = message.arrays.get('bounds')
+        logger.debug('Extracting %d neighbouring points for each of %d data points', k, len(queries))
+        start = time.perf_counter()
+        options = {'bounds': bounds} if bounds is not None else {}
+        if nprobe is None:
+            ids, distances, label_codes = self.live.query(self.engine, queries, k, **options)
+        else:
+            if self.approximate_engine is None:
+                self.approximate_engine = self.build_engine(spatial_index.INDEX_IVF)
+            ids, distances, label_codes = self.live.query(self.approximate_engine, queries, k, nprobe=nprobe,
+                                                          **options)
+        compute_seconds = time.perf_counter() - start
+        self.metrics.histogram('query_compute').observe(compute_seconds)
+        self.metrics.increment('queries', len(queries))
+        arrays = {'query_ids': message.arrays['ids']}
+        if bounds is not None or self.live.is_modified():
+            # Only candidates within the bounds can improve the Master's result and deleted points leave gaps, rows
+            # are sent as a ragged array
+            keep = np.isfinite(distances)
+            if bounds is not None:
+                keep &= distances <= bounds[:, None]
+                self.metrics.increment('pruned_candidates', int(np.count_nonzero(~keep)))
+            arrays['counts'] = np.count_nonzero(keep, axis=1)
+            ids, distances, label_codes = ids[keep], distances[keep], label_codes[keep]
+        arrays.update({'neighbour_ids': ids, 'distances': distances, 'label_codes': label_codes})
+        self.send(MessageType.NEIGHBOURS,
+                  {'request_id': message.fields.get('request_id'), 'label_table': self.live.label_table,
+                   'compute_seconds': compute_seconds}, arrays)
+
+    def update_shard(self, message):
+        """
+        Inserts points into the shard or deletes them from it, compacting the shard and rebuilding its index once
+        enough of it changed.
+        :param message: INSERT_POINTS or DELETE_POINTS message
+        :return: None
+        """
+        start = time.perf_counter()
+        removed = 0
+        if message.type == MessageType.INSERT_POINTS:
+            self.live.insert(PointBatch(message.arrays['points'], message.arrays['ids'], message.arrays['label_codes'],
+                                        message.fields['label_table']))
+            self.metrics.increment('inserted_points', len(message.arrays['ids']))
+        else:
+            removed = self.live.delete(message.arrays['ids'])
+            self.metrics.increment('deleted_points', removed)
+        if self.live.needs_compaction():
+            self.compact_shard()
+        self.send(MessageType.DATA_RECEIVED, {'request_id': message.fields.get('request_id'), 'count': len(self.live),
+                                              'removed': removed, 'max_id': self.live.max_id,
+                                              'compute_seconds': time.perf_counter() - start})
+
+    def extract_points(self, message):
+        """
+        Removes points from the shard and sends them to the Master, which moves them to another Slave. With the copy
+        flag all live points are sent and kept, so that the Master can make another replica of the shard.
+        :param message: EXTRACT_POINTS message with the number of points
+        :return: None
+        """
+        if message.fields.get('copy'):
+            batch = self.live.snapshot()
+        else:
+            batch = self.live.extract(message.fields['count'])
+            self.metrics.increment('extracted_points', len(batch))
+        if self.live.needs_compaction():
+            self.compact_shard()
+        self.send(MessageType.DATA_CHUNK, {'request_id': message.fields.get('request_id'), 'count': len(self.live),
+                                           'label_table': batch.label_table},
+                  {'points': batch.points, 'ids': batch.ids, 'label_codes': batch.label_codes})
+
+    def compact_shard(self):
+        """
+        Replaces the shard with its live points and rebuilds the index over them.
+        :return: None
+        """
+        logger.info('Compacting shard: %d buffered points, %d tombstones', len(self.live.buffer),
+                    self.live.tombstones)
+        self.close_engines()
+        self.shard = self.spill_points(self.live.compact())
+        self.build_engines()
+        self.metrics.increment('compactions')
 
+    @measure_phase('shutdown')
     def start_shutdown_phase(self):
         """
         Starts Shutdown Phase where connection is closed
         :return:
         """
-        print('SHUTDOWN PHASE')
+        logger.info('SHUTDOWN PHASE')
+        self.close_engines()
         self.socket.close()
-        print('SHUTDOWN PHASE IS FINISHED')
+        logger.info('SHUTDOWN PHASE IS FINISHED')
 
 
 if __name__ == '__main__':
@@ -128,11 +396,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--master-host', '-mh', help='Set Master node host name')
     parser.add_argument('--master-port', '-mp', help='Set Master node port number')
+    parser.add_argument('--shard-dir', help='Set directory where the shard is stored and memory mapped from')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Set number of cores used to search the shard')
+    parser.add_argument('--worker-mode', choices=WORKER_MODES, default=WORKER_THREAD,
+                        help='Search the shard with threads or with processes sharing it through shared memory')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='Set logging level, DEBUG logs every query batch')
+    parser.add_argument('--stats', action='append', default=[],
+                        help='Write statistics to this file at shutdown, in Prometheus text format if its name '
+                             'ends with .prom and as JSON otherwise, can be repeated')
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
     if args.master_host:
         host = args.master_host
     if args.master_port:
         port = int(args.master_port)
 
-    slave = SlaveNode(master_host=host, master_port=port)
+    slave = SlaveNode(master_host=host, master_port=port, shard_directory=args.shard_dir, workers=args.workers,
+                      worker_mode=args.worker_mode)
     slave.start_node()
+    for path in args.stats:
+        slave.metrics.write(path)
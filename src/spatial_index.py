@@ -0,0 +1,440 @@
+"""
+Module contains spatial indexes that can be built on a Slave's shard to speed up kNN queries.
+"""
+import math
+import os
+import numpy as np
+from knn_classifier import ShardEngine, select_k_smallest, DEFAULT_BLOCK_BYTES, QUERY_BLOCK_SIZE
+from quantization import QuantizedIndex
+import shard_store
+
+INDEX_AUTO = 'auto'
+INDEX_BRUTE = 'brute'
+INDEX_KD_TREE = 'kd_tree'
+INDEX_BALL_TREE = 'ball_tree'
+INDEX_IVF = 'ivf'
+INDEX_TYPES = (INDEX_AUTO, INDEX_BRUTE, INDEX_KD_TREE, INDEX_BALL_TREE, INDEX_IVF)
+
+DEFAULT_LEAF_SIZE = 128
+# Trees do not pay off for small shards or high dimensional data
+MIN_TREE_SHARD_SIZE = 8 * DEFAULT_LEAF_SIZE
+MAX_KD_TREE_DIMENSIONS = 8
+MAX_TREE_DIMENSIONS = 20
+
+# Number of inverted lists of the IVF index is this factor times the square root of the shard size
+IVF_LIST_FACTOR = 1.0
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+# k-means is trained on a sample of at most this many points per centroid
+KMEANS_SAMPLE_PER_CENTROID = 64
+# Upper bound (in bytes) for points read at once while an index is built, so that memory mapped shards are never read
+# whole into memory
+BUILD_CHUNK_BYTES = 1 << 26
+
+
+def row_chunks(matrix, rows):
+    """
+    Reads rows of a matrix in chunks of at most BUILD_CHUNK_BYTES.
+    :param matrix: [n x d] array, may be memory mapped
+    :param rows: Array of row indices
+    :return: generator of tuples of (offset in rows, [c x d] float64 array)
+    """
+    chunk = max(1, BUILD_CHUNK_BYTES // (8 * max(1, matrix.shape[1])))
+    for start in range(0, len(rows), chunk):
+        yield start, np.asarray(matrix[rows[start:start + chunk]], dtype=np.float64)
+
+
+def reorder(matrix, order):
+    """
+    Reorders the rows of the shard for an index. A memory mapped shard is reordered into a temporary file next to it
+    and stays memory mapped, any other matrix is reordered in memory.
+    :param matrix: [n x d] array, may be memory mapped
+    :param order: Array of row indices
+    :return: [n x d] reordered matrix
+    """
+    if isinstance(matrix, np.memmap) and matrix.filename is not None:
+        return shard_store.spill_points(matrix, os.path.dirname(matrix.filename), order)
+    return matrix[order]
+
+
+class TreeIndex(object):
+    """
+    Base class of the tree indexes. The shard is recursively split in halves until the nodes hold at most leaf_size
+    points, and the points are reordered so that every leaf is one contiguous block of the matrix. The reordered copy
+    of a memory mapped shard is memory mapped from a temporary file in the shard directory. Queries are answered in
+    batches: lower bounds to all leaves are computed at once, every query starts in its own leaf and then visits only
+    the leaves whose lower bound does not exceed its current k-th distance.
+    """
+
+    def __init__(self, matrix, leaf_size=DEFAULT_LEAF_SIZE, block_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Constructor for TreeIndex.
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param leaf_size: Maximum number of points in one leaf
+        :param block_bytes: Upper bound for memory used by the lower bounds of one query block
+        """
+        if not isinstance(matrix, np.memmap) or matrix.dtype != np.float64:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(len(matrix), -1 if len(matrix) else 0)
+        self.leaf_size = max(1, leaf_size)
+        self.block_bytes = block_bytes
+        self.order = np.arange(len(matrix), dtype=np.int64)
+        leaves = []
+        stack = [(0, len(matrix))] if len(matrix) else []
+        while stack:
+            start, end = stack.pop()
+            if end - start <= self.leaf_size:
+                leaves.append((start, end))
+                continue
+            rows = self.order[start:end]
+            mid = (end - start) // 2
+            self.order[start:end] = rows[np.argpartition(self.split_keys(matrix, rows), mid)]
+            stack.append((start + mid, end))
+            stack.append((start, start + mid))
+        self.matrix = reorder(matrix, self.order)
+        self.norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.leaves = np.array(sorted(leaves), dtype=np.int64).reshape(-1, 2)
+        self.build_leaf_geometry()
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def split_keys(self, matrix, rows):
+        """
+        Projects node points on the axis along which the node is split at the median.
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param rows: Array of s rows of the node points
+        :return: array of s keys
+        """
+        raise NotImplementedError
+
+    def build_leaf_geometry(self):
+        """
+        Computes bounding geometry of all leaves.
+        :return: None
+        """
+        raise NotImplementedError
+
+    def lower_bounds(self, queries):
+        """
+        Computes lower bounds of squared distances from queries to all leaves.
+        :param queries: [m x d] array of queries
+        :return: [m x L] array of squared lower bounds
+        """
+        raise NotImplementedError
+
+    def search_leaf(self, leaf, queries, query_norms, active, best_i, best_d, kth, limit=None):
+        """
+        Computes squared distances from active queries to the points of one leaf and updates their k nearest. The
+        k-th distances never exceed the optional squared distance limits of the queries.
+        """
+        start, end = self.leaves[leaf]
+        leaf_d = queries[active] @ self.matrix[start:end].T
+        leaf_d *= -2
+        leaf_d += query_norms[active, None]
+        leaf_d += self.norms[None, start:end]
+        np.maximum(leaf_d, 0, out=leaf_d)
+        leaf_i = np.broadcast_to(self.order[start:end], leaf_d.shape)
+        k = best_d.shape[1]
+        new_i, new_d = select_k_smallest(np.hstack((best_d[active], leaf_d)), np.hstack((best_i[active], leaf_i)), k)
+        best_i[active] = new_i
+        best_d[active] = new_d
+        kth[active] = new_d.max(axis=1) if limit is None else np.minimum(new_d.max(axis=1), limit[active])
+
+    def query(self, queries, k, bounds=None):
+        """
+        Finds k nearest shard points for every query.
+        :param queries: [m x d] array of query points (or a single [d] point)
+        :param k: number of neighbours to return
+        :param bounds: Optional [m] array of distances, neighbours farther than the bound of their query are not
+                       needed: leaves beyond it are skipped and missing neighbours have infinite distance
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        n, d = self.matrix.shape
+        queries = np.asarray(queries, dtype=np.float64)
+        queries = queries.reshape(-1, d) if d else np.atleast_2d(queries)
+        m = len(queries)
+        k = min(k, n)
+        indices = np.empty((m, k), dtype=np.int64)
+        distances = np.empty((m, k), dtype=np.float64)
+        if k == 0 or m == 0:
+            return indices, distances
+        limits = squared_limits(bounds, m)
+        block = max(1, min(QUERY_BLOCK_SIZE, self.block_bytes // (8 * len(self.leaves))))
+        for qs in range(0, m, block):
+            q = queries[qs:qs + block]
+            q_norms = np.einsum('ij,ij->i', q, q)
+            lower = self.lower_bounds(q)
+            best_i = np.full((len(q), k), n, dtype=np.int64)
+            best_d = np.full((len(q), k), np.inf)
+            limit = limits[qs:qs + block] if limits is not None else None
+            kth = limit.copy() if limit is not None else np.full(len(q), np.inf)
+            own = np.argmin(lower, axis=1)
+            for leaf in np.unique(own):
+                active = np.flatnonzero((own == leaf) & (lower[:, leaf] <= kth))
+                if len(active):
+                    self.search_leaf(leaf, q, q_norms, active, best_i, best_d, kth, limit)
+            for leaf in np.argsort(lower.min(axis=0), kind='stable'):
+                active = np.flatnonzero((lower[:, leaf] <= kth) & (own != leaf))
+                if len(active):
+                    self.search_leaf(leaf, q, q_norms, active, best_i, best_d, kth, limit)
+            order = np.lexsort((best_i, best_d))
+            indices[qs:qs + len(q)] = np.take_along_axis(best_i, order, axis=1)
+            distances[qs:qs + len(q)] = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+        return indices, distances
+
+
+class KDTreeIndex(TreeIndex):
+    """
+    KD-tree: nodes are split at the median of the dimension with the largest spread, leaves are bounded by boxes
+    """
+
+    def split_keys(self, matrix, rows):
+        low = np.full(matrix.shape[1], np.inf)
+        high = np.full(matrix.shape[1], -np.inf)
+        for _, points in row_chunks(matrix, rows):
+            np.minimum(low, points.min(axis=0), out=low)
+            np.maximum(high, points.max(axis=0), out=high)
+        return np.asarray(matrix[rows, np.argmax(high - low)], dtype=np.float64)
+
+    def build_leaf_geometry(self):
+        starts = self.leaves[:, 0]
+        self.lower = np.minimum.reduceat(self.matrix, starts, axis=0) if len(starts) else self.matrix[:0]
+        self.upper = np.maximum.reduceat(self.matrix, starts, axis=0) if len(starts) else self.matrix[:0]
+
+    def lower_bounds(self, queries):
+        bounds = np.zeros((len(queries), len(self.leaves)))
+        for j in range(queries.shape[1]):
+            q = queries[:, j, None]
+            diff = np.maximum(self.lower[None, :, j] - q, 0) + np.maximum(q - self.upper[None, :, j], 0)
+            bounds += diff * diff
+        return bounds
+
+
+class BallTreeIndex(TreeIndex):
+    """
+    Ball tree: nodes are split at the median of the projection on the line between two far apart points, leaves are
+    bounded by balls
+    """
+
+    def split_keys(self, matrix, rows):
+        a = self.farthest(matrix, rows, np.asarray(matrix[rows[0]], dtype=np.float64))
+        b = self.farthest(matrix, rows, a)
+        keys = np.empty(len(rows))
+        for start, points in row_chunks(matrix, rows):
+            keys[start:start + len(points)] = points @ (b - a)
+        return keys
+
+    @staticmethod
+    def farthest(matrix, rows, point):
+        """
+        Finds the node point farthest from a point.
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param rows: Array of rows of the node points
+        :param point: [d] array
+        :return: [d] array of the farthest point
+        """
+        best, best_distance = point, -1.0
+        for _, points in row_chunks(matrix, rows):
+            points = points - point
+            distances = np.einsum('ij,ij->i', points, points)
+            i = int(np.argmax(distances))
+            if distances[i] > best_distance:
+                best, best_distance = points[i] + point, distances[i]
+        return best
+
+    def build_leaf_geometry(self):
+        starts = self.leaves[:, 0]
+        sizes = self.leaves[:, 1] - starts
+        if not len(starts):
+            self.centers = self.matrix[:0]
+            self.radii = np.zeros(0)
+            return
+        self.centers = np.add.reduceat(self.matrix, starts, axis=0) / sizes[:, None]
+        # Squared distances of the points to the centers of their leaves, computed in chunks of whole leaves
+        squared = np.empty(len(self.matrix))
+        chunk = max(1, BUILD_CHUNK_BYTES // (8 * max(1, self.matrix.shape[1])))
+        first = 0
+        while first < len(starts):
+            last = max(first + 1, int(np.searchsorted(self.leaves[:, 1], starts[first] + chunk, side='right')))
+            start, end = starts[first], self.leaves[last - 1, 1]
+            diff = np.asarray(self.matrix[start:end]) - np.repeat(self.centers[first:last], sizes[first:last], axis=0)
+            squared[start:end] = np.einsum('ij,ij->i', diff, diff)
+            first = last
+        self.radii = np.sqrt(np.maximum.reduceat(squared, starts))
+        self.center_norms = np.einsum('ij,ij->i', self.centers, self.centers)
+
+    def lower_bounds(self, queries):
+        distances = queries @ self.centers.T
+        distances *= -2
+        distances += np.einsum('ij,ij->i', queries, queries)[:, None]
+        distances += self.center_norms[None, :]
+        bounds = np.maximum(np.sqrt(np.maximum(distances, 0)) - self.radii[None, :], 0)
+        return bounds * bounds
+
+
+def kmeans(matrix, clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Lloyd's k-means trained on a sample of the points.
+    :param matrix: [n x d] array of points
+    :param clusters: Number of centroids
+    :param iterations: Number of iterations
+    :param seed: Seed of the sampling and of the initial centroids
+    :return: [clusters x d] array of centroids
+    """
+    rng = np.random.default_rng(seed)
+    n = len(matrix)
+    sample = np.asarray(matrix[np.sort(rng.choice(n, min(n, clusters * KMEANS_SAMPLE_PER_CENTROID), replace=False))],
+                        dtype=np.float64)
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = ShardEngine(centroids).query(sample, 1)[0][:, 0]
+        counts = np.bincount(assignment, minlength=clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Empty clusters are moved to random sample points
+        centroids[~filled] = sample[rng.choice(len(sample), np.count_nonzero(~filled))]
+    return centroids
+
+
+class IVFIndex(TreeIndex):
+    """
+    Inverted file index for approximate search: shard points are clustered with k-means and every query searches only
+    the nprobe lists whose centroids are nearest to it. The lists are stored like tree leaves, as contiguous blocks of
+    the reordered matrix. Probing all lists gives the exact result.
+    """
+
+    def __init__(self, matrix, lists=None, block_bytes=DEFAULT_BLOCK_BYTES, seed=0):
+        """
+        Constructor for IVFIndex.
+        :param matrix: [n x d] array of shard points, may be memory mapped
+        :param lists: Number of inverted lists, IVF_LIST_FACTOR * sqrt(n) by default
+        :param block_bytes: Upper bound for memory used by one block of distances
+        :param seed: Seed of k-means
+        """
+        if not isinstance(matrix, np.memmap) or matrix.dtype != np.float64:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(len(matrix), -1 if len(matrix) else 0)
+        n = len(matrix)
+        lists = lists if lists is not None else int(math.ceil(IVF_LIST_FACTOR * math.sqrt(n)))
+        lists = max(1, min(lists, n))
+        self.block_bytes = block_bytes
+        if n:
+            self.centroids = kmeans(matrix, lists, seed=seed)
+            engine = ShardEngine(self.centroids)
+            assignment = np.concatenate([engine.query(points, 1)[0][:, 0]
+                                         for _, points in row_chunks(matrix, np.arange(n))])
+        else:
+            self.centroids = np.zeros((1, matrix.shape[1]))
+            assignment = np.zeros(0, dtype=np.int64)
+        self.order = np.argsort(assignment, kind='stable')
+        ends = np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))
+        self.leaves = np.stack((ends - np.bincount(assignment, minlength=len(self.centroids)), ends), axis=1)
+        self.matrix = reorder(matrix, self.order)
+        self.norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.centroid_engine = ShardEngine(self.centroids)
+
+    def query(self, queries, k, nprobe=None, bounds=None):
+        """
+        Finds approximately k nearest shard points for every query.
+        :param queries: [m x d] array of query points (or a single [d] point)
+        :param k: number of neighbours to return
+        :param nprobe: Number of nearest lists searched for every query, all lists (exact search) by default
+        :param bounds: Optional [m] array of distances, neighbours farther than the bound of their query are not
+                       needed and may be returned with infinite distance
+        :return: tuple of ([m x k] indices, [m x k] distances) sorted by distance
+        """
+        n, d = self.matrix.shape
+        queries = np.asarray(queries, dtype=np.float64)
+        queries = queries.reshape(-1, d) if d else np.atleast_2d(queries)
+        m = len(queries)
+        k = min(k, n)
+        lists = len(self.leaves)
+        nprobe = lists if nprobe is None else max(1, min(int(nprobe), lists))
+        indices = np.empty((m, k), dtype=np.int64)
+        distances = np.empty((m, k), dtype=np.float64)
+        if k == 0 or m == 0:
+            return indices, distances
+        limits = squared_limits(bounds, m)
+        block = max(1, min(QUERY_BLOCK_SIZE, self.block_bytes // (8 * lists)))
+        for qs in range(0, m, block):
+            q = queries[qs:qs + block]
+            q_norms = np.einsum('ij,ij->i', q, q)
+            probes = self.centroid_engine.query(q, nprobe)[0]
+            best_i = np.full((len(q), k), n, dtype=np.int64)
+            best_d = np.full((len(q), k), np.inf)
+            limit = limits[qs:qs + block] if limits is not None else None
+            kth = limit.copy() if limit is not None else np.full(len(q), np.inf)
+            # Group (query, list) pairs by list so that every probed list is scanned once per block
+            flat = probes.reshape(-1)
+            order = np.argsort(flat, kind='stable')
+            probing = np.repeat(np.arange(len(q)), nprobe)[order]
+            starts = np.searchsorted(flat[order], np.arange(lists + 1))
+            for leaf in np.flatnonzero(np.diff(starts)):
+                if self.leaves[leaf, 1] > self.leaves[leaf, 0]:
+                    self.search_leaf(leaf, q, q_norms, probing[starts[leaf]:starts[leaf + 1]], best_i, best_d, kth,
+                                     limit)
+            # Queries whose probed lists hold fewer than k points are answered exactly
+            short = np.flatnonzero(np.isinf(best_d[:, -1]) & np.isinf(kth))
+            if len(short) and nprobe < lists:
+                exact_i, exact_d = self.query(q[short], k)
+                best_i[short] = exact_i
+                best_d[short] = exact_d * exact_d
+            order = np.lexsort((best_i, best_d))
+            indices[qs:qs + len(q)] = np.take_along_axis(best_i, order, axis=1)
+            distances[qs:qs + len(q)] = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+        return indices, distances
+
+
+def squared_limits(bounds, m):
+    """
+    Converts distance bounds of queries into limits of squared distances.
+    :param bounds: Optional [m] array of distance bounds
+    :param m: Number of queries
+    :return: [m] array of squared limits or None
+    """
+    if bounds is None:
+        return None
+    bounds = np.broadcast_to(np.asarray(bounds, dtype=np.float64), (m,))
+    return bounds * bounds
+
+
+def choose_index_type(n, d):
+    """
+    Picks the index type for a shard in automatic mode.
+    :param n: Number of shard points
+    :param d: Number of dimensions
+    :return: one of INDEX_BRUTE, INDEX_KD_TREE, INDEX_BALL_TREE
+    """
+    if n < MIN_TREE_SHARD_SIZE or d > MAX_TREE_DIMENSIONS:
+        return INDEX_BRUTE
+    return INDEX_KD_TREE if d <= MAX_KD_TREE_DIMENSIONS else INDEX_BALL_TREE
+
+
+def build_index(index_type, matrix, norms=None, quantization=None, **kwargs):
+    """
+    Builds an index over the shard.
+    :param index_type: One of INDEX_TYPES
+    :param matrix: [n x d] array of shard points, may be memory mapped
+    :param norms: Optional precomputed squared norms of the points, used by brute force
+    :param quantization: If set, exact indexes scan the shard quantized to 'int8' or 'float16' and re-rank the
+                         candidates with the full-precision points, IVF indexes ignore it
+    :return: index with query(queries, k) method
+    """
+    if quantization is not None and index_type != INDEX_IVF:
+        return QuantizedIndex(matrix, quantization, **kwargs)
+    if index_type == INDEX_AUTO:
+        index_type = choose_index_type(len(matrix), matrix.shape[1] if np.ndim(matrix) == 2 else 1)
+    if index_type == INDEX_BRUTE:
+        return ShardEngine(matrix, norms=norms, **kwargs)
+    if index_type == INDEX_KD_TREE:
+        return KDTreeIndex(matrix, **kwargs)
+    if index_type == INDEX_BALL_TREE:
+        return BallTreeIndex(matrix, **kwargs)
+    if index_type == INDEX_IVF:
+        return IVFIndex(matrix, **kwargs)
+    raise ValueError('Unknown index type ' + str(index_type))
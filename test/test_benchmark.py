@@ -0,0 +1,33 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from benchmark.datasets import gaussian_blobs, train_test_split
+from benchmark.runner import run_benchmark, save_results
+
+
+class TestBenchmark(TestCase):
+
+    def test_gaussian_blobs_are_reproducible(self):
+        batch = gaussian_blobs(500, 4, classes=3, seed=7)
+        self.assertEqual(batch.points.shape, (500, 4))
+        self.assertEqual(sorted(set(batch.labels)), ['0', '1', '2'])
+        np.testing.assert_array_equal(gaussian_blobs(500, 4, classes=3, seed=7).points, batch.points)
+        train, test = train_test_split(batch, 50)
+        self.assertEqual((len(train), len(test)), (450, 50))
+        self.assertFalse(set(train.ids) & set(test.ids))
+
+    def test_run_benchmark_on_local_cluster(self):
+        result = run_benchmark(n=2000, d=3, k=5, slaves=2, queries=40, batch_size=4, pipeline=2)
+        self.assertEqual(sum(result['distribution']['shard_sizes']), 2000)
+        self.assertGreater(result['distribution']['bytes_sent'], 2000 * 3 * 8)
+        self.assertGreater(result['queries']['queries_per_second'], 0)
+        self.assertGreater(result['queries']['accuracy'], 0.5)
+        self.assertEqual(result['queries']['recall'], 1.0)
+        self.assertLessEqual(result['queries']['batch_latency_ms']['p50'], result['queries']['batch_latency_ms']['p99'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            save_results([result], path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)['runs'][0]['config']['slaves'], 2)
@@ -0,0 +1,68 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from dataset_file import *
+
+
+class TestDatasetFile(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(2)
+        self.points = rng.normal(size=(25, 3))
+        self.labels = np.array(['a', 'b', 'c'])[rng.integers(0, 3, 25)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def check(self, dataset, labelled=True):
+        chunks = list(dataset.chunks())
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        batch = dataset.read()
+        np.testing.assert_allclose(batch.points, self.points)
+        np.testing.assert_array_equal(batch.ids, np.arange(25))
+        if labelled:
+            self.assertEqual(list(batch.labels), list(self.labels))
+
+    def test_csv_with_header_and_label_column(self):
+        with open(self.path('train.csv'), 'w') as f:
+            f.write('label,x,y,z\n')
+            for label, point in zip(self.labels, self.points):
+                f.write(label + ',' + ','.join(str(value) for value in point) + '\n')
+        self.check(DatasetFile(self.path('train.csv'), chunk_rows=10, label_column=0))
+
+    def test_unlabelled_csv(self):
+        np.savetxt(self.path('queries.csv'), self.points, delimiter=',')
+        self.check(DatasetFile(self.path('queries.csv'), chunk_rows=10, label_column=None), labelled=False)
+
+    def test_npy_and_npz(self):
+        np.save(self.path('train.npy'), np.column_stack([self.points, (self.labels == 'b').astype(float)]))
+        batch = DatasetFile(self.path('train.npy'), chunk_rows=10).read()
+        np.testing.assert_array_equal(batch.points, self.points)
+        self.assertEqual(list(batch.labels), list((self.labels == 'b').astype(float)))
+        np.savez(self.path('train.npz'), points=self.points, labels=self.labels)
+        self.check(DatasetFile(self.path('train.npz'), chunk_rows=10))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            DatasetFile(self.path('train.txt'))
+
+    def test_assign_rows(self):
+        rows = np.arange(1000)
+        np.testing.assert_array_equal(assign_rows(rows, rows, 4, ASSIGN_ROUND_ROBIN)[:6], [0, 1, 2, 3, 0, 1])
+        owners = assign_rows(rows * 7, rows, 4, ASSIGN_HASH)
+        np.testing.assert_array_equal(owners[10:], assign_rows(rows[10:] * 7, rows[:-10], 4, ASSIGN_HASH))
+        self.assertGreater(np.bincount(owners, minlength=4).min(), 200)
+
+    def test_weighted_assign_rows(self):
+        rows = np.arange(1200)
+        owners = assign_rows(rows, rows, 3, ASSIGN_ROUND_ROBIN, [1, 0.5, 0.5])
+        np.testing.assert_array_equal(np.bincount(owners), [600, 300, 300])
+        owners = assign_rows(rows * 7, rows, 3, ASSIGN_HASH, [1, 0.5, 0.5])
+        counts = np.bincount(owners, minlength=3)
+        self.assertGreater(counts[0], 500)
+        self.assertGreater(counts[1:].min(), 230)
@@ -1,4 +1,5 @@
 from unittest import TestCase
+import numpy as np
 from data_point import DataPoint
 from knn_classifier import *
 
@@ -46,3 +47,63 @@ class TestKNNClassifier(TestCase):
         label2 = 'a'
         result2 = classify(points, new_point, k2)
         self.assertEqual(result2, label2, 'With 5 neighbours classification should result in "a" label')
+
+    def test_shard_engine_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.normal(size=(500, 7))
+        queries = rng.normal(size=(40, 7))
+        engine = ShardEngine(matrix, block_bytes=40 * 8 * 16)
+        indices, distances = engine.query(queries, 6)
+        expected = np.linalg.norm(queries[:, None, :] - matrix[None, :, :], axis=2)
+        expected_indices = np.argsort(expected, axis=1, kind='stable')[:, :6]
+        np.testing.assert_array_equal(indices, expected_indices)
+        np.testing.assert_allclose(distances, np.take_along_axis(expected, expected_indices, axis=1))
+
+    def test_shard_engine_skips_blocks_beyond_bounds(self):
+        rng = np.random.default_rng(4)
+        matrix = rng.normal(size=(600, 5)) * rng.uniform(0.1, 10, size=(600, 1))
+        queries = rng.normal(size=(30, 5))
+        engine = ShardEngine(matrix, block_bytes=30 * 8 * 50)
+        expected_i, expected_d = engine.query(queries, 8)
+        bounds = expected_d[:, 4]
+        blocks = []
+        engine.gather = lambda rows: blocks.append(len(rows)) or matrix[rows]
+        indices, distances = engine.query(queries, 8, bounds=bounds)
+        self.assertLess(sum(blocks), len(matrix))
+        within = expected_d <= bounds[:, None]
+        np.testing.assert_array_equal(indices[within], expected_i[within])
+        np.testing.assert_allclose(distances[within], expected_d[within])
+        # Neighbours beyond the bounds are either found in a searched block or missing
+        self.assertTrue((distances[~within] > np.broadcast_to(bounds[:, None], within.shape)[~within]).all())
+        self.assertTrue((indices[np.isinf(distances)] == len(matrix)).all())
+
+    def test_shard_engine_breaks_ties_by_index(self):
+        matrix = [[1.0, 0.0], [0.0, 1.0], [-1.0, 0.0], [0.0, -1.0], [2.0, 0.0]]
+        engine = ShardEngine(matrix, block_bytes=8)
+        indices, distances = engine.query([[0.0, 0.0]], 3)
+        np.testing.assert_array_equal(indices, [[0, 1, 2]])
+        np.testing.assert_allclose(distances, [[1.0, 1.0, 1.0]])
+
+    def test_select_k_smallest_breaks_ties_in_every_row(self):
+        rng = np.random.default_rng(3)
+        distances = rng.integers(0, 4, size=(50, 40)).astype(np.float64)
+        indices = np.stack([rng.permutation(100)[:40] for _ in range(50)])
+        best_i, best_d = select_k_smallest(distances, indices, 7)
+        order = np.lexsort((indices, distances), axis=1)[:, :7]
+        expected_i = np.take_along_axis(indices, order, axis=1)
+        np.testing.assert_array_equal(np.sort(best_i, axis=1), np.sort(expected_i, axis=1))
+        np.testing.assert_array_equal(np.sort(best_d, axis=1), np.take_along_axis(distances, order, axis=1))
+
+    def test_shard_engine_k_larger_than_shard(self):
+        engine = ShardEngine([[0.0], [3.0]], dtype=np.float32)
+        indices, distances = engine.query([[1.0], [2.5]], 5)
+        np.testing.assert_array_equal(indices, [[0, 1], [1, 0]])
+        self.assertEqual(distances.dtype, np.float32)
+
+    def test_merge_candidates_keeps_global_k_nearest(self):
+        slave1 = to_candidates([4, 7, 9], [0.5, 1.0, 3.0], ['a', 'b', 'a'])
+        slave2 = to_candidates([1, 2], [0.7, 1.0], ['b', 'b'])
+        merged = merge_candidates([slave1, slave2, []], 4)
+        self.assertEqual([c.id for c in merged], [4, 1, 2, 7], 'Equal distances should be ordered by id')
+        self.assertEqual([c.label for c in merged], ['a', 'b', 'b', 'b'])
+        self.assertEqual(len(merge_candidates([slave2], 5)), 2)
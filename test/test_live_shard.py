@@ -0,0 +1,61 @@
+from unittest import TestCase
+import numpy as np
+from knn_classifier import ShardEngine
+from live_shard import LiveShard
+from point_batch import PointBatch
+from shard_store import Shard
+from spatial_index import KDTreeIndex
+
+
+class TestLiveShard(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.points = rng.normal(size=(200, 2))
+        self.labels = np.where(self.points[:, 0] > 0, 'a', 'b')
+        self.queries = rng.normal(size=(15, 2))
+        batch = PointBatch.from_labels(self.points[:150], list(self.labels[:150]))
+        self.live = LiveShard(Shard(batch.points, batch.ids, batch.label_codes, batch.label_table),
+                              min_compact_rows=1000)
+        self.engine = KDTreeIndex(self.live.shard.points, leaf_size=8)
+
+    def check(self, ids):
+        expected_i, expected_d = ShardEngine(self.points[ids]).query(self.queries, 5)
+        found_ids, found_d, codes = self.live.query(self.engine, self.queries, 5)
+        np.testing.assert_array_equal(found_ids, np.asarray(ids)[expected_i])
+        np.testing.assert_allclose(found_d, expected_d)
+        self.assertEqual([self.live.label_table[c] for c in codes.ravel()], list(self.labels[found_ids].ravel()))
+
+    def test_insert_and_delete(self):
+        inserted = PointBatch.from_labels(self.points[150:], ['c'] + list(self.labels[151:]), np.arange(150, 200))
+        self.live.insert(inserted)
+        self.labels[150] = 'c'
+        self.assertEqual(len(self.live), 200)
+        self.check(np.arange(200))
+        # Delete the nearest neighbours of the queries, from the shard and from the buffer
+        nearest = np.unique(self.live.query(self.engine, self.queries, 3)[0])
+        self.assertEqual(self.live.delete(np.append(nearest, 999)), len(nearest))
+        self.assertEqual(len(self.live), 200 - len(nearest))
+        self.check(np.setdiff1d(np.arange(200), nearest))
+
+    def test_extract_and_compact(self):
+        self.live.insert(PointBatch.from_labels(self.points[150:], list(self.labels[150:]), np.arange(150, 200)))
+        moved = self.live.extract(60)
+        self.assertEqual(len(moved), 60)
+        self.assertEqual(len(self.live), 140)
+        self.assertEqual(len(self.live.snapshot()), 140)
+        self.assertEqual(list(moved.labels), list(self.labels[moved.ids]))
+        # A replica made from a copy of the live points gives away the same points
+        copy = self.live.snapshot()
+        replica = LiveShard(Shard(copy.points, copy.ids, copy.label_codes, copy.label_table))
+        moved = PointBatch.concatenate([moved, self.live.extract(70)])
+        self.assertEqual(sorted(replica.extract(70).ids), sorted(moved.ids[60:]))
+        self.assertEqual(len(self.live), 70)
+        self.assertFalse(self.live.needs_compaction())
+        self.live.min_compact_rows, self.live.compact_fraction = 5, 0.05
+        self.assertTrue(self.live.needs_compaction())
+        shard = self.live.compact()
+        self.assertFalse(self.live.is_modified())
+        self.engine = KDTreeIndex(shard.points, leaf_size=8)
+        self.check(np.sort(shard.ids))
+        self.assertEqual(sorted(np.concatenate([shard.ids, moved.ids])), list(range(200)))
@@ -0,0 +1,504 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest import TestCase
+import numpy as np
+from data_point import DataPoint
+from connection import SlaveConnection
+from dataset_file import DatasetFile
+from knn_classifier import classify
+from network_messages import MessageType
+from master_node import MasterNode, adaptive_request_size, balanced_sizes, capacity_sizes, capacity_weights, \
+    fill_counts
+from query_client import QueryClient
+import slave_node
+from slave_node import SlaveNode
+
+
+class SlowSlaveNode(SlaveNode):
+    """
+    Slave that waits before it answers query batches while its delay is set
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = 0
+
+    def answer_query_batch(self, message):
+        time.sleep(self.delay)
+        super().answer_query_batch(message)
+
+
+def start_nodes(master, slaves):
+    master.socket.listen(len(slaves))
+    threads = [threading.Thread(target=master.run, args=(len(slaves),))]
+    threads += [threading.Thread(target=slave.start_node) for slave in slaves]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def start_cluster(master, num_slaves, shard_directories=None, **slave_options):
+    port = master.socket.getsockname()[1]
+    slaves = [SlaveNode(master_port=port, shard_directory=shard_directories[i] if shard_directories else None,
+                        **slave_options)
+              for i in range(num_slaves)]
+    return start_nodes(master, slaves)
+
+
+def run_cluster(master, num_slaves, shard_directories=None, **slave_options):
+    for thread in start_cluster(master, num_slaves, shard_directories, **slave_options):
+        thread.join(30)
+    return master
+
+
+def wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def connect_client(address):
+    for _ in range(100):
+        try:
+            return QueryClient(address)
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.05)
+    return QueryClient(address)
+
+
+class TestMasterNode(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.dataset = [DataPoint(x, str(int(x[0] > 0))) for x in rng.normal(size=(300, 3))]
+        self.queries = [DataPoint(x) for x in rng.normal(size=(20, 3))]
+        self.expected = [classify(self.dataset, q, 7) for q in self.queries]
+
+    def test_adaptive_request_size(self):
+        self.assertEqual(adaptive_request_size(5, 1), 5)
+        self.assertLess(adaptive_request_size(100, 10), 100)
+
+    def test_fill_counts_and_balanced_sizes(self):
+        self.assertEqual(fill_counts([5, 0, 3], 4), [0, 4, 0])
+        self.assertEqual(fill_counts([2, 2], 3), [2, 1])
+        self.assertEqual(fill_counts([0, 0], 6, [1, 0.5]), [4, 2])
+        self.assertEqual(balanced_sizes([10, 0, 3]), [5, 4, 4])
+        self.assertEqual(balanced_sizes([10, 0, 2], [1, 0.5, 0.5]), [6, 3, 3])
+
+    def test_capacity_weights_and_sizes(self):
+        self.assertEqual(capacity_weights([100, 90, 40, 10], [1, 1, 1, 1]), [1.0, 1.0, 0.375, 0.125])
+        self.assertEqual(capacity_weights([1.0, 1.0], [32, 16]), [1.0, 0.5])
+        self.assertEqual(capacity_weights([100, 95, 50], [8, 4, 16]), [1.0, 0.5, 1.0])
+        self.assertEqual(capacity_sizes(10, [1, 1, 0.5]), [4, 4, 2])
+        self.assertEqual(capacity_sizes(10, [1, 1, 0.5], [2, 100, 100]), [2, 5, 3])
+
+    def test_stragglers_trigger_rebalancing(self):
+        master = MasterNode(dataset=list(self.dataset), k=7, port=0)
+        pairs = [socket.socketpair() for _ in range(2)]
+        master.connections = [SlaveConnection(pair[0], 'slave-' + str(i), i) for i, pair in enumerate(pairs)]
+        master.replicas = [[slave] for slave in master.connections]
+        master.shard_sizes = [150, 150]
+        submitted = []
+        master.submit_rebalance = submitted.append
+        master.connections[0].compute_per_query, master.connections[1].compute_per_query = 1.0, 3.0
+        for _ in range(7):
+            master.check_stragglers()
+        self.assertEqual(submitted, [])
+        master.check_stragglers()
+        self.assertEqual(submitted, [[150.0, 50.0]])
+        master.socket.close()
+        for pair in pairs:
+            pair[0].close()
+            pair[1].close()
+
+    def test_cluster_classification_matches_local(self):
+        for fan_out, index_type in (('exact', 'brute'), ('adaptive', 'kd_tree'), (1, 'ball_tree'), ('exact', 'ivf')):
+            master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0, fan_out=fan_out,
+                                index_type=index_type)
+            run_cluster(master, 3)
+            self.assertEqual([p.label for p in master.points], self.expected)
+
+    def test_pruning_with_bounds_matches_local(self):
+        for index_type in ('brute', 'kd_tree'):
+            master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0, pruning=True,
+                                index_type=index_type)
+            run_cluster(master, 3)
+            self.assertEqual([p.label for p in master.points], self.expected)
+            self.assertEqual(master.stats()['counters']['pruned_batches'], 1)
+            replies = sorted(slave['requests'] for slave in master.stats()['slaves'].values())
+            self.assertEqual(replies, [2, 2, 2])
+
+    def test_streamed_dataset_file_matches_local(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'train.csv')
+            with open(path, 'w') as f:
+                for point in self.dataset:
+                    f.write(','.join(str(value) for value in point.data) + ',' + point.label + '\n')
+            for assignment in ('round_robin', 'hash'):
+                master = MasterNode(dataset=DatasetFile(path, chunk_rows=64), points=list(self.queries), k=7, port=0,
+                                    assignment=assignment)
+                run_cluster(master, 3)
+                self.assertEqual([p.label for p in master.points], self.expected)
+                self.assertEqual(sum(master.shard_sizes), 300)
+                self.assertEqual(master.stats()['phases']['distribution']['messages_sent'], 3 * 5 + 3)
+
+    def test_serving_mode_pipelines_batches_until_shutdown(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, max_in_flight=2)
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            request_ids = [client.send_batch(self.queries[i:i + 5]) for i in range(0, 20, 5)]
+            results = dict(client.receive_result() for _ in request_ids)
+            self.assertEqual(sum((results[r] for r in request_ids), []), self.expected)
+            self.assertEqual(master.classify(self.queries[:3]), self.expected[:3])
+            stats = client.stats()
+            self.assertEqual(stats['counters']['queries'], 23)
+            self.assertEqual(stats['histograms']['query_latency']['count'], 23)
+            # Probing every IVF list gives the exact result
+            self.assertEqual(client.classify(self.queries, nprobe=1000), self.expected)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_malformed_queries_are_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, max_batch_size=8)
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            for points, k, nprobe in (([[1.0, 2.0, 3.0, 4.0]], None, None), (self.queries[:2], 0, None),
+                                      (self.queries[:2], None, -1), ([[]], None, None)):
+                with self.assertRaises(ValueError):
+                    client.classify(points, k, nprobe)
+            with self.assertRaises(ValueError):
+                master.classify([[1.0, 2.0]])
+            # Slaves reply with an error to batches they cannot answer and keep serving
+            master.check_queries = lambda queries, k, nprobe: None
+            with self.assertRaises(ValueError):
+                client.classify([[1.0, 2.0, 3.0, 4.0]])
+            self.assertEqual(client.classify(self.queries), self.expected)
+            self.assertEqual(client.stats()['counters']['failed_batches'], 1)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_micro_batches_coalesce_requests(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, max_batch_size=8,
+                                max_batch_wait=0.2)
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            request_ids = [client.send_batch(self.queries[i:i + 5]) for i in range(0, 20, 5)]
+            results = dict(client.receive_result() for _ in request_ids)
+            self.assertEqual(sum((results[r] for r in request_ids), []), self.expected)
+            # A lone request is sent once it waited long enough
+            client.send_batch(self.queries[:3], neighbours=True)
+            _, labels, neighbour_ids = client.receive_result(with_neighbours=True)
+            self.assertEqual(labels, self.expected[:3])
+            self.assertEqual(neighbour_ids.shape, (3, 7))
+            stats = client.stats()
+            self.assertEqual(stats['counters']['micro_batches'], 3)
+            self.assertEqual(stats['histograms']['micro_batch_size']['count'], 3)
+            self.assertGreaterEqual(stats['histograms']['micro_batch_wait']['max'], 0.2)
+            self.assertEqual(stats['rates']['answered_queries']['count'], 23)
+            self.assertGreater(stats['rates']['answered_queries']['per_second'], 0)
+            text = master.metrics.to_prometheus()
+            self.assertIn('knn_micro_batch_size_count ', text)
+            self.assertIn('knn_micro_batch_wait_seconds_count ', text)
+            self.assertIn('knn_answered_queries_per_second ', text)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_live_updates_and_rebalancing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=self.dataset[:200], k=7, port=0, serve_address=address, index_type='kd_tree',
+                                sizing='equal')
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            ids = client.insert(self.dataset[200:])
+            self.assertEqual(list(ids), list(range(200, 300)))
+            self.assertEqual(client.classify(self.queries), self.expected)
+            dataset = [p for i, p in enumerate(self.dataset) if i % 4]
+            self.assertEqual(master.delete([i for i in range(300) if not i % 4] + [1000]), 75)
+            expected = [classify(dataset, q, 7) for q in self.queries]
+            self.assertEqual(client.classify(self.queries), expected)
+            # A connection that never greets the Master does not stall serving
+            probe = socket.create_connection(master.socket.getsockname())
+            self.assertTrue(wait_until(lambda: len(master.joining) == 1))
+            self.assertEqual(client.classify(self.queries), expected)
+            probe.close()
+            self.assertTrue(wait_until(lambda: not master.joining))
+            joined = SlaveNode(master_port=master.socket.getsockname()[1])
+            threads.append(threading.Thread(target=joined.start_node))
+            threads[-1].start()
+            for _ in range(100):
+                if len(master.shard_sizes) == 3:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(client.rebalance(), 75)
+            self.assertEqual(master.shard_sizes, [75, 75, 75])
+            self.assertEqual(client.classify(self.queries), expected)
+            self.assertEqual(master.rebalance([1, 0.5, 0.5]), 38)
+            self.assertEqual(master.shard_sizes, [113, 56, 56])
+            self.assertEqual(client.classify(self.queries), expected)
+            # The joined Slave leaves again and its points go to the other shards
+            with self.assertRaises(ValueError):
+                client.drain('nowhere:1')
+            self.assertEqual(client.drain(str(master.replicas[2][0])), 56)
+            threads[-1].join(30)
+            self.assertFalse(threads[-1].is_alive())
+            self.assertEqual(len(master.connections), 2)
+            self.assertEqual(sum(master.shard_sizes), 225)
+            self.assertEqual(client.classify(self.queries), expected)
+            size = master.shard_sizes[1]
+            self.assertEqual(master.drain(str(master.replicas[1][0])), size)
+            self.assertEqual(master.shard_sizes, [225])
+            with self.assertRaises(ValueError):
+                master.drain(str(master.replicas[0][0]))
+            self.assertEqual(client.classify(self.queries), expected)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_updates_wait_for_moving_points(self):
+        def together(first, second):
+            both = Future()
+
+            def on_done(_):
+                if first.done() and second.done() and not both.done():
+                    both.set_result((first.result(), second.result()))
+
+            first.add_done_callback(on_done)
+            second.add_done_callback(on_done)
+            return both
+
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, sizing='equal')
+            threads = start_cluster(master, 3)
+            client = connect_client(address)
+            self.assertTrue(wait_until(lambda: master.loop_thread is not None))
+            # Deletes submitted while points move also reach the moving points
+            self.assertEqual(master.run_in_loop(lambda: together(master.submit_rebalance([1, 0.5, 0.5]),
+                                                                 master.submit_delete(range(300)))), (50, 300))
+            self.assertEqual(master.shard_sizes, [0, 0, 0])
+            self.assertEqual(list(client.insert(self.dataset)), list(range(300, 600)))
+            leaving = str(master.replicas[2][0])
+            self.assertEqual(master.run_in_loop(lambda: together(master.submit_drain(leaving),
+                                                                 master.submit_delete(range(300, 600)))), (100, 300))
+            self.assertEqual(master.shard_sizes, [0, 0])
+            client.insert(self.dataset)
+            self.assertEqual(client.classify(self.queries), self.expected)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_malformed_updates_are_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, sizing='equal')
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            with self.assertRaises(ValueError):
+                client.insert([DataPoint([1.0, 2.0], 'a')])
+            with self.assertRaises(ValueError):
+                master.delete([[1, 2]])
+            for fields, arrays in (({}, {'points': np.zeros((1, 3))}),
+                                   ({'label_table': ['a']}, {'points': np.zeros((1, 3)),
+                                                             'label_codes': np.array([1], dtype=np.int32)}),
+                                   ({'label_table': ['a']}, {'points': np.zeros((2, 3)),
+                                                             'label_codes': np.zeros(1, dtype=np.int32)})):
+                self.assertIn('error', client.request(MessageType.INSERT_POINTS, fields, arrays).fields)
+            self.assertIn('error', client.request(MessageType.DELETE_POINTS).fields)
+            self.assertIn('error', client.request(MessageType.DELETE_POINTS, arrays={'ids': np.zeros(2)}).fields)
+            # Slaves reply with an error to updates they cannot apply and keep serving
+            master.check_points = lambda batch: None
+            with self.assertRaises(ValueError):
+                client.insert([DataPoint([1.0, 2.0], 'a')])
+            self.assertEqual(client.classify(self.queries), self.expected)
+            self.assertEqual(sum(master.shard_sizes), 300)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_cached_results_until_dataset_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=self.dataset[:200], k=7, port=0, serve_address=address, sizing='equal',
+                                cache_size=100)
+            threads = start_cluster(master, 2)
+            client = connect_client(address)
+            expected = [classify(self.dataset[:200], q, 7) for q in self.queries]
+            self.assertEqual(client.classify(self.queries[:10] * 2), expected[:10] * 2)
+            self.assertEqual(client.classify(self.queries), expected)
+            counters = client.stats()['counters']
+            self.assertEqual((counters['cache_hits'], counters['cache_misses'], counters['queries']), (10, 30, 20))
+            client.insert(self.dataset[200:])
+            self.assertEqual(master.stats()['cache']['entries'], 0)
+            self.assertEqual(client.classify(self.queries), self.expected)
+            self.assertEqual(client.classify(self.queries), self.expected)
+            self.assertEqual(client.stats()['counters']['cache_hits'], 30)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_replicas_take_over_failed_slaves(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=self.dataset[:250], k=7, port=0, serve_address=address, index_type='kd_tree',
+                                replication=2, sizing='equal')
+            port = master.socket.getsockname()[1]
+            slaves = [SlaveNode(master_port=port) for _ in range(4)]
+            threads = start_nodes(master, slaves)
+            client = connect_client(address)
+            self.assertEqual(client.classify(self.queries), [classify(self.dataset[:250], q, 7) for q in self.queries])
+            self.assertEqual([len(replicas) for replicas in master.replicas], [2, 2])
+            counters = master.metrics.counters
+            # Replicas of the failed Slave's shard take over, then a joining Slave gets a copy of that shard
+            addresses = {slave.socket.getsockname(): slave for slave in slaves}
+            failed = next(slave for slave in master.connections if slave.address == slaves[0].socket.getsockname())
+            partner = next(replica for replica in master.replicas[failed.shard_id] if replica is not failed)
+            slaves[0].socket.shutdown(socket.SHUT_RDWR)
+            self.assertTrue(wait_until(lambda: counters.get('failed_slaves') == 1))
+            self.assertEqual(list(client.insert(self.dataset[250:])), list(range(250, 300)))
+            dataset = [p for i, p in enumerate(self.dataset) if i % 4]
+            self.assertEqual(client.delete([i for i in range(300) if not i % 4]), 75)
+            expected = [classify(dataset, q, 7) for q in self.queries]
+            self.assertEqual(client.classify(self.queries), expected)
+            joined = SlaveNode(master_port=port)
+            threads.append(threading.Thread(target=joined.start_node))
+            threads[-1].start()
+            self.assertTrue(wait_until(lambda: counters.get('copied_shards') == 1))
+            self.assertEqual([len(replicas) for replicas in master.replicas], [2, 2])
+            addresses[partner.address].socket.shutdown(socket.SHUT_RDWR)
+            self.assertTrue(wait_until(lambda: counters.get('failed_slaves') == 2))
+            self.assertEqual(client.classify(self.queries), expected)
+            self.assertEqual(sum(master.shard_sizes), 225)
+            # A Slave whose shard has another replica leaves without moving points
+            leaving = next(replicas[0] for replicas in master.replicas if len(replicas) == 2)
+            self.assertEqual(client.drain(str(leaving)), 0)
+            self.assertEqual([len(replicas) for replicas in master.replicas], [1, 1])
+            self.assertEqual(client.classify(self.queries), expected)
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_slow_replicas_are_hedged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'frontend.sock')
+            master = MasterNode(dataset=list(self.dataset), k=7, port=0, serve_address=address, replication=2)
+            slaves = [SlowSlaveNode(master_port=master.socket.getsockname()[1]) for _ in range(2)]
+            threads = start_nodes(master, slaves)
+            client = connect_client(address)
+            for query, expected in zip(self.queries, self.expected):
+                self.assertEqual(client.classify([query]), [expected])
+            slaves[0].delay = 1.0
+            for query, expected in zip(self.queries[:4], self.expected):
+                start = time.perf_counter()
+                self.assertEqual(client.classify([query]), [expected])
+                self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertGreaterEqual(master.metrics.counters.get('hedged_requests', 0), 1)
+            slaves[0].delay = 0
+            self.assertTrue(wait_until(lambda: master.metrics.counters.get('late_replies', 0) >= 1))
+            client.shutdown()
+            client.close()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_stats_cover_phases_and_slaves(self):
+        master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0)
+        run_cluster(master, 2)
+        stats = master.stats()
+        for phase in ('connection', 'distribution', 'classification', 'shutdown'):
+            self.assertEqual(stats['phases'][phase]['runs'], 1)
+        distribution = stats['phases']['distribution']
+        self.assertGreater(distribution['bytes_sent'], 300 * 3 * 8)
+        self.assertEqual((distribution['messages_sent'], distribution['messages_received']), (2, 2))
+        self.assertEqual(len(stats['slaves']), 2)
+        for slave in stats['slaves'].values():
+            self.assertEqual(slave['requests'], 2)
+            self.assertEqual(slave['compute_seconds']['count'], 2)
+        self.assertIn('knn_slave_round_trip_seconds_count', master.metrics.to_prometheus())
+
+    def test_restarted_slaves_reuse_stored_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shard_directories = [os.path.join(directory, 'slave-' + str(i)) for i in range(2)]
+            # Slaves measure different throughputs in every run, the stored shards keep their sizes anyway
+            throughputs = iter([1.0, 0.5, 1.0, 1.0])
+            measure = slave_node.measure_throughput
+            slave_node.measure_throughput = lambda: next(throughputs)
+            try:
+                master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0)
+                run_cluster(master, 2, shard_directories)
+                self.assertEqual([p.label for p in master.points], self.expected)
+                self.assertNotEqual(master.shard_sizes[0], master.shard_sizes[1])
+                # Slaves join in the other order, every one still keeps its own shard
+                master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0)
+                prepare = master.prepare_shards
+                requests = []
+                master.prepare_shards = lambda: requests.append(prepare()) or requests[0]
+                run_cluster(master, 2, shard_directories[::-1])
+            finally:
+                slave_node.measure_throughput = measure
+            self.assertEqual([p.label for p in master.points], self.expected)
+            self.assertTrue(all(fields.get('reuse') for fields, _ in requests[0].values()))
+            for slave in master.connections:
+                self.assertEqual(slave.manifest['shard_id'], slave.shard_id)
+
+    def test_approximate_index_is_built_with_the_shard(self):
+        master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0, index_type='brute',
+                            nprobe=1000)
+        slaves = [SlaveNode(master_port=master.socket.getsockname()[1]) for _ in range(2)]
+        built = []
+        for slave in slaves:
+            collect = slave.start_data_collection_phase
+            slave.start_data_collection_phase = lambda collect=collect, slave=slave: (
+                collect(), built.append(type(slave.approximate_engine).__name__))
+        for thread in start_nodes(master, slaves):
+            thread.join(30)
+        self.assertEqual(built, ['IVFIndex', 'IVFIndex'])
+        self.assertEqual([p.label for p in master.points], self.expected)
+
+    def test_quantized_shards_match_local(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shard_directories = [os.path.join(directory, 'slave-' + str(i)) for i in range(2)]
+            for quantization, workers in (('int8', 1), ('float16', 2)):
+                master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0,
+                                    quantization=quantization)
+                run_cluster(master, 2, shard_directories, workers=workers)
+                self.assertEqual([p.label for p in master.points], self.expected)
+
+    def test_multi_core_slaves(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for mode, shard_directories in (('thread', None), ('process', [directory])):
+                master = MasterNode(dataset=list(self.dataset), points=list(self.queries), k=7, port=0)
+                run_cluster(master, len(shard_directories or [1, 2]), shard_directories, workers=3, worker_mode=mode)
+                self.assertEqual([p.label for p in master.points], self.expected)
+                self.assertEqual([slave.workers for slave in master.connections], [3] * len(master.connections))
@@ -0,0 +1,54 @@
+from unittest import TestCase
+from metrics import *
+
+
+class Node(object):
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.sent = 0
+
+    def traffic(self):
+        return {'bytes_sent': self.sent, 'bytes_received': 0, 'messages_sent': 0, 'messages_received': 0}
+
+    @measure_phase('work')
+    def work(self, size):
+        self.sent += size
+        return size
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram([1, 2, 4, 8])
+        for value in (0.5, 1.5, 1.5, 3, 100):
+            histogram.observe(value)
+        histogram.observe(0.2, count=5)
+        self.assertEqual(histogram.count, 10)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(80), 2)
+        self.assertEqual(histogram.percentile(100), 100)
+        self.assertEqual(Histogram().percentile(99), 0.0)
+
+    def test_measure_phase(self):
+        node = Node()
+        self.assertEqual(node.work(10), 10)
+        node.work(5)
+        phase = node.metrics.to_dict()['phases']['work']
+        self.assertEqual((phase['runs'], phase['bytes_sent']), (2, 15))
+        self.assertGreaterEqual(phase['seconds'], 0)
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.slave('10.0.0.1:5000').round_trip.observe(0.003)
+        metrics.histogram('query_latency').observe(0.5, count=3)
+        metrics.increment('queries', 3)
+        metrics.histogram('batch_size', SIZE_BUCKETS, unit=None).observe(4)
+        metrics.rate('answered_queries').add(3)
+        text = metrics.to_prometheus()
+        self.assertIn('knn_batch_size_bucket{le="4"} 1.0', text)
+        self.assertIn('# TYPE knn_answered_queries_per_second gauge', text)
+        self.assertEqual(metrics.to_dict()['rates']['answered_queries']['count'], 3)
+        self.assertIn('knn_slave_round_trip_seconds_count{slave="10.0.0.1:5000"} 1.0', text)
+        self.assertIn('knn_query_latency_seconds_bucket{le="+Inf"} 3.0', text)
+        self.assertIn('knn_queries 3.0', text)
@@ -0,0 +1,52 @@
+import socket
+from unittest import TestCase
+import numpy as np
+from network_messages import *
+
+
+class TestNetworkMessages(TestCase):
+
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_round_trip_arrays_and_fields(self):
+        points = np.arange(15, dtype=np.float64).reshape(5, 3)
+        ids = np.arange(5, dtype=np.int64)
+        codes = np.array([0, 1, 0], dtype=np.int32)
+        send_message(self.left, MessageType.DATA_BATCH, {'label_table': ['a', 'b']},
+                     {'codes': codes, 'points': points, 'ids': ids})
+        message = recv_message(self.right, MessageType.DATA_BATCH)
+        self.assertEqual(message.fields, {'label_table': ['a', 'b']})
+        np.testing.assert_array_equal(message.arrays['points'], points)
+        np.testing.assert_array_equal(message.arrays['ids'], ids)
+        np.testing.assert_array_equal(message.arrays['codes'], codes)
+
+    def test_consecutive_messages_are_not_glued(self):
+        send_message(self.left, MessageType.GREET_SERVER)
+        send_message(self.left, MessageType.QUERY_BATCH, {'k': 3}, {'queries': np.zeros((0, 4))})
+        self.assertEqual(recv_message(self.right).type, MessageType.GREET_SERVER)
+        message = recv_message(self.right)
+        self.assertEqual(message.fields['k'], 3)
+        self.assertEqual(message.arrays['queries'].shape, (0, 4))
+
+    def test_unexpected_type_raises(self):
+        send_message(self.left, MessageType.SHUTDOWN)
+        with self.assertRaises(ProtocolError):
+            recv_message(self.right, MessageType.GREET_CLIENT)
+
+    def test_bad_headers_are_rejected_before_the_frame_is_read(self):
+        self.right.settimeout(5)
+        self.left.sendall(HEADER.pack(b'GE', PROTOCOL_VERSION, 1, 10, 10))
+        with self.assertRaises(ProtocolError):
+            recv_message(self.right)
+        self.left.sendall(HEADER.pack(MAGIC, PROTOCOL_VERSION, 1, 2, MAX_BODY_BYTES + 1))
+        with self.assertRaises(ProtocolError):
+            recv_message(self.right)
+        self.right.setblocking(False)
+        self.left.sendall(HEADER.pack(MAGIC, PROTOCOL_VERSION + 1, 1, 0, 0))
+        with self.assertRaises(ProtocolError):
+            FrameReader().read(self.right)
@@ -0,0 +1,44 @@
+from unittest import TestCase
+import numpy as np
+from knn_classifier import ShardEngine
+from spatial_index import INDEX_BRUTE, INDEX_KD_TREE
+from parallel_index import *
+
+
+class TestParallelIndex(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.matrix = rng.normal(size=(503, 3))
+        self.queries = rng.normal(size=(40, 3))
+        self.expected = ShardEngine(self.matrix).query(self.queries, 7)
+
+    def test_split_rows(self):
+        self.assertEqual(split_rows(10, 3), [(0, 4), (4, 7), (7, 10)])
+        self.assertEqual(split_rows(2, 2), [(0, 1), (1, 2)])
+
+    def test_thread_workers_match_single_index(self):
+        for index_type in (INDEX_BRUTE, INDEX_KD_TREE):
+            index = ParallelIndex(index_type, self.matrix, workers=4)
+            indices, distances = index.query(self.queries, 7)
+            index.close()
+            np.testing.assert_array_equal(indices, self.expected[0])
+            np.testing.assert_allclose(distances, self.expected[1])
+
+    def test_process_workers_share_the_shard(self):
+        index = ParallelIndex(INDEX_BRUTE, self.matrix, workers=2, mode=WORKER_PROCESS)
+        try:
+            indices, distances = index.query(self.queries, 7)
+            self.assertEqual(len(index.processes), 2)
+        finally:
+            index.close()
+        np.testing.assert_array_equal(indices, self.expected[0])
+        np.testing.assert_allclose(distances, self.expected[1])
+        self.assertIsNone(index.memory)
+
+    def test_more_workers_than_rows(self):
+        index = ParallelIndex(INDEX_BRUTE, [[1.0], [4.0]], workers=8)
+        indices, distances = index.query([[3.0]], 5)
+        index.close()
+        np.testing.assert_array_equal(indices, [[1, 0]])
+        np.testing.assert_allclose(distances, [[1.0, 2.0]])
@@ -0,0 +1,61 @@
+from unittest import TestCase
+import numpy as np
+from data_point import DataPoint
+from point_batch import *
+
+
+class TestPointBatch(TestCase):
+
+    def setUp(self):
+        self.batch = PointBatch.from_labels(np.arange(20.0).reshape(10, 2), [str(i % 3) for i in range(10)])
+
+    def test_split_sizes(self):
+        self.assertEqual(split_sizes(10, 3), [4, 3, 3])
+        self.assertEqual(split_sizes(2, 3), [1, 1, 0])
+        self.assertEqual(weighted_split_sizes(10, [1, 1, 1]), [4, 3, 3])
+        self.assertEqual(weighted_split_sizes(10, [1, 1, 1], priority=[0, 0, 5]), [3, 3, 4])
+        self.assertEqual(weighted_split_sizes(10, [2, 1, 1]), [5, 3, 2])
+        self.assertEqual([len(part) for part in self.batch.split(3, [6, 0, 4])], [6, 0, 4])
+
+    def test_label_codes_round_trip(self):
+        labels = ['x', 'y', 'x', None]
+        codes, table = encode_labels(labels)
+        self.assertEqual(list(decode_labels(codes, table)), labels)
+        self.assertEqual(decode_labels(codes.reshape(2, 2), table).shape, (2, 2))
+
+    def test_slices_share_memory(self):
+        shards = self.batch.split(3)
+        self.assertEqual([len(shard) for shard in shards], [4, 3, 3])
+        for shard in shards:
+            self.assertTrue(np.shares_memory(shard.points, self.batch.points))
+        self.assertEqual(list(shards[1].ids), [4, 5, 6])
+
+    def test_points_are_data_point_views(self):
+        point = self.batch[4]
+        self.assertIsInstance(point, DataPoint)
+        self.assertEqual(point.id, 4)
+        self.assertEqual(point.label, '1')
+        self.assertTrue(np.shares_memory(point.data, self.batch.points))
+        self.assertEqual([p.label for p in self.batch][:4], ['0', '1', '2', '0'])
+
+    def test_shuffle_permutes_every_column(self):
+        shuffled = self.batch.shuffle(5)
+        self.assertEqual(sorted(shuffled.ids), list(range(10)))
+        np.testing.assert_array_equal(shuffled.points, self.batch.points[shuffled.ids])
+        self.assertEqual(list(shuffled.labels), list(self.batch.labels[shuffled.ids]))
+        np.testing.assert_array_equal(self.batch.shuffle(5).ids, shuffled.ids)
+
+    def test_concatenate_merges_label_tables(self):
+        other = PointBatch.from_labels(np.ones((2, 2)), ['5', '2'], np.array([10, 11]))
+        joined = PointBatch.concatenate([self.batch, other])
+        self.assertEqual(len(joined), 12)
+        self.assertEqual(list(joined.labels), list(self.batch.labels) + ['5', '2'])
+        self.assertEqual(joined.label_table, ['0', '1', '2', '5'])
+
+    def test_conversions(self):
+        batch = as_point_batch([DataPoint([1.0, 2.0], 'a'), DataPoint([3.0, 4.0], 'b')])
+        self.assertEqual(list(batch.labels), ['a', 'b'])
+        self.assertEqual(list(batch.with_labels(['c', 'c']).labels), ['c', 'c'])
+        self.assertEqual(as_query_matrix([DataPoint([1.0, 2.0]), [3.0, 4.0]]).shape, (2, 2))
+        self.assertIs(as_point_batch(batch), batch)
+        self.assertIsNone(as_point_batch(np.zeros((3, 2)))[0].label)
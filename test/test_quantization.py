@@ -0,0 +1,67 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from knn_classifier import ShardEngine
+from parallel_index import ParallelIndex
+from quantization import *
+from spatial_index import INDEX_IVF, IVFIndex, build_index
+
+
+class TestQuantization(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(6)
+        self.matrix = rng.normal(scale=[1, 10, 100, 0.1], size=(900, 4))
+        self.queries = rng.normal(scale=[1, 10, 100, 0.1], size=(50, 4))
+        self.expected = ShardEngine(self.matrix).query(self.queries, 9)
+
+    def test_quantizer_round_trip(self):
+        for quantization, dtype, tolerance in ((QUANTIZATION_INT8, np.int8, 0.5 / INT8_LEVELS),
+                                               (QUANTIZATION_FLOAT16, np.float16, 1e-3)):
+            quantizer = ScalarQuantizer.fit(self.matrix, quantization)
+            codes = quantizer.encode(self.matrix)
+            self.assertEqual(codes.dtype, dtype)
+            span = self.matrix.max(axis=0) - self.matrix.min(axis=0)
+            self.assertTrue(np.all(np.abs(quantizer.decode(codes) - self.matrix) <= tolerance * span + 1e-12))
+        constant = ScalarQuantizer.fit(np.ones((3, 2)))
+        np.testing.assert_array_equal(constant.decode(constant.encode(np.ones((3, 2)))), np.ones((3, 2)))
+
+    def test_rerank_is_exact(self):
+        for quantization in QUANTIZATIONS:
+            index = QuantizedIndex(self.matrix, quantization, rerank=1.0)
+            self.assertLess(index.nbytes, self.matrix.nbytes)
+            indices, distances = index.query(self.queries, 9)
+            np.testing.assert_array_equal(indices, self.expected[0])
+            np.testing.assert_allclose(distances, self.expected[1])
+
+    def test_memory_mapped_points_and_small_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'points.npy')
+            np.save(path, self.matrix)
+            index = QuantizedIndex(np.load(path, mmap_mode='r'))
+            indices, distances = index.query(self.queries, 9)
+            np.testing.assert_array_equal(indices, self.expected[0])
+            del index
+        indices, distances = QuantizedIndex(self.matrix[:5]).query(self.queries[0], 9)
+        self.assertEqual(indices.shape, (1, 5))
+        self.assertEqual(QuantizedIndex(np.empty((0, 4))).query(self.queries, 3)[0].shape, (50, 0))
+
+    def test_build_index_with_quantization(self):
+        self.assertIsInstance(build_index('kd_tree', self.matrix, quantization=QUANTIZATION_INT8), QuantizedIndex)
+        self.assertIsInstance(build_index(INDEX_IVF, self.matrix, quantization=QUANTIZATION_INT8), IVFIndex)
+        index = ParallelIndex('brute', self.matrix, workers=3, quantization=QUANTIZATION_FLOAT16)
+        indices, distances = index.query(self.queries, 9)
+        index.close()
+        np.testing.assert_array_equal(indices, self.expected[0])
+        np.testing.assert_allclose(distances, self.expected[1])
+
+    def test_decoded_blocks_are_bounded(self):
+        index = QuantizedIndex(self.matrix, block_bytes=8 * 100 * (1 + 4))
+        blocks = []
+        block = index.block
+        index.block = lambda start, end: blocks.append(block(start, end)) or blocks[-1]
+        indices, distances = index.query(self.queries[:1], 9)
+        np.testing.assert_array_equal(indices, self.expected[0][:1])
+        self.assertLessEqual(max(decoded.nbytes for decoded in blocks), index.block_bytes)
+        self.assertGreater(len(blocks), 1)
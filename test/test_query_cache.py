@@ -0,0 +1,60 @@
+from unittest import TestCase
+import numpy as np
+from knn_classifier import to_candidates
+from query_cache import QueryCache, entry_bytes
+
+
+class TestQueryCache(TestCase):
+
+    def setUp(self):
+        self.queries = np.random.default_rng(5).normal(size=(6, 3))
+        self.neighbours = to_candidates(np.arange(3), np.array([0.1, 0.2, 0.3]), np.array(['a', 'b', 'a']))
+
+    def test_keys_depend_on_query_k_and_nprobe(self):
+        cache = QueryCache(10)
+        keys = cache.keys(self.queries, 3)
+        self.assertEqual(len(set(keys)), 6)
+        self.assertEqual(cache.keys(self.queries.copy(), 3), keys)
+        self.assertNotEqual(cache.keys(self.queries, 4), keys)
+        self.assertNotEqual(cache.keys(self.queries, 3, nprobe=2), keys)
+        self.assertEqual(cache.keys(np.array([[-0.0, 1.0]]), 3), cache.keys(np.array([[0.0, 1.0]]), 3))
+        self.assertNotEqual(cache.keys(self.queries + 1e-9, 3), keys)
+
+    def test_quantized_keys_share_near_duplicates(self):
+        cache = QueryCache(10, precision=1e-3)
+        self.assertEqual(cache.keys(self.queries + 1e-6, 3), cache.keys(self.queries, 3))
+        self.assertNotEqual(cache.keys(self.queries + 1e-2, 3), cache.keys(self.queries, 3))
+
+    def test_least_recently_used_results_are_evicted(self):
+        cache = QueryCache(2)
+        keys = cache.keys(self.queries, 3)
+        self.assertEqual(cache.put(keys[0], self.neighbours, 'a', 0), 0)
+        cache.put(keys[1], self.neighbours, 'b', 0)
+        self.assertEqual(cache.get(keys[0]), (self.neighbours, 'a'))
+        self.assertEqual(cache.put(keys[2], self.neighbours, 'c', 0), 1)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[2]), (self.neighbours, 'c'))
+        self.assertEqual(len(cache), 2)
+
+    def test_memory_cap(self):
+        keys = QueryCache(10).keys(self.queries, 3)
+        size = entry_bytes(keys[0], self.neighbours, 'a')
+        cache = QueryCache(10, max_bytes=3 * size)
+        evicted = sum(cache.put(key, self.neighbours, 'a', 0) for key in keys)
+        self.assertEqual((len(cache), evicted), (3, 3))
+        self.assertLessEqual(cache.bytes, 3 * size)
+        self.assertEqual([cache.get(key) is not None for key in keys], [False] * 3 + [True] * 3)
+        self.assertEqual(QueryCache(10, max_bytes=size - 1).put(keys[0], self.neighbours, 'a', 0), 0)
+
+    def test_new_dataset_version_empties_the_cache(self):
+        cache = QueryCache(10)
+        keys = cache.keys(self.queries, 3)
+        cache.put(keys[0], self.neighbours, 'a', 0)
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.bytes, 0)
+        # Results of queries sent before the change are not stored
+        cache.put(keys[0], self.neighbours, 'a', 0)
+        self.assertEqual(len(cache), 0)
+        cache.put(keys[0], self.neighbours, 'a', 1)
+        self.assertEqual(cache.to_dict()['entries'], 1)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from shard_store import *
+
+
+class TestShardStore(TestCase):
+
+    def test_write_and_open_memory_mapped_shard(self):
+        points = np.arange(12, dtype=np.float64).reshape(4, 3)
+        ids = np.array([7, 3, 9, 1], dtype=np.int64)
+        codes = np.array([0, 1, 1, 0], dtype=np.int32)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shard-2')
+            manifest = write_shard(path, 2, points, ids, codes, ['a', 'b'])
+            self.assertEqual(read_manifest(path), manifest)
+            shard = open_shard(path)
+            self.assertIsInstance(shard.points, np.memmap)
+            np.testing.assert_array_equal(shard.points, points)
+            np.testing.assert_array_equal(shard.ids, ids)
+            np.testing.assert_array_equal(shard.label_codes, codes)
+            np.testing.assert_array_equal(shard.norms, (points ** 2).sum(axis=1))
+            self.assertEqual(shard.label_table, ['a', 'b'])
+            self.assertEqual(manifest['checksum'], shard_checksum(shard.points, shard.ids, shard.label_codes,
+                                                                  shard.label_table))
+
+    def test_checksum_changes_with_contents(self):
+        points = np.ones((3, 2))
+        ids = np.arange(3, dtype=np.int64)
+        codes = np.zeros(3, dtype=np.int32)
+        checksum = shard_checksum(points, ids, codes, ['x'])
+        self.assertNotEqual(checksum, shard_checksum(points * 2, ids, codes, ['x']))
+        self.assertNotEqual(checksum, shard_checksum(points, ids, codes, ['y']))
+
+    def test_missing_shard(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(read_manifest(directory))
+            with self.assertRaises(FileNotFoundError):
+                open_shard(directory)
+
+    def test_spilled_points_are_memory_mapped(self):
+        points = np.arange(12, dtype=np.float64).reshape(4, 3)
+        spilled = spill_points(points)
+        path = spilled.filename
+        self.assertIsInstance(spilled, np.memmap)
+        np.testing.assert_array_equal(spilled, points)
+        rows = spilled[1:3]
+        del spilled
+        np.testing.assert_array_equal(rows, points[1:3])
+        self.assertTrue(os.path.exists(path))
+        del rows
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(spill_points(np.empty((0, 3))).shape, (0, 3))
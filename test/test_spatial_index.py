@@ -0,0 +1,76 @@
+from unittest import TestCase
+import os
+import tempfile
+import numpy as np
+from knn_classifier import ShardEngine
+from spatial_index import *
+
+
+class TestSpatialIndex(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        centers = rng.normal(scale=5, size=(4, 3))
+        self.matrix = centers[rng.integers(0, 4, 700)] + rng.normal(size=(700, 3))
+        self.queries = rng.normal(scale=5, size=(60, 3))
+        self.expected = ShardEngine(self.matrix).query(self.queries, 9)
+
+    def test_trees_match_brute_force(self):
+        for index in (KDTreeIndex(self.matrix, leaf_size=16), BallTreeIndex(self.matrix, leaf_size=16)):
+            indices, distances = index.query(self.queries, 9)
+            np.testing.assert_array_equal(indices, self.expected[0])
+            np.testing.assert_allclose(distances, self.expected[1])
+
+    def test_trees_break_ties_by_index(self):
+        grid = np.array([[x, y] for x in range(6) for y in range(6)], dtype=np.float64)
+        for index in (KDTreeIndex(grid, leaf_size=4), BallTreeIndex(grid, leaf_size=4)):
+            indices, _ = index.query([[2.0, 2.0], [0.5, 0.5]], 5)
+            np.testing.assert_array_equal(indices, ShardEngine(grid).query([[2.0, 2.0], [0.5, 0.5]], 5)[0])
+
+    def test_small_and_empty_shards(self):
+        index = KDTreeIndex([[1.0], [4.0]], leaf_size=1)
+        indices, distances = index.query([[3.0]], 5)
+        np.testing.assert_array_equal(indices, [[1, 0]])
+        np.testing.assert_allclose(distances, [[1.0, 2.0]])
+        self.assertEqual(BallTreeIndex(np.zeros((0, 2))).query([[1.0, 1.0]], 3)[0].shape, (1, 0))
+
+    def test_build_index_auto(self):
+        self.assertIsInstance(build_index(INDEX_AUTO, self.matrix[:10]), ShardEngine)
+        self.assertIsInstance(build_index(INDEX_AUTO, np.zeros((5000, 3))), KDTreeIndex)
+        self.assertIsInstance(build_index(INDEX_AUTO, np.zeros((5000, 12))), BallTreeIndex)
+        self.assertIsInstance(build_index(INDEX_AUTO, np.zeros((5000, 64))), ShardEngine)
+        with self.assertRaises(ValueError):
+            build_index('unknown', self.matrix)
+
+    def test_ivf_probing_all_lists_is_exact(self):
+        index = build_index(INDEX_IVF, self.matrix, lists=12)
+        self.assertEqual(len(index.leaves), 12)
+        indices, distances = index.query(self.queries, 9)
+        np.testing.assert_array_equal(indices, self.expected[0])
+        np.testing.assert_allclose(distances, self.expected[1])
+
+    def test_ivf_approximate_search(self):
+        index = IVFIndex(self.matrix, lists=40)
+        indices, distances = index.query(self.queries, 9, nprobe=4)
+        recall = np.mean([len(np.intersect1d(a, b)) / 9 for a, b in zip(indices, self.expected[0])])
+        self.assertGreater(recall, 0.8)
+        self.assertTrue((indices < len(self.matrix)).all())
+        self.assertTrue((np.diff(distances, axis=1) >= 0).all())
+        # A single probed list may hold fewer than k points, such queries are answered exactly
+        indices, _ = index.query(self.queries, 200, nprobe=1)
+        self.assertTrue((indices < len(self.matrix)).all())
+
+    def test_memory_mapped_shards_stay_on_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shard.npy')
+            np.save(path, self.matrix)
+            shard = np.load(path, mmap_mode='r')
+            for index in (KDTreeIndex(shard, leaf_size=16), BallTreeIndex(shard, leaf_size=16),
+                          IVFIndex(shard, lists=12)):
+                self.assertIsInstance(index.matrix, np.memmap)
+                self.assertEqual(os.path.dirname(index.matrix.filename), directory)
+                indices, distances = index.query(self.queries, 9)
+                np.testing.assert_array_equal(indices, self.expected[0])
+                np.testing.assert_allclose(distances, self.expected[1])
+            del index
+            self.assertEqual(os.listdir(directory), ['shard.npy'])